@@ -6,24 +6,34 @@ import json
 import sys
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
 import base64
+import hashlib
+import shutil
+import sqlite3
+import io
+import uuid
 import os
+import random
 import time
 import logging
+import threading
+import collections
+import statistics
+import queue
+import signal
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as futures_wait
+from davinci_common import effective_brand, exe_version, parse_services_map
 
 # Paths and configuration
 EXE     = r"C:\Program Files\DAVINCI\davinci.exe"
 SCRIPT  = r"C:\Program Files\DAVINCI\davinci_automation.py"
 PYTHON  = r"C:\davinci_venv\Scripts\python.exe"
 INDIR   = Path(r"C:\ecu_files\original")
+OUTDIR  = Path(r"C:\ecu_files\modified")
 WORKDIR = Path(r"C:\davinci_automation")
 
-for p in (INDIR, WORKDIR):
-    try:
-        p.mkdir(parents=True, exist_ok=True)
-    except Exception:
-        pass
-
 API_STAGING_FILES_URL = "https://backend-staging.ecutech.gr/api/davinci/files"
 API_PRODUCTION_FILES_URL = "https://backend.ecutech.gr/api/davinci/files"
 
@@ -33,11 +43,84 @@ API_PRODUCTION_SAVE_REPLY_URL = "https://backend.ecutech.gr/api/davinci/save_rep
 API_STAGING_FAILURE_REPLY_URL = "https://backend-staging.ecutech.gr/api/davinci/failure"
 API_PRODUCTION_FAILURE_REPLY_URL = "https://backend.ecutech.gr/api/davinci/failure"
 
-logging.basicConfig(
-    filename=str(Path("C:/davinci_automation/agent.log")),
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(message)s",
-)
+LOG_PATH = WORKDIR / "agent.log"
+
+
+def _setup_runtime():
+    """Create the working folders and start logging to LOG_PATH (run by the agent's entry point)."""
+    for p in (INDIR, WORKDIR):
+        try:
+            p.mkdir(parents=True, exist_ok=True)
+        except Exception:
+            pass
+    logging.basicConfig(
+        filename=str(LOG_PATH),
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+# HTTP connection layer: one pooled keep-alive session per backend host, shared by
+# polling, downloads and replies. Pool sizes and timeouts can be overridden via env.
+HTTP_POOL_CONNECTIONS = _env_int("DAVINCI_HTTP_POOL_CONNECTIONS", 2)
+HTTP_POOL_MAXSIZE     = _env_int("DAVINCI_HTTP_POOL_MAXSIZE", 4)
+HTTP_CONNECT_TIMEOUT  = _env_float("DAVINCI_HTTP_CONNECT_TIMEOUT", 5)
+HTTP_READ_TIMEOUT     = _env_float("DAVINCI_HTTP_READ_TIMEOUT", 30)
+HTTP_DOWNLOAD_READ_TIMEOUT = _env_float("DAVINCI_HTTP_DOWNLOAD_READ_TIMEOUT", 60)
+
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def _session_for(url: str) -> requests.Session:
+    """Return the shared keep-alive session for the host of `url` (created on first use)."""
+    parts = urlsplit(url)
+    key = f"{parts.scheme}://{parts.netloc}"
+    with _SESSIONS_LOCK:
+        s = _SESSIONS.get(key)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=HTTP_POOL_MAXSIZE,
+                pool_block=False,
+            )
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            _SESSIONS[key] = s
+            logging.info(
+                f"HTTP session created for {key} (pool_maxsize={HTTP_POOL_MAXSIZE})"
+            )
+        return s
+
+
+def _timeout(read: float | None = None):
+    """(connect, read) timeout tuple for requests."""
+    return (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT if read is None else read)
+
+
+def close_sessions():
+    """Close all pooled sessions (used on shutdown)."""
+    with _SESSIONS_LOCK:
+        for s in _SESSIONS.values():
+            try:
+                s.close()
+            except Exception:
+                pass
+        _SESSIONS.clear()
 
 def _select_failure_url(on_dev):
     """
@@ -49,25 +132,32 @@ def _select_failure_url(on_dev):
         return API_STAGING_FAILURE_REPLY_URL
     return API_PRODUCTION_FAILURE_REPLY_URL
 
-def _post_failure(task_id, message: str, on_dev):
-    """POST a failure reason back to the backend for the given task_id."""
+def _post_failure(task_id, message: str, on_dev, idempotency_key: str | None = None,
+                  url: str | None = None) -> bool:
+    """POST a failure reason back to the backend for the given task_id. Returns True if accepted.
+
+    `url` overrides the endpoint picked from `on_dev`.
+    """
     if not task_id or not (message or "").strip():
         logging.info("failure skipped (missing task_id or message)")
-        return
+        return False
 
     payload = {
         "task_id": str(task_id),
         "message": message,
     }
     try:
-        url = _select_failure_url(on_dev)
+        url = url or _select_failure_url(on_dev)
         logging.info(f"Posting failure to {url} for task_id={task_id} | message={message}")
         print(f"[AGENT] Posting failure for task_id={task_id}: {message}", flush=True)
-        resp = requests.post(url, json=payload, timeout=30)
+        headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+        resp = _session_for(url).post(url, json=payload, headers=headers, timeout=_timeout())
         print(f"[AGENT] failure response: {resp.status_code}", flush=True)
         logging.info(f"failure response: {resp.status_code} {resp.text[:500]}")
+        return resp.ok
     except Exception as e:
         logging.error(f"failure post error for task_id={task_id}: {e}")
+        return False
 
 def _select_save_reply_url(on_dev):
     """
@@ -111,17 +201,39 @@ def _normalize_services(s):
     return s
 
 
-def _download_file(url: str, dest: Path) -> bool:
-    """Download a file from `url` to `dest`. Returns True on success."""
+class _DownloadAborted(Exception):
+    """A download stopped because its `reserve` callback refused more bytes."""
+
+
+def _download_file(url: str, dest: Path, reserve=None) -> bool:
+    """Download a file from `url` to `dest`. Returns True on success.
+
+    `reserve(nbytes)` is asked for disk space before it is written: once for the
+    Content-Length, then for any bytes beyond it. The download is abandoned when
+    it returns False.
+    """
     try:
         logging.info(f"Downloading {url} -> {dest}")
-        with requests.get(url, stream=True, timeout=60) as r:
+        with _session_for(url).get(url, stream=True, timeout=_timeout(HTTP_DOWNLOAD_READ_TIMEOUT)) as r:
             r.raise_for_status()
+            reserved = written = 0
+            if reserve is not None:
+                reserved = int(r.headers.get("Content-Length") or 0)
+                if reserved and not reserve(reserved):
+                    raise _DownloadAborted(f"{reserved} bytes")
             with open(dest, "wb") as f:
                 for chunk in r.iter_content(chunk_size=8192):
                     if chunk:
+                        written += len(chunk)
+                        if reserve is not None and written > reserved:
+                            if not reserve(written - reserved):
+                                raise _DownloadAborted(f"more than {reserved} bytes")
+                            reserved = written
                         f.write(chunk)
         return True
+    except _DownloadAborted as e:
+        logging.info(f"Download of {url} abandoned: no disk space reserved for {e}")
+        return False
     except Exception as e:
         logging.error(f"Download failed for {url}: {e}")
         return False
@@ -135,10 +247,362 @@ def _extract_automation_error(out: str, err: str) -> str:
     # fallback: first 500 chars of combined output
     return combined.strip()[:500] if combined.strip() else "DaVinci automation failed (no further details)."
 
-def _run_automation(bin_path: Path, brand: str, ecu: str, services):
-    """Call davinci_automation.py with the given parameters.
+# Supervised automation runner: per-task wall-clock deadline, process-tree kill
+# on expiry, and only a bounded tail of the child's output kept in memory.
+AUTOMATION_TIMEOUT = _env_float("DAVINCI_AUTOMATION_TIMEOUT", 900)
+AUTOMATION_OUTPUT_LINES = _env_int("DAVINCI_AUTOMATION_OUTPUT_LINES", 400)
+
+# In priority order: the first pattern that matched anywhere wins
+_SAVED_PATH_PATTERNS = [
+    re.compile(r"SAVED_PATH:(?P<p>.+)"),
+    re.compile(r"SAVED:(?P<p>.+)"),
+    re.compile(r"SAVING_TO:(?P<p>.+)"),
+]
+_AUTOMATION_ERROR_RE = re.compile(r"AUTOMATION_ERROR:\s*(.+)")
+_STAGE_TIMING_PREFIX = "STAGE_TIMING:"
+STAGE_TIMINGS_PATH = WORKDIR / "stage_timings.jsonl"
+
+
+class _SupervisedRun:
+    """Outcome of _run_supervised: exit code, output tails and markers seen while streaming."""
+
+    def __init__(self, max_lines: int):
+        self.returncode = None
+        self.timed_out = False
+        self.duration = 0.0
+        self.stdout = collections.deque(maxlen=max_lines)
+        self.stderr = collections.deque(maxlen=max_lines)
+        self.saved_paths = [None] * len(_SAVED_PATH_PATTERNS)
+        self.automation_error = None
+        self.stages = []
+        self._lock = threading.Lock()
+
+    @property
+    def saved_path(self):
+        return next((p for p in self.saved_paths if p), None)
+
+    def out_text(self) -> str:
+        return "\n".join(self.stdout)
+
+    def err_text(self) -> str:
+        return "\n".join(self.stderr)
+
+    def feed(self, stream: str, line: str):
+        """Store one output line and react to the markers it carries."""
+        line = line.rstrip("\r\n")
+        with self._lock:
+            (self.stdout if stream == "stdout" else self.stderr).append(line)
+            if line.startswith(_STAGE_TIMING_PREFIX):
+                try:
+                    self.stages.append(json.loads(line[len(_STAGE_TIMING_PREFIX):]))
+                except ValueError:
+                    pass
+                return
+            for i, pat in enumerate(_SAVED_PATH_PATTERNS):
+                m = pat.search(line)
+                if m and self.saved_paths[i] is None:
+                    self.saved_paths[i] = m.group("p").strip().strip('"')
+                    logging.info(f"automation reported {pat.pattern.split(':')[0]}: {self.saved_paths[i]}")
+            m = _AUTOMATION_ERROR_RE.search(line)
+            if m and self.automation_error is None:
+                self.automation_error = m.group(1).strip()
+                logging.error(f"automation reported error: {self.automation_error}")
+
+
+def _kill_process_tree(proc: subprocess.Popen):
+    """Kill `proc` and every process it started (DaVinci helpers, dialogs, ...)."""
+    try:
+        if os.name == "nt":
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(proc.pid)], capture_output=True, timeout=30)
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except Exception as e:
+        logging.error(f"process tree kill failed for pid={proc.pid}: {e}")
+    try:
+        proc.kill()
+    except Exception:
+        pass
+
+
+def _run_supervised(cmd, timeout: float = AUTOMATION_TIMEOUT, cwd=None,
+                    max_lines: int = AUTOMATION_OUTPUT_LINES) -> _SupervisedRun:
+    """Run `cmd`, streaming stdout/stderr line by line into a bounded ring buffer.
 
-    Returns (ok, saved_path, stdout, stderr).
+    The whole process tree is killed when `timeout` seconds of wall-clock time
+    have passed; the result then has timed_out=True.
+    """
+    result = _SupervisedRun(max_lines)
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    popen_kw = {}
+    if os.name == "nt":
+        popen_kw["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        popen_kw["start_new_session"] = True
+
+    t0 = time.monotonic()
+    proc = subprocess.Popen(
+        cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        text=True, encoding="utf-8", errors="replace", bufsize=1, **popen_kw,
+    )
+
+    def pump(pipe, name):
+        try:
+            for line in pipe:
+                result.feed(name, line)
+        except Exception:
+            pass
+        finally:
+            try:
+                pipe.close()
+            except Exception:
+                pass
+
+    readers = [
+        threading.Thread(target=pump, args=(proc.stdout, "stdout"), daemon=True),
+        threading.Thread(target=pump, args=(proc.stderr, "stderr"), daemon=True),
+    ]
+    for t in readers:
+        t.start()
+
+    try:
+        result.returncode = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        result.timed_out = True
+        logging.error(f"automation exceeded {timeout}s deadline; killing process tree (pid={proc.pid})")
+        _kill_process_tree(proc)
+        try:
+            result.returncode = proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            result.returncode = -9
+    for t in readers:
+        t.join(5)
+    result.duration = time.monotonic() - t0
+    return result
+
+
+# Persistent automation worker: one long-lived `davinci_automation.py --worker`
+# process takes jobs as JSON lines, so interpreter start-up, the pywinauto/comtypes
+# import and DaVinci window discovery are paid once instead of per task.
+AUTOMATION_WORKER = os.environ.get("DAVINCI_AUTOMATION_WORKER", "1").strip() != "0"
+WORKER_MAX_JOBS = _env_int("DAVINCI_WORKER_MAX_JOBS", 50)
+WORKER_START_TIMEOUT = _env_float("DAVINCI_WORKER_START_TIMEOUT", 120)
+# Pass the BIN on DaVinci's command line when the build supports it (probed and cached by the script)
+OPEN_DIRECT = os.environ.get("DAVINCI_OPEN_DIRECT", "0").strip() == "1"
+
+
+class _AutomationWorker:
+    """Client for the persistent automation worker process.
+
+    The worker is (re)started on demand: on first use, after it died, after a
+    job overran its deadline (the process tree is killed), and every
+    WORKER_MAX_JOBS jobs to bound resource leaks in the GUI automation stack.
+    `cmd` and `cwd` default to the automation script's --worker mode in WORKDIR.
+    """
+
+    def __init__(self, cmd: list | None = None, cwd: Path | None = None):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.proc = None
+        self.jobs_done = 0
+        self.startup_seconds = 0.0
+        self.saved_seconds = 0.0
+        self._lines = None
+        self._seq = 0
+
+    def _alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def _start(self):
+        env = dict(os.environ, PYTHONUNBUFFERED="1")
+        popen_kw = {}
+        if os.name == "nt":
+            popen_kw["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            popen_kw["start_new_session"] = True
+        t0 = time.monotonic()
+        self.proc = subprocess.Popen(
+            self.cmd or [PYTHON, SCRIPT, "--worker"], cwd=str(self.cwd or WORKDIR), env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            text=True, encoding="utf-8", errors="replace", bufsize=1, **popen_kw,
+        )
+        self._lines = queue.Queue()
+        self.jobs_done = 0
+        for pipe, name in ((self.proc.stdout, "stdout"), (self.proc.stderr, "stderr")):
+            threading.Thread(target=self._pump, args=(pipe, name, self._lines), daemon=True).start()
+
+        deadline = time.monotonic() + WORKER_START_TIMEOUT
+        while True:
+            try:
+                name, line = self._lines.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                self.stop()
+                raise RuntimeError(f"automation worker did not start within {WORKER_START_TIMEOUT:.0f}s")
+            if line is None:
+                self.stop()
+                raise RuntimeError("automation worker exited during start-up")
+            if name == "stdout" and line.strip() == "WORKER_READY":
+                break
+            logging.info(f"worker start-up {name}: {line.rstrip()}")
+        self.startup_seconds = time.monotonic() - t0
+        logging.info(f"automation worker started (pid={self.proc.pid}) in {self.startup_seconds:.2f}s")
+        print(f"[AGENT] Automation worker ready in {self.startup_seconds:.2f}s", flush=True)
+
+    @staticmethod
+    def _pump(pipe, name, lines):
+        try:
+            for line in pipe:
+                lines.put((name, line))
+        except Exception:
+            pass
+        lines.put((name, None))
+
+    def stop(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+                self.proc.wait(timeout=10)
+            except Exception:
+                _kill_process_tree(self.proc)
+        self.proc = None
+
+    def run_job(self, job: dict, timeout: float = AUTOMATION_TIMEOUT) -> _SupervisedRun:
+        """Send one job and stream its output until JOB_DONE, the deadline or worker death."""
+        if self._alive() and self.jobs_done >= WORKER_MAX_JOBS:
+            logging.info(f"recycling automation worker after {self.jobs_done} jobs")
+            self.stop()
+        reused = self._alive()
+        if not reused:
+            self._start()
+
+        # Drop output that trailed the previous job
+        while True:
+            try:
+                self._lines.get_nowait()
+            except queue.Empty:
+                break
+
+        self._seq += 1
+        job = dict(job, id=self._seq)
+        result = _SupervisedRun(AUTOMATION_OUTPUT_LINES)
+        t0 = time.monotonic()
+        try:
+            self.proc.stdin.write(json.dumps(job) + "\n")
+            self.proc.stdin.flush()
+        except Exception as e:
+            logging.error(f"automation worker stdin failed: {e}")
+            self.stop()
+            result.returncode = 1
+            result.feed("stderr", f"AUTOMATION_ERROR: automation worker unavailable ({e})")
+            return result
+
+        deadline = t0 + timeout
+        eof = 0
+        while result.returncode is None:
+            try:
+                name, line = self._lines.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                result.timed_out = True
+                logging.error(f"automation job exceeded {timeout}s deadline; killing worker (pid={self.proc.pid})")
+                _kill_process_tree(self.proc)
+                self.proc = None
+                result.returncode = -9
+                break
+            if line is None:
+                eof += 1
+                if eof == 2:
+                    code = self.proc.wait()
+                    logging.error(f"automation worker exited mid-job (code={code})")
+                    self.proc = None
+                    result.returncode = code or 1
+                continue
+            if name == "stdout" and line.startswith("JOB_DONE:"):
+                try:
+                    done = json.loads(line[len("JOB_DONE:"):])
+                except ValueError:
+                    done = {"id": self._seq}
+                if done.get("id") != self._seq:
+                    # Trailing marker of an earlier job: this job is still running
+                    logging.warning(f"automation worker: ignoring JOB_DONE for job {done.get('id')} "
+                                    f"while waiting for job {self._seq}")
+                    continue
+                try:
+                    result.returncode = int(done.get("code", 1))
+                except (TypeError, ValueError):
+                    result.returncode = 1
+                continue
+            result.feed(name, line)
+
+        result.duration = time.monotonic() - t0
+        self.jobs_done += 1
+        if reused and self._alive():
+            self.saved_seconds += self.startup_seconds
+            logging.info(
+                f"automation worker reused (job {self.jobs_done}): saved ~{self.startup_seconds:.2f}s "
+                f"start-up, {self.saved_seconds:.1f}s in total"
+            )
+        return result
+
+
+WORKER = _AutomationWorker()
+
+
+def _record_stage_timings(task_id, brand: str, ecu: str, services: str, r: _SupervisedRun, ok: bool,
+                          on_dev=None, queued=None):
+    """Append one per-task timing record (all stage events of the run) to STAGE_TIMINGS_PATH."""
+    stages = [ev for ev in r.stages if ev.get("stage") != "total"]
+    record = {
+        "task_id": task_id,
+        "on_dev": on_dev,
+        "brand": brand,
+        "ecu": ecu,
+        "services": services,
+        "queued": round(queued, 3) if queued else None,
+        "finished": round(time.time(), 3),
+        "ok": ok,
+        "timed_out": r.timed_out,
+        "wall_seconds": round(r.duration, 3),
+        "stages": stages,
+    }
+    total = next((ev for ev in r.stages if ev.get("stage") == "total"), None)
+    if total:
+        record["automation_seconds"] = total.get("duration")
+        record["automation_outcome"] = total.get("outcome")
+        if total.get("failed_stage"):
+            record["failed_stage"] = total["failed_stage"]
+        if "wait_saved" in total:
+            record["wait_saved_seconds"] = total["wait_saved"]
+    try:
+        with open(STAGE_TIMINGS_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+    except Exception as e:
+        logging.error(f"could not write stage timings: {e}")
+
+    if stages:
+        slowest = sorted(stages, key=lambda ev: ev.get("duration") or 0, reverse=True)[:3]
+        summary = ", ".join(
+            f"{ev['stage']}={ev.get('duration', 0):.1f}s"
+            + (f"({ev['outcome']})" if ev.get("outcome") not in (None, "ok") else "")
+            for ev in stages
+        )
+        logging.info(f"Task {task_id} stage timings [{brand}/{ecu}]: {summary}")
+        print(
+            "[AGENT] Slowest stages: " + ", ".join(f"{ev['stage']} {ev.get('duration', 0):.1f}s" for ev in slowest),
+            flush=True,
+        )
+    if record.get("wait_saved_seconds") is not None:
+        logging.info(f"Task {task_id}: condition waits saved {record['wait_saved_seconds']:.1f}s of fixed sleeps")
+    anomalies = [f"{ev['stage']} ({ev['anomaly']}, {ev.get('duration', 0):.1f}s)" for ev in stages if ev.get("anomaly")]
+    if anomalies:
+        logging.warning(f"Task {task_id} stage anomalies [{brand}/{ecu}]: {', '.join(anomalies)}")
+        print(f"[AGENT] Stage anomalies vs. history: {', '.join(anomalies)}", flush=True)
+
+
+def _run_automation(bin_path: Path, brand: str, ecu: str, services, task_id=None, on_dev=None, queued=None):
+    """Call davinci_automation.py with the given parameters under supervision.
+
+    Returns (ok, saved_path, stdout_tail, stderr_tail, error_message).
     """
     brand_clean = (brand or "").strip()
     ecu_clean = (ecu or "").strip()
@@ -152,6 +616,8 @@ def _run_automation(bin_path: Path, brand: str, ecu: str, services):
         "--ecu", ecu_clean,
         "--services", services_norm,
     ]
+    if OPEN_DIRECT:
+        cmd.append("--open-direct")
 
     print(f"[AGENT] Running automation for {bin_path} | brand={brand_clean} ecu={ecu_clean} services={services_norm}", flush=True)
     logging.info(
@@ -159,22 +625,29 @@ def _run_automation(bin_path: Path, brand: str, ecu: str, services):
         f"brand={brand_clean} ecu={ecu_clean} services={services_norm}"
     )
 
-    r = subprocess.run(cmd, cwd=str(WORKDIR), capture_output=True, text=True)
-    ok = (r.returncode == 0)
+    if AUTOMATION_WORKER:
+        try:
+            r = WORKER.run_job(
+                {"exe": EXE, "input": str(bin_path), "brand": brand_clean,
+                 "ecu": ecu_clean, "services": services_norm, "open_direct": OPEN_DIRECT},
+                timeout=AUTOMATION_TIMEOUT,
+            )
+        except Exception as e:
+            logging.error(f"automation worker unavailable ({e}); falling back to one process per task")
+            r = _run_supervised(cmd, timeout=AUTOMATION_TIMEOUT, cwd=str(WORKDIR))
+    else:
+        r = _run_supervised(cmd, timeout=AUTOMATION_TIMEOUT, cwd=str(WORKDIR))
+    ok = (r.returncode == 0) and not r.timed_out
+
+    _record_stage_timings(task_id, brand_clean, ecu_clean, services_norm, r, ok, on_dev=on_dev, queued=queued)
 
-    out = r.stdout or ""
-    err = r.stderr or ""
+    out = r.out_text()
+    err = r.err_text()
     logging.info(f"automation stdout (tail): {out[-500:]}")
     logging.info(f"automation stderr (tail): {err[-500:]}")
-    print(f"[AGENT] automation returncode={r.returncode}", flush=True)
-
-    saved_path = None
-    for pat in (r"SAVED_PATH:(?P<p>.+)", r"SAVED:(?P<p>.+)", r"SAVING_TO:(?P<p>.+)"):
-        m = re.search(pat, out) or re.search(pat, err)
-        if m:
-            saved_path = m.group("p").strip().strip('"')
-            break
+    print(f"[AGENT] automation returncode={r.returncode} in {r.duration:.1f}s", flush=True)
 
+    saved_path = r.saved_path
     if saved_path:
         print(f"[AGENT] Detected saved_path: {saved_path}", flush=True)
     else:
@@ -186,38 +659,906 @@ def _run_automation(bin_path: Path, brand: str, ecu: str, services):
         logging.warning(f"Automation did not report saved path for {bin_path}")
 
     error_message = None
-    if (not ok) or (not saved_path):
-        error_message = _extract_automation_error(out, err)
+    if r.timed_out:
+        error_message = f"DaVinci automation timed out after {AUTOMATION_TIMEOUT:.0f}s; process was killed."
+        if r.automation_error:
+            error_message += f" Last error: {r.automation_error}"
+    elif (not ok) or (not saved_path):
+        error_message = r.automation_error or _extract_automation_error(out, err)
 
     return ok, saved_path, out, err, error_message
 
 
-def _post_save_reply(task_id, saved_path: str, on_dev):
-    """POST the modified file back to the backend as base64 for the given task_id."""
+# Result upload mode for save_reply:
+#   multipart    → streamed multipart/form-data (task_id, saved_path, file)
+#   octet-stream → raw file body, task_id/saved_path as query parameters
+#   json         → legacy whole-file base64 JSON document
+# Streaming modes fall back to json, remembered per URL, when the backend rejects
+# them with one of SAVE_REPLY_FALLBACK_STATUSES (the endpoint cannot take them).
+# A 400/422 is usually a problem with this one upload: it is retried once as json
+# without remembering anything, so later uploads still stream.
+SAVE_REPLY_MODE = os.environ.get("DAVINCI_SAVE_REPLY_MODE", "multipart").strip().lower()
+SAVE_REPLY_FALLBACK_STATUSES = {404, 405, 415}
+SAVE_REPLY_RETRY_JSON_STATUSES = {400, 422}
+UPLOAD_CHUNK_SIZE = _env_int("DAVINCI_UPLOAD_CHUNK_SIZE", 64 * 1024)
+HTTP_UPLOAD_READ_TIMEOUT = _env_float("DAVINCI_HTTP_UPLOAD_READ_TIMEOUT", 120)
+
+_JSON_ONLY_URLS = set()
+
+
+class _MultipartFileStream:
+    """Read-only file-like multipart/form-data body.
+
+    The form fields and part headers are built up front; the file itself is
+    read lazily in chunks of at most UPLOAD_CHUNK_SIZE, so the payload is never
+    held in memory. `len` lets requests send a Content-Length header instead of
+    falling back to chunked transfer encoding.
+    """
+
+    def __init__(self, fields: dict, file_field: str, path: str):
+        self.boundary = uuid.uuid4().hex
+        head = b""
+        for name, value in fields.items():
+            head += (
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f"{value}\r\n"
+            ).encode("utf-8")
+        head += (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{file_field}"; filename="{Path(path).name}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+        tail = f"\r\n--{self.boundary}--\r\n".encode("ascii")
+
+        self._file = open(path, "rb")
+        self._parts = [io.BytesIO(head), self._file, io.BytesIO(tail)]
+        self.len = len(head) + os.path.getsize(path) + len(tail)
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > UPLOAD_CHUNK_SIZE:
+            size = UPLOAD_CHUNK_SIZE
+        while self._parts:
+            chunk = self._parts[0].read(size)
+            if chunk:
+                return chunk
+            self._parts.pop(0)
+        return b""
+
+    def close(self):
+        try:
+            self._file.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _post_save_reply_json(url: str, task_id, saved_path: str, headers: dict | None = None):
+    """Legacy upload: the whole file base64-encoded inside a JSON document."""
+    with open(saved_path, "rb") as f:
+        b64 = base64.b64encode(f.read()).decode("ascii")
+
+    payload = {
+        "task_id": str(task_id),
+        "saved_path": saved_path,
+        "file_b64": b64,
+    }
+    return _session_for(url).post(url, json=payload, headers=headers, timeout=_timeout(HTTP_UPLOAD_READ_TIMEOUT))
+
+
+def _post_save_reply_streaming(url: str, task_id, saved_path: str, mode: str, headers: dict | None = None):
+    """Streamed upload: the file is read from disk in UPLOAD_CHUNK_SIZE pieces."""
+    session = _session_for(url)
+    if mode == "octet-stream":
+        with open(saved_path, "rb") as f:
+            return session.post(
+                url,
+                params={"task_id": str(task_id), "saved_path": saved_path},
+                data=f,
+                headers={**(headers or {}), "Content-Type": "application/octet-stream"},
+                timeout=_timeout(HTTP_UPLOAD_READ_TIMEOUT),
+            )
+    with _MultipartFileStream({"task_id": str(task_id), "saved_path": saved_path}, "file", saved_path) as body:
+        return session.post(
+            url,
+            data=body,
+            headers={**(headers or {}), "Content-Type": body.content_type},
+            timeout=_timeout(HTTP_UPLOAD_READ_TIMEOUT),
+        )
+
+
+def _post_save_reply(task_id, saved_path: str, on_dev, idempotency_key: str | None = None,
+                     url: str | None = None) -> bool:
+    """POST the modified file back to the backend for the given task_id.
+
+    Uses SAVE_REPLY_MODE (streamed multipart by default) and falls back to the
+    base64 JSON document for backends that have not migrated.
+    Returns True when the backend accepted the upload. `idempotency_key` is sent
+    as the Idempotency-Key header so retried uploads can be de-duplicated;
+    `url` overrides the endpoint picked from `on_dev`.
+    """
     if not (task_id and saved_path):
         logging.info("save_reply skipped (missing task_id or saved_path)")
-        return
+        return False
     try:
-        with open(saved_path, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode("ascii")
-
-        payload = {
-            "task_id": str(task_id),
-            "saved_path": saved_path,
-            "file_b64": b64,
-        }
         print(f"[AGENT] Uploading result for task_id={task_id} from {saved_path}", flush=True)
-        url = _select_save_reply_url(on_dev)
-        logging.info(f"Posting save_reply to {url} for task_id={task_id}")
-        resp = requests.post(url, json=payload, timeout=30)
+        url = url or _select_save_reply_url(on_dev)
+        mode = SAVE_REPLY_MODE if url not in _JSON_ONLY_URLS else "json"
+        logging.info(f"Posting save_reply ({mode}) to {url} for task_id={task_id}")
+        headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+        t0 = time.monotonic()
+
+        if mode in ("multipart", "octet-stream"):
+            resp = _post_save_reply_streaming(url, task_id, saved_path, mode, headers)
+            if resp.status_code in SAVE_REPLY_FALLBACK_STATUSES:
+                logging.warning(
+                    f"save_reply: {mode} upload rejected by {url} ({resp.status_code}); "
+                    f"falling back to base64 JSON for this backend"
+                )
+                _JSON_ONLY_URLS.add(url)
+                resp = _post_save_reply_json(url, task_id, saved_path, headers)
+            elif resp.status_code in SAVE_REPLY_RETRY_JSON_STATUSES:
+                logging.warning(
+                    f"save_reply: {mode} upload for task_id={task_id} rejected by {url} "
+                    f"({resp.status_code}); retrying this upload once as base64 JSON"
+                )
+                resp = _post_save_reply_json(url, task_id, saved_path, headers)
+        else:
+            resp = _post_save_reply_json(url, task_id, saved_path, headers)
+
         print(f"[AGENT] save_reply response: {resp.status_code}", flush=True)
-        logging.info(f"save_reply response: {resp.status_code} {resp.text[:500]}")
+        logging.info(
+            f"save_reply response: {resp.status_code} in {time.monotonic() - t0:.2f}s {resp.text[:500]}"
+        )
+        return resp.ok
     except Exception as e:
         logging.error(f"save_reply error for task_id={task_id}: {e}")
+        return False
+
 
+# Services the script's capability map (learned per brand/ECU from DaVinci's
+# layout) says are missing: "flag" logs them and runs the task anyway (the script
+# skips them), "reject" fails the task before its BIN is downloaded, "off" disables the check.
+UNSUPPORTED_SERVICES = os.environ.get("DAVINCI_UNSUPPORTED_SERVICES", "flag").strip().lower()
+# The map is davinci_automation.py's service_capabilities.json, read as plain JSON.
+# An entry counts only once this many walks found the same layout, and only for
+# the DaVinci version the script ran last.
+CAPABILITY_PATH = Path("C:/davinci_automation/service_capabilities.json")
+CAPABILITY_CONFIRM_WALKS = 2
+_CAPABILITIES = {"mtime": None, "data": {}}
 
-def process_task(task: dict):
-    """Process a single task from the /api/davinci/files endpoint."""
+
+def _capability_map() -> dict:
+    try:
+        mtime = CAPABILITY_PATH.stat().st_mtime
+        if mtime != _CAPABILITIES["mtime"]:
+            _CAPABILITIES["data"] = json.loads(CAPABILITY_PATH.read_text(encoding="utf-8"))
+            _CAPABILITIES["mtime"] = mtime
+    except (OSError, ValueError) as e:
+        logging.info(f"Service capability map unavailable: {e}")
+        return {}
+    return _CAPABILITIES["data"]
+
+
+def _unsupported_services(task: dict) -> list:
+    """Requested service keys the capability map marks as absent for the task's ECU."""
+    if UNSUPPORTED_SERVICES not in ("flag", "reject"):
+        return []
+    data = _capability_map()
+    brand = (task.get("brand") or "").strip()
+    brand = (data.get("brand_aliases") or {}).get(brand.lower(), brand.upper())
+    entry = (data.get("ecus") or {}).get(f"{brand}|{(task.get('ecu') or '').strip().upper()}")
+    if (not entry or entry.get("version") != data.get("version")
+            or entry.get("walks", 0) < CAPABILITY_CONFIRM_WALKS):
+        return []
+    service_keys = data.get("service_keys") or {}
+    parts = _normalize_services(task.get("services") or "").replace(";", ",").split(",")
+    requested = {service_keys.get(p.strip().lower()) for p in parts}
+    return sorted(k for k in requested if k in (entry.get("absent") or []))
+
+
+def _sha256_file(path, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Content-addressed result cache: identical input BIN + brand/ECU/services
+# → reuse the stored .mod instead of running the GUI again.
+RESULT_CACHE_DIR = WORKDIR / "result_cache"
+RESULT_CACHE_MAX_MB = _env_int("DAVINCI_RESULT_CACHE_MB", 1024)
+
+
+class _ResultCache:
+    """Size-bounded LRU cache of automation results.
+
+    Each entry is stored as <key>.mod next to an index.json holding its size,
+    SHA-256, original file name, input stem and last-use time. Entries are
+    verified against their SHA-256 on every read; a mismatch evicts them.
+    """
+
+    def __init__(self, root: Path = RESULT_CACHE_DIR, max_bytes: int = RESULT_CACHE_MAX_MB * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = None
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "corrupt": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _index_path(self) -> Path:
+        return self.root / "index.json"
+
+    def _load(self) -> dict:
+        if self._index is None:
+            try:
+                self._index = json.loads(self._index_path().read_text(encoding="utf-8"))
+            except Exception:
+                self._index = {}
+        return self._index
+
+    def _save(self):
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp = self._index_path().with_suffix(".tmp")
+            tmp.write_text(json.dumps(self._index), encoding="utf-8")
+            os.replace(tmp, self._index_path())
+        except Exception as e:
+            logging.error(f"result cache: could not write index: {e}")
+
+    def key_for(self, bin_path: Path, brand: str, ecu: str, services):
+        """SHA-256 of the input BIN plus the canonical brand/ECU/services request and the
+        DaVinci version (a DaVinci upgrade starts a fresh set of keys), or None."""
+        if not self.enabled:
+            return None
+        try:
+            canon = json.dumps({
+                "brand": effective_brand(brand),
+                "ecu": " ".join((ecu or "").split()).upper(),
+                "services": parse_services_map(_normalize_services(services)),
+                "davinci": exe_version(EXE),
+            }, sort_keys=True)
+            return hashlib.sha256(f"{_sha256_file(bin_path)}|{canon}".encode("utf-8")).hexdigest()
+        except Exception as e:
+            logging.error(f"result cache: could not compute key for {bin_path}: {e}")
+            return None
+
+    def _drop(self, key: str):
+        self._load().pop(key, None)
+        try:
+            (self.root / f"{key}.mod").unlink()
+        except OSError:
+            pass
+
+    def get(self, key: str, bin_path: Path):
+        """Return the path of a verified copy of the cached .mod (placed in OUTDIR), or None."""
+        if not key:
+            return None
+        with self._lock:
+            entry = self._load().get(key)
+            blob = self.root / f"{key}.mod"
+            if not entry or not blob.exists():
+                if entry:
+                    self._drop(key)
+                    self._save()
+                self.stats["misses"] += 1
+                return None
+            if _sha256_file(blob) != entry.get("sha256"):
+                logging.warning(f"result cache: integrity check failed for {key}, evicting")
+                self.stats["corrupt"] += 1
+                self.stats["misses"] += 1
+                self._drop(key)
+                self._save()
+                return None
+
+            # Keep DaVinci's naming: swap the cached input stem for this task's stem
+            name = entry.get("name") or f"{bin_path.stem}.mod"
+            stem = entry.get("input_stem") or ""
+            if stem and stem in name:
+                name = name.replace(stem, bin_path.stem)
+            try:
+                OUTDIR.mkdir(parents=True, exist_ok=True)
+            except Exception:
+                pass
+            out = OUTDIR / name
+            shutil.copyfile(blob, out)
+
+            entry["last_used"] = time.time()
+            self.stats["hits"] += 1
+            self._save()
+            return str(out)
+
+    def put(self, key: str, saved_path: str, bin_path: Path):
+        """Store a finished .mod under `key` and evict least-recently-used entries over budget."""
+        if not key or not saved_path:
+            return
+        with self._lock:
+            try:
+                self.root.mkdir(parents=True, exist_ok=True)
+                blob = self.root / f"{key}.mod"
+                tmp = blob.with_suffix(".tmp")
+                shutil.copyfile(saved_path, tmp)
+                os.replace(tmp, blob)
+                now = time.time()
+                self._load()[key] = {
+                    "size": blob.stat().st_size,
+                    "sha256": _sha256_file(blob),
+                    "name": Path(saved_path).name,
+                    "input_stem": bin_path.stem,
+                    "created": now,
+                    "last_used": now,
+                }
+                self.stats["stores"] += 1
+                self._evict()
+                self._save()
+            except Exception as e:
+                logging.error(f"result cache: could not store {saved_path}: {e}")
+
+    def _evict(self):
+        index = self._load()
+        total = sum(e.get("size", 0) for e in index.values())
+        for key in sorted(index, key=lambda k: index[k].get("last_used", 0)):
+            if total <= self.max_bytes:
+                break
+            total -= index[key].get("size", 0)
+            self._drop(key)
+            self.stats["evictions"] += 1
+
+    def log_stats(self):
+        if not self.enabled:
+            return
+        st = self.stats
+        lookups = st["hits"] + st["misses"]
+        rate = (100.0 * st["hits"] / lookups) if lookups else 0.0
+        logging.info(
+            f"result cache: hits={st['hits']} misses={st['misses']} ({rate:.0f}% hit rate) "
+            f"stores={st['stores']} evictions={st['evictions']} corrupt={st['corrupt']}"
+        )
+
+
+RESULT_CACHE = _ResultCache()
+
+
+# Download pipeline: while DaVinci works on the current task, the BINs of the
+# next PREFETCH_DEPTH queued tasks are downloaded in the background into
+# PREFETCH_DIR and moved into INDIR right before their automation starts.
+PREFETCH_DEPTH = _env_int("DAVINCI_PREFETCH_DEPTH", 2)
+PREFETCH_DISK_BUDGET_MB = _env_int("DAVINCI_PREFETCH_DISK_BUDGET_MB", 512)
+PREFETCH_DIR = INDIR / ".prefetch"
+
+
+class _Prefetcher:
+    """Bounded background download pool for the queued tasks of one poll batch.
+
+    At most `depth` tasks are downloaded ahead (in flight or finished but not
+    yet consumed). Every prefetch reserves its Content-Length (and any bytes
+    beyond it) before writing, so finished plus in-flight downloads never hold
+    more than `budget_bytes`; one that does not fit is abandoned and its task is
+    downloaded inline by take(). take() hands a task's BIN over to the caller and
+    reports how much of the download time was hidden behind the previous task.
+    """
+
+    def __init__(self, depth: int = PREFETCH_DEPTH, budget_bytes: int = PREFETCH_DISK_BUDGET_MB * 1024 * 1024):
+        self.depth = max(0, depth)
+        self.budget_bytes = budget_bytes
+        self._pool = ThreadPoolExecutor(max_workers=max(1, self.depth), thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._pending = []
+        self._jobs = {}
+        self._bytes_on_disk = 0
+        self._seq = 0
+        self.stats = {"prefetched": 0, "inline": 0, "hidden_seconds": 0.0, "waited_seconds": 0.0}
+
+    def queue(self, tasks):
+        """Register the tasks of a batch (in processing order) and start prefetching.
+
+        Tasks the journal has already downloaded (or finished) are skipped.
+        """
+        tasks = [t for t in tasks if _input_needed(t)]
+        with self._lock:
+            for task in tasks:
+                if task.get("file") and str(task.get("brand") or "").strip() and str(task.get("ecu") or "").strip():
+                    self._pending.append(task)
+        self._fill()
+
+    def _fill(self):
+        with self._lock:
+            while (self.depth > 0 and self._pending and len(self._jobs) < self.depth
+                   and self._bytes_on_disk < self.budget_bytes):
+                task = self._pending.pop(0)
+                self._seq += 1
+                dest = PREFETCH_DIR / str(self._seq) / Path(task.get("file_name") or "input.bin").name
+                self._jobs[id(task)] = self._pool.submit(self._fetch, task.get("file"), dest)
+
+    def _reserve(self, held: list, nbytes: int) -> bool:
+        with self._lock:
+            if self._bytes_on_disk + nbytes > self.budget_bytes:
+                return False
+            self._bytes_on_disk += nbytes
+            held[0] += nbytes
+            return True
+
+    def _fetch(self, url: str, dest: Path):
+        t0 = time.monotonic()
+        try:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+        except Exception:
+            pass
+        held = [0]
+        ok = _download_file(url, dest, reserve=lambda n: self._reserve(held, n))
+        try:
+            size = dest.stat().st_size if ok else 0
+        except OSError:
+            size = 0
+        if not ok:
+            try:
+                dest.unlink()
+            except OSError:
+                pass
+        with self._lock:
+            # Settle the reservation on the bytes actually kept on disk
+            self._bytes_on_disk = max(0, self._bytes_on_disk - held[0] + size)
+        return ok, dest, time.monotonic() - t0
+
+    def _release(self, dest: Path):
+        try:
+            size = dest.stat().st_size
+        except OSError:
+            size = 0
+        with self._lock:
+            self._bytes_on_disk = max(0, self._bytes_on_disk - size)
+
+    def take(self, task: dict, bin_path: Path) -> bool:
+        """Place the task's BIN at `bin_path`, using the prefetched copy when there is one."""
+        task_id = task.get("task_id")
+        with self._lock:
+            fut = self._jobs.pop(id(task), None)
+            if fut is None:
+                self._pending = [t for t in self._pending if t is not task]
+
+        if fut is None:
+            self.stats["inline"] += 1
+            ok = _download_file(task.get("file"), bin_path)
+            self._fill()
+            return ok
+
+        t0 = time.monotonic()
+        ok, dest, download_seconds = fut.result()
+        waited = time.monotonic() - t0
+        if ok:
+            self._release(dest)
+            try:
+                os.replace(dest, bin_path)
+            except OSError as e:
+                logging.error(f"Task {task_id}: could not move prefetched file {dest} -> {bin_path}: {e}")
+                ok = False
+        _remove_empty_dir(dest.parent)
+        self._fill()
+
+        if not ok:
+            # One inline retry so a transient prefetch failure does not lose the task
+            logging.info(f"Task {task_id}: prefetch failed, downloading inline")
+            self.stats["inline"] += 1
+            return _download_file(task.get("file"), bin_path)
+
+        hidden = max(0.0, download_seconds - waited)
+        self.stats["prefetched"] += 1
+        self.stats["hidden_seconds"] += hidden
+        self.stats["waited_seconds"] += waited
+        logging.info(
+            f"Task {task_id}: prefetched input (download={download_seconds:.2f}s, "
+            f"waited={waited:.2f}s, hidden={hidden:.2f}s)"
+        )
+        print(f"[AGENT] Prefetch hid {hidden:.2f}s of download time for task_id={task_id}", flush=True)
+        return True
+
+    def reset(self):
+        """Drop anything still queued or prefetched at the end of a batch."""
+        with self._lock:
+            self._pending.clear()
+            jobs = list(self._jobs.values())
+            self._jobs.clear()
+        for fut in jobs:
+            if fut.cancel():
+                continue
+            try:
+                ok, dest, _ = fut.result()
+                if ok:
+                    self._release(dest)
+                    dest.unlink()
+                _remove_empty_dir(dest.parent)
+            except Exception:
+                pass
+
+    def log_summary(self):
+        n = self.stats["prefetched"]
+        per_task = (self.stats["hidden_seconds"] / n) if n else 0.0
+        logging.info(
+            f"prefetch summary: prefetched={n} inline={self.stats['inline']} "
+            f"hidden={self.stats['hidden_seconds']:.2f}s ({per_task:.2f}s/task) "
+            f"waited={self.stats['waited_seconds']:.2f}s"
+        )
+
+
+def _remove_empty_dir(path: Path):
+    try:
+        path.rmdir()
+    except OSError:
+        pass
+
+
+# Durable task journal (SQLite, WAL mode). Every task's stage transitions are
+# recorded so a restart resumes from the last completed stage:
+#   fetched → downloaded → automated → uploaded
+#   failed  (terminal once the failure reply has been accepted)
+JOURNAL_PATH = WORKDIR / "agent_journal.db"
+JOURNAL_RETENTION_DAYS = 30
+
+
+class _TaskJournal:
+    """Crash-safe record of task progress, keyed by (on_dev, task_id)."""
+
+    DONE_STAGES = ("uploaded",)
+
+    def __init__(self, path: Path = JOURNAL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS tasks (
+                    key         TEXT PRIMARY KEY,
+                    task_id     TEXT NOT NULL,
+                    on_dev      TEXT NOT NULL,
+                    stage       TEXT NOT NULL,
+                    task_json   TEXT NOT NULL,
+                    bin_path    TEXT,
+                    saved_path  TEXT,
+                    error       TEXT,
+                    reply_sent  INTEGER NOT NULL DEFAULT 0,
+                    created_at  REAL NOT NULL,
+                    updated_at  REAL NOT NULL
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS transitions (
+                    key    TEXT NOT NULL,
+                    stage  TEXT NOT NULL,
+                    at     REAL NOT NULL,
+                    detail TEXT
+                )"""
+            )
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def key(task_id, on_dev) -> str:
+        return f"{on_dev}:{task_id}"
+
+    def get(self, task_id, on_dev):
+        try:
+            with self._lock:
+                row = self._db().execute(
+                    "SELECT * FROM tasks WHERE key = ?", (self.key(task_id, on_dev),)
+                ).fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            logging.error(f"journal read failed for task_id={task_id}: {e}")
+            return None
+
+    def record(self, task: dict, stage: str, **fields):
+        """Record a stage transition (upsert) plus its history row."""
+        task_id = task.get("task_id")
+        on_dev = "1" if str(task.get("on_dev") or "").strip() == "1" else "0"
+        key = self.key(task_id, on_dev)
+        now = time.time()
+        cols = {k: v for k, v in fields.items() if k in ("bin_path", "saved_path", "error", "reply_sent")}
+        try:
+            with self._lock:
+                db = self._db()
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    db.execute(
+                        """INSERT INTO tasks (key, task_id, on_dev, stage, task_json, created_at, updated_at)
+                           VALUES (?, ?, ?, ?, ?, ?, ?)
+                           ON CONFLICT(key) DO UPDATE SET stage = excluded.stage,
+                               task_json = excluded.task_json, updated_at = excluded.updated_at""",
+                        (key, str(task_id), on_dev, stage, json.dumps(task), now, now),
+                    )
+                    for col, val in cols.items():
+                        db.execute(f"UPDATE tasks SET {col} = ? WHERE key = ?", (val, key))
+                    db.execute(
+                        "INSERT INTO transitions (key, stage, at, detail) VALUES (?, ?, ?, ?)",
+                        (key, stage, now, json.dumps(cols) if cols else None),
+                    )
+                    db.execute("COMMIT")
+                except Exception:
+                    db.execute("ROLLBACK")
+                    raise
+        except Exception as e:
+            logging.error(f"journal write failed for task_id={task_id} stage={stage}: {e}")
+
+    def failures(self, task_id, on_dev, stage: str) -> int:
+        """Number of failed attempts journaled at `stage` (transitions carrying an error)."""
+        try:
+            with self._lock:
+                row = self._db().execute(
+                    """SELECT COUNT(*) FROM transitions WHERE key = ? AND stage = ?
+                       AND detail LIKE '%"error"%'""",
+                    (self.key(task_id, on_dev), stage),
+                ).fetchone()
+            return int(row[0])
+        except Exception as e:
+            logging.error(f"journal read failed for task_id={task_id}: {e}")
+            return 0
+
+    def is_done(self, row) -> bool:
+        return bool(row) and (row["stage"] in self.DONE_STAGES or (row["stage"] == "failed" and row["reply_sent"]))
+
+    def unfinished(self) -> list:
+        """Tasks that still need work, oldest first."""
+        try:
+            with self._lock:
+                rows = self._db().execute(
+                    """SELECT * FROM tasks
+                       WHERE stage NOT IN ('uploaded') AND NOT (stage = 'failed' AND reply_sent = 1)
+                       ORDER BY created_at"""
+                ).fetchall()
+            return [dict(r) for r in rows]
+        except Exception as e:
+            logging.error(f"journal scan failed: {e}")
+            return []
+
+    def prune(self, days: int = JOURNAL_RETENTION_DAYS):
+        """Forget finished tasks older than `days`."""
+        cutoff = time.time() - days * 86400
+        try:
+            with self._lock:
+                db = self._db()
+                db.execute(
+                    """DELETE FROM transitions WHERE key IN (SELECT key FROM tasks WHERE updated_at < ?
+                       AND (stage = 'uploaded' OR (stage = 'failed' AND reply_sent = 1)))""",
+                    (cutoff,),
+                )
+                db.execute(
+                    """DELETE FROM tasks WHERE updated_at < ?
+                       AND (stage = 'uploaded' OR (stage = 'failed' AND reply_sent = 1))""",
+                    (cutoff,),
+                )
+        except Exception as e:
+            logging.error(f"journal prune failed: {e}")
+
+
+JOURNAL = _TaskJournal()
+
+
+# Upload outbox: finished results and failure reasons are queued in the journal
+# database and delivered by a background sender with exponential backoff and
+# jitter, so a slow or failing backend never blocks the next GUI job.
+OUTBOX_BASE_DELAY = _env_float("DAVINCI_OUTBOX_BASE_DELAY", 5)
+OUTBOX_MAX_DELAY = _env_float("DAVINCI_OUTBOX_MAX_DELAY", 600)
+OUTBOX_MAX_ATTEMPTS = _env_int("DAVINCI_OUTBOX_MAX_ATTEMPTS", 30)
+
+
+class _Outbox:
+    """Durable reply queue drained by a background sender thread.
+
+    One row per (kind, on_dev, task_id); that triple is also the Idempotency-Key
+    sent to the backend. Rows that exhaust `max_attempts` are parked and
+    revived on the next start. `urls` maps (kind, on_dev) to an endpoint that
+    replaces the one picked from on_dev.
+    """
+
+    def __init__(self, journal: _TaskJournal, base_delay: float = OUTBOX_BASE_DELAY,
+                 max_delay: float = OUTBOX_MAX_DELAY, max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 urls: dict | None = None):
+        self.journal = journal
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.urls = urls or {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._ready = False
+
+    def _db(self) -> sqlite3.Connection:
+        db = self.journal._db()
+        if not self._ready:
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS outbox (
+                    idem_key     TEXT PRIMARY KEY,
+                    kind         TEXT NOT NULL,
+                    task_json    TEXT NOT NULL,
+                    saved_path   TEXT,
+                    message      TEXT,
+                    attempts     INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    parked       INTEGER NOT NULL DEFAULT 0,
+                    created_at   REAL NOT NULL
+                )"""
+            )
+            self._ready = True
+        return db
+
+    @staticmethod
+    def idempotency_key(kind: str, task: dict) -> str:
+        on_dev = "1" if str(task.get("on_dev") or "").strip() == "1" else "0"
+        return f"{kind}:{on_dev}:{task.get('task_id')}"
+
+    def enqueue(self, task: dict, kind: str, saved_path: str | None = None, message: str | None = None):
+        """Queue a save_reply or failure for delivery (no-op if it is already queued)."""
+        key = self.idempotency_key(kind, task)
+        now = time.time()
+        try:
+            with self.journal._lock:
+                self._db().execute(
+                    """INSERT OR IGNORE INTO outbox
+                       (idem_key, kind, task_json, saved_path, message, next_attempt, created_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    (key, kind, json.dumps(task), saved_path, message, now, now),
+                )
+            logging.info(f"outbox: queued {key}")
+        except Exception as e:
+            logging.error(f"outbox: could not queue {key}: {e}")
+        self._wake.set()
+
+    def pending(self) -> int:
+        try:
+            with self.journal._lock:
+                return self._db().execute("SELECT COUNT(*) FROM outbox WHERE parked = 0").fetchone()[0]
+        except Exception:
+            return 0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        try:
+            with self.journal._lock:
+                revived = self._db().execute("UPDATE outbox SET parked = 0, attempts = 0 WHERE parked = 1").rowcount
+            if revived:
+                logging.info(f"outbox: revived {revived} parked item(s)")
+        except Exception as e:
+            logging.error(f"outbox: could not revive parked items: {e}")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _next_due(self):
+        with self.journal._lock:
+            row = self._db().execute(
+                "SELECT * FROM outbox WHERE parked = 0 ORDER BY next_attempt LIMIT 1"
+            ).fetchone()
+        return dict(row) if row else None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                item = self._next_due()
+            except Exception as e:
+                logging.error(f"outbox: read failed: {e}")
+                item = None
+            if item is None:
+                self._wake.wait(60)
+                self._wake.clear()
+                continue
+            delay = item["next_attempt"] - time.time()
+            if delay > 0:
+                self._wake.wait(delay)
+                self._wake.clear()
+                continue
+            self._deliver(item)
+
+    def _deliver(self, item: dict):
+        key = item["idem_key"]
+        task = json.loads(item["task_json"])
+        task_id = task.get("task_id")
+        on_dev = "1" if str(task.get("on_dev") or "").strip() == "1" else "0"
+
+        if item["kind"] == "save_reply":
+            if not Path(item["saved_path"] or "").exists():
+                logging.error(f"outbox: {key} result file {item['saved_path']} is gone; dropping")
+                sent = None
+            else:
+                sent = _post_save_reply(task_id, item["saved_path"], on_dev, idempotency_key=key,
+                                        url=self.urls.get((item["kind"], on_dev)))
+        else:
+            sent = _post_failure(task_id, item["message"], on_dev, idempotency_key=key,
+                                 url=self.urls.get((item["kind"], on_dev)))
+
+        if sent or sent is None:
+            with self.journal._lock:
+                self._db().execute("DELETE FROM outbox WHERE idem_key = ?", (key,))
+            if sent:
+                if item["kind"] == "save_reply":
+                    self.journal.record(task, "uploaded")
+                    print(f"[AGENT] Delivered result for task_id={task_id}", flush=True)
+                else:
+                    self.journal.record(task, "failed", reply_sent=1)
+                logging.info(f"outbox: delivered {key} after {item['attempts'] + 1} attempt(s)")
+            return
+
+        attempts = item["attempts"] + 1
+        backoff = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        backoff *= random.uniform(0.5, 1.5)
+        parked = int(attempts >= self.max_attempts)
+        with self.journal._lock:
+            self._db().execute(
+                "UPDATE outbox SET attempts = ?, next_attempt = ?, parked = ? WHERE idem_key = ?",
+                (attempts, time.time() + backoff, parked, key),
+            )
+        if parked:
+            logging.error(f"outbox: giving up on {key} after {attempts} attempts (parked until restart)")
+        else:
+            logging.warning(f"outbox: {key} attempt {attempts} failed; retrying in {backoff:.1f}s")
+
+
+OUTBOX = _Outbox(JOURNAL)
+
+# A task whose input cannot be fetched (no URL, download error) is retried on
+# later polls/restarts, then answered with a failure reply after this many attempts.
+DOWNLOAD_MAX_ATTEMPTS = _env_int("DAVINCI_DOWNLOAD_MAX_ATTEMPTS", 5)
+
+
+def _report_failure(task: dict, message: str):
+    """Journal a failure and queue its reply (terminal once the outbox delivered it)."""
+    JOURNAL.record(task, "failed", error=message, reply_sent=0)
+    OUTBOX.enqueue(task, "failure", message=message)
+
+
+def _report_input_failure(task: dict, message: str):
+    """Journal a failed fetch of the input; give up with a failure reply after DOWNLOAD_MAX_ATTEMPTS."""
+    on_dev = "1" if str(task.get("on_dev") or "").strip() == "1" else "0"
+    JOURNAL.record(task, "fetched", error=message)
+    attempts = JOURNAL.failures(task.get("task_id"), on_dev, "fetched")
+    if attempts >= DOWNLOAD_MAX_ATTEMPTS:
+        msg = f"{message} (gave up after {attempts} attempts)"
+        logging.error(f"Task {task.get('task_id')}: {msg}")
+        print(f"[AGENT] Abandoning task_id={task.get('task_id')}: {msg}", flush=True)
+        _report_failure(task, msg)
+    else:
+        logging.warning(f"Task {task.get('task_id')}: input attempt {attempts}/{DOWNLOAD_MAX_ATTEMPTS} failed")
+
+
+def _report_result(task: dict, saved_path: str):
+    """Journal a finished result and queue its upload."""
+    JOURNAL.record(task, "automated", saved_path=saved_path)
+    OUTBOX.enqueue(task, "save_reply", saved_path=saved_path)
+
+
+def process_task(task: dict, prefetcher: _Prefetcher | None = None, queued: float | None = None):
+    """Process a single task from the /api/davinci/files endpoint.
+
+    Progress is journaled; a task seen before resumes from its last completed
+    stage (e.g. a crash after a successful automation only costs a re-upload).
+    `queued` (epoch seconds of the first poll that returned the task) is kept
+    in the stage timing record for the scheduler simulation.
+    """
     try:
         task_id = task.get("task_id")
         file_url = task.get("file")
@@ -229,12 +1570,29 @@ def process_task(task: dict):
 
         on_dev = "1" if str(on_dev).strip() == "1" else "0"
 
+        row = JOURNAL.get(task_id, on_dev)
+        if JOURNAL.is_done(row):
+            logging.info(f"Task {task_id}: already {row['stage']} according to journal, skipping")
+            print(f"[AGENT] Skipping task_id={task_id} (already {row['stage']})", flush=True)
+            return
+        stage = row["stage"] if row else None
+        if stage:
+            logging.info(f"Task {task_id}: resuming from journal stage '{stage}'")
+            print(f"[AGENT] Resuming task_id={task_id} from stage '{stage}'", flush=True)
+        else:
+            JOURNAL.record(task, "fetched")
+
+        if stage == "failed":
+            # Automation already failed; only the failure reply is outstanding
+            OUTBOX.enqueue(task, "failure", message=row.get("error") or "DaVinci automation failed.")
+            return
+
         # Early validation for missing brand/ECU
         if not brand.strip() or not ecu.strip():
             msg = f"Missing brand or ECU for task {task_id} (brand='{brand}', ecu='{ecu}')"
             logging.error(msg)
             print(f"[AGENT] {msg}", flush=True)
-            _post_failure(task_id, msg, on_dev)
+            _report_failure(task, msg)
             return
 
         print(f"[AGENT] Processing task_id={task_id} | file_name={file_name} | brand={brand} | ecu={ecu}", flush=True)
@@ -242,113 +1600,599 @@ def process_task(task: dict):
             f"Processing task_id={task_id}, file={file_url}, file_name={file_name}"
         )
 
-        if not file_url:
-            logging.error(f"Task {task_id}: missing file URL, skipping")
+        # Resume after automation: only the upload is missing (queued again if needed)
+        if stage == "automated" and row.get("saved_path") and Path(row["saved_path"]).exists():
+            OUTBOX.enqueue(task, "save_reply", saved_path=row["saved_path"])
             return
 
+        unsupported = _unsupported_services(task)
+        if unsupported:
+            msg = f"Services not available for {brand} / {ecu}: {', '.join(unsupported)}"
+            if UNSUPPORTED_SERVICES == "reject":
+                logging.error(f"Task {task_id}: {msg}")
+                print(f"[AGENT] Rejecting task_id={task_id}: {msg}", flush=True)
+                _report_failure(task, msg)
+                return
+            logging.warning(f"Task {task_id}: {msg} (they will be skipped)")
+            print(f"[AGENT] Task {task_id}: {msg}; flagged, continuing", flush=True)
+
         bin_path = INDIR / Path(file_name).name
-        if not _download_file(file_url, bin_path):
-            logging.error(f"Task {task_id}: download failed, skipping automation")
+        if stage in ("downloaded", "automated") and row.get("bin_path") and Path(row["bin_path"]).exists():
+            bin_path = Path(row["bin_path"])
+            logging.info(f"Task {task_id}: reusing downloaded input {bin_path}")
+        else:
+            if not file_url:
+                logging.error(f"Task {task_id}: missing file URL, skipping")
+                _report_input_failure(task, "Task has no file URL.")
+                return
+
+            downloaded = prefetcher.take(task, bin_path) if prefetcher else _download_file(file_url, bin_path)
+            if not downloaded:
+                logging.error(f"Task {task_id}: download failed, skipping automation")
+                _report_input_failure(task, "Downloading the input file failed.")
+                return
+            JOURNAL.record(task, "downloaded", bin_path=str(bin_path))
+            print(f"[AGENT] Downloaded file to {bin_path}", flush=True)
+
+        cache_key = RESULT_CACHE.key_for(bin_path, brand, ecu, services)
+        cached_path = RESULT_CACHE.get(cache_key, bin_path)
+        if cached_path:
+            print(f"[AGENT] Result cache hit for task_id={task_id}; skipping DaVinci", flush=True)
+            logging.info(f"Task {task_id}: result cache hit ({cache_key[:12]}) -> {cached_path}")
+            _report_result(task, cached_path)
+            RESULT_CACHE.log_stats()
             return
-        print(f"[AGENT] Downloaded file to {bin_path}", flush=True)
 
-        ok, saved_path, out, err, error_message = _run_automation(bin_path, brand, ecu, services)
+        ok, saved_path, out, err, error_message = _run_automation(
+            bin_path, brand, ecu, services, task_id=task_id, on_dev=on_dev, queued=queued)
         print(f"[AGENT] Automation finished for task_id={task_id} | ok={ok} | saved_path={saved_path}", flush=True)
 
         if ok and saved_path:
-            _post_save_reply(task_id, saved_path, on_dev)
-            print(f"[AGENT] Completed task_id={task_id}", flush=True)
+            _report_result(task, saved_path)
+            RESULT_CACHE.put(cache_key, saved_path, bin_path)
+            RESULT_CACHE.log_stats()
+            print(f"[AGENT] Completed task_id={task_id}; result queued for upload", flush=True)
         else:
             logging.error(f"Task {task_id}: automation failed or no saved_path")
             print(f"[AGENT] Task {task_id} FAILED (ok={ok}, saved_path={saved_path})", flush=True)
 
             failure_reason = error_message or f"DaVinci automation failed or did not produce a saved file (ok={ok}, saved_path={saved_path})."
-            _post_failure(task_id, failure_reason, on_dev)
+            _report_failure(task, failure_reason)
             
     except Exception as e:
         logging.error(f"Unhandled error while processing task {task}: {e}")
 
 
-def _fetch_all_tasks():
+def _input_needed(task: dict) -> bool:
+    """False when the journal already has the task's input (or is past it), or it will be rejected."""
+    on_dev = "1" if str(task.get("on_dev") or "").strip() == "1" else "0"
+    row = JOURNAL.get(task.get("task_id"), on_dev)
+    if row and row["stage"] in ("automated", "uploaded", "failed"):
+        return False
+    if row and row["stage"] == "downloaded" and row.get("bin_path") and Path(row["bin_path"]).exists():
+        return False
+    return not (UNSUPPORTED_SERVICES == "reject" and _unsupported_services(task))
+
+
+def _resume_unfinished_tasks():
+    """On startup, continue every journaled task that did not reach a terminal stage."""
+    JOURNAL.prune()
+    rows = JOURNAL.unfinished()
+    if not rows:
+        return
+    logging.info(f"Journal: resuming {len(rows)} unfinished task(s)")
+    print(f"[AGENT] Resuming {len(rows)} unfinished task(s) from journal", flush=True)
+    for row in rows:
+        try:
+            task = json.loads(row["task_json"])
+        except Exception as e:
+            logging.error(f"Journal: bad task record {row['key']}: {e}")
+            continue
+        process_task(task)
+
+
+# Order of the tasks within one poll batch:
+#   fifo → as returned by the backends
+#   env  → production before staging, FIFO within each
+#   sjf  → shortest expected automation time first (median wall time of earlier
+#          runs of the same brand/ECU/services in STAGE_TIMINGS_PATH, then of the
+#          brand/ECU, then of all runs). Aging: every second a task has waited
+#          since its first poll takes SCHEDULER_AGING s off its expected time, so
+#          a long job that keeps being returned overtakes newer short ones.
+SCHEDULER_POLICY = os.environ.get("DAVINCI_SCHEDULER", "sjf").strip().lower()
+SCHEDULER_AGING = _env_float("DAVINCI_SCHEDULER_AGING", 0.5)
+SCHEDULER_DEFAULT_SECONDS = 120.0  # expected time of a task with no history at all
+SCHEDULER_HISTORY_RECORDS = 5000   # newest timing records used for the estimates
+SCHEDULER_POLICIES = ("fifo", "env", "sjf")
+
+
+def _history_keys(brand, ecu, services):
+    b, e = (brand or "").strip().upper(), (ecu or "").strip().upper()
+    return (b, e, _normalize_services(services).upper()), (b, e)
+
+
+class _DurationHistory:
+    """Median automation wall time per brand/ECU/services, from stage timing records."""
+
+    def __init__(self):
+        self._samples = collections.defaultdict(list)
+        self._mtime = None
+
+    def add(self, brand, ecu, services, seconds: float):
+        for key in _history_keys(brand, ecu, services) + ("*",):
+            self._samples[key].append(seconds)
+
+    def load(self, path: Path = STAGE_TIMINGS_PATH):
+        """(Re)read the newest records of `path` when it changed since the last load."""
+        try:
+            mtime = path.stat().st_mtime
+        except OSError:
+            return self
+        if mtime == self._mtime:
+            return self
+        self._samples.clear()
+        for rec in _read_timing_records(path)[-SCHEDULER_HISTORY_RECORDS:]:
+            if rec.get("ok") and rec.get("wall_seconds"):
+                self.add(rec.get("brand"), rec.get("ecu"), rec.get("services"), rec["wall_seconds"])
+        self._mtime = mtime
+        return self
+
+    def expected(self, task: dict) -> float:
+        for key in _history_keys(task.get("brand"), task.get("ecu"), task.get("services")) + ("*",):
+            samples = self._samples.get(key)
+            if samples:
+                return statistics.median(samples)
+        return SCHEDULER_DEFAULT_SECONDS
+
+
+def _read_timing_records(path: Path) -> list:
+    records = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return records
+
+
+class _Scheduler:
+    """Orders a batch of tasks by policy; see SCHEDULER_POLICY."""
+
+    def __init__(self, policy: str = SCHEDULER_POLICY, history: _DurationHistory | None = None,
+                 aging: float = SCHEDULER_AGING):
+        if policy not in SCHEDULER_POLICIES:
+            logging.warning(f"Unknown scheduler policy '{policy}', using fifo")
+            policy = "fifo"
+        self.policy = policy
+        self.history = history or _DurationHistory()
+        self.aging = aging
+
+    def order(self, tasks, now: float = 0.0, first_seen: dict | None = None) -> list:
+        """The batch in processing order.
+
+        `first_seen` maps id(task) to the time it was first polled (default: now);
+        under sjf a task's priority is its expected time minus SCHEDULER_AGING
+        times its own wait, so older tasks move ahead of newer ones.
+        """
+        if self.policy == "fifo":
+            return list(tasks)
+        if self.policy == "env":
+            return sorted(tasks, key=lambda t: str(t.get("on_dev") or "").strip() == "1")
+        seen = first_seen or {}
+        keyed = [(self.history.expected(t) - self.aging * (now - seen.get(id(t), now)), i, t)
+                 for i, t in enumerate(tasks)]
+        return [t for _, _, t in sorted(keyed, key=lambda k: k[:2])]
+
+
+def _task_key(task: dict):
+    return task.get("task_id"), "1" if str(task.get("on_dev") or "").strip() == "1" else "0"
+
+
+def simulate_scheduler(path: Path = STAGE_TIMINGS_PATH, batch_gap: float = 30.0, aging: float = SCHEDULER_AGING):
+    """Replay recorded task mixes under every policy; returns {policy: (mean, p95)} turnaround.
+
+    A task arrives at its recorded `queued` time. Older records without one
+    arrive with their batch: runs recorded less than `batch_gap` seconds apart
+    count as one poll batch that arrived when its first run started. Like
+    poll_forever, each poll takes every task that has arrived and not run yet,
+    orders it with the policy (history recorded so far, arrival times as
+    first_seen) and works it off with the recorded wall times; tasks arriving
+    meanwhile wait for the next poll. Turnaround is completion minus arrival.
+    """
+    records = sorted((r for r in _read_timing_records(path) if r.get("wall_seconds") and r.get("finished")),
+                     key=lambda r: r["finished"])
+    if not records:
+        print(f"No timing records in {path}")
+        return {}
+    arrivals, batches, batch_start, last_end = [], 0, None, None
+    for rec in records:
+        start = rec["finished"] - rec["wall_seconds"]
+        if last_end is None or start - last_end > batch_gap:
+            batches, batch_start = batches + 1, start
+        arrivals.append((rec.get("queued") or batch_start, rec))
+        last_end = rec["finished"]
+    arrivals.sort(key=lambda a: a[0])
+    results = {}
+    for policy in SCHEDULER_POLICIES:
+        history = _DurationHistory()
+        sched = _Scheduler(policy, history, aging)
+        turnaround, nxt, clock = [], 0, arrivals[0][0]
+        while nxt < len(arrivals):
+            clock = max(clock, arrivals[nxt][0])
+            batch, first_seen = [], {}
+            while nxt < len(arrivals) and arrivals[nxt][0] <= clock:
+                batch.append(arrivals[nxt][1])
+                first_seen[id(arrivals[nxt][1])] = arrivals[nxt][0]
+                nxt += 1
+            for rec in sched.order(batch, clock, first_seen):
+                clock += rec["wall_seconds"]
+                turnaround.append(clock - first_seen[id(rec)])
+                if rec.get("ok"):
+                    history.add(rec.get("brand"), rec.get("ecu"), rec.get("services"), rec["wall_seconds"])
+        turnaround.sort()
+        p95 = turnaround[min(len(turnaround) - 1, int(len(turnaround) * 0.95))]
+        results[policy] = (statistics.mean(turnaround), p95)
+    print(f"{len(records)} recorded runs, {sum(1 for r in records if r.get('queued'))} with arrival times, "
+          f"{batches} recorded batches (gap > {batch_gap:.0f}s starts a new batch)")
+    for policy, (mean, p95) in results.items():
+        print(f"  {policy:5s} turnaround: mean {mean:8.1f}s   p95 {p95:8.1f}s")
+    return results
+
+
+# Per-source polling budgets (seconds). Each source is polled on its own thread,
+# so a slow staging backend can no longer hold back production work.
+POLL_SOURCES = [
+    # (label, url, default_on_dev, latency budget)
+    ("staging", API_STAGING_FILES_URL, "1", 10),
+    ("production", API_PRODUCTION_FILES_URL, "0", 30),
+]
+
+# Circuit breaker: after this many consecutive failures (errors, or answers
+# slower than the source's budget) a source is skipped and only probed in the
+# background every BREAKER_COOLDOWN seconds, independently of the poll cycle.
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_COOLDOWN = 300
+
+_POLL_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="poll")
+# Tasks of a poll that finished after its budget, per source; used by the next
+# cycle if that source misses its budget again (a newer answer replaces them).
+_LATE_RESULTS = {}
+_ANSWERED_AT = {}  # per source: start of the newest poll whose answer was used
+_LATE_RESULTS_LOCK = threading.Lock()
+_POLL_WAKE = threading.Event()  # set by a successful probe to start the next poll cycle early
+
+
+class _CircuitBreaker:
+    """Per-source circuit breaker with background probing.
+
+    closed    → source is polled every cycle
+    open      → source is skipped; a timer runs `probe` once the cooldown
+                has elapsed, whether or not a poll cycle is running
+    half-open → a probe is running; its outcome closes or re-opens the breaker
     """
-    Poll both staging and production /api/davinci/files endpoints.
-    Returns a single flat list of task dicts.
+
+    def __init__(self, label: str, threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 cooldown: float = BREAKER_COOLDOWN, probe=None):
+        self.label = label
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe = probe
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            return self.state == "closed"
+
+    def _open(self):
+        # caller holds self._lock
+        self.state = "open"
+        self.opened_at = time.time()
+        if self.probe is not None:
+            self._timer = threading.Timer(self.cooldown, self._run_probe)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _run_probe(self):
+        with self._lock:
+            if self.state != "open":
+                return
+            self.state = "half-open"
+        self.probe()
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logging.info(f"{self.label}: circuit breaker closed")
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= self.threshold:
+                if self.state != "open":
+                    logging.warning(
+                        f"{self.label}: circuit breaker open after {self.failures} failure(s); "
+                        f"probing every {self.cooldown}s"
+                    )
+                    self._open()
+
+
+_BREAKERS = {
+    label: _CircuitBreaker(label, probe=lambda src=(label, url, on_dev, budget): _probe_source(*src))
+    for label, url, on_dev, budget in POLL_SOURCES
+}
+
+# Per-source counters, see get_poll_stats()
+_POLL_STATS = {
+    label: {"polls": 0, "errors": 0, "timeouts": 0, "skipped": 0, "probes": 0,
+            "tasks": 0, "last_latency": None, "total_latency": 0.0}
+    for label, _, _, _ in POLL_SOURCES
+}
+_POLL_STATS_LOCK = threading.Lock()
+
+
+def _record_poll(label: str, latency=None, **increments):
+    with _POLL_STATS_LOCK:
+        st = _POLL_STATS[label]
+        for k, v in increments.items():
+            st[k] += v
+        if latency is not None:
+            st["last_latency"] = latency
+            st["total_latency"] += latency
+
+
+def get_poll_stats() -> dict:
+    """Snapshot of per-source polling counters (plus breaker state and mean latency)."""
+    with _POLL_STATS_LOCK:
+        snap = {label: dict(st) for label, st in _POLL_STATS.items()}
+    for label, st in snap.items():
+        done = st["polls"] - st["errors"]
+        st["mean_latency"] = (st["total_latency"] / done) if done > 0 else None
+        st["breaker"] = _BREAKERS[label].state
+    return snap
+
+
+def _log_poll_stats():
+    for label, st in get_poll_stats().items():
+        last = f"{st['last_latency']:.2f}s" if st["last_latency"] is not None else "-"
+        mean = f"{st['mean_latency']:.2f}s" if st["mean_latency"] is not None else "-"
+        logging.info(
+            f"poll stats {label}: breaker={st['breaker']} polls={st['polls']} errors={st['errors']} "
+            f"timeouts={st['timeouts']} skipped={st['skipped']} probes={st['probes']} "
+            f"tasks={st['tasks']} last={last} mean={mean}"
+        )
+
+
+def _fetch_source(label: str, url: str, default_on_dev: str, budget: float) -> list:
+    """Poll a single /api/davinci/files endpoint. Raises on any failure."""
+    logging.info(f"Polling {label} files URL: {url}")
+    resp = _session_for(url).get(url, timeout=_timeout(budget))
+    resp.raise_for_status()
+
+    try:
+        data = resp.json()
+    except Exception as e:
+        logging.error(
+            f"Failed to decode JSON from {label} files API: {e} | body={resp.text[:500]}"
+        )
+        data = []
+
+    if not data:
+        logging.info(f"{label}: no tasks returned.")
+        return []
+
+    logging.info(f"{label}: received {len(data)} task(s)")
+    tasks = []
+    for task in data:
+        # If backend didn't set on_dev explicitly, infer from source.
+        if "on_dev" not in task or (task["on_dev"] in (None, "", 0, 1) and str(task["on_dev"]).strip() == ""):
+            task["on_dev"] = default_on_dev
+        tasks.append(task)
+    return tasks
+
+
+def _timed_fetch(label: str, url: str, default_on_dev: str, budget: float) -> list:
+    """Run _fetch_source and feed the outcome into the source's counters and breaker."""
+    breaker = _BREAKERS[label]
+    t0 = time.monotonic()
+    try:
+        tasks = _fetch_source(label, url, default_on_dev, budget)
+    except Exception as e:
+        _record_poll(label, polls=1, errors=1)
+        breaker.record_failure()
+        logging.error(f"{label} files polling error: {e}")
+        raise
+    latency = time.monotonic() - t0
+    _record_poll(label, latency=latency, polls=1, tasks=len(tasks))
+    if latency > budget:
+        # The answer is still used, but a source this slow holds up its cycle
+        logging.warning(f"{label}: answered in {latency:.1f}s, over its {budget}s budget; counted as a failure")
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return tasks
+
+
+def _probe_source(label: str, url: str, default_on_dev: str, budget: float):
+    """Background probe for an open breaker, run by its timer.
+
+    On success the poll loop is woken so the source's tasks are fetched by a
+    regular poll right away instead of after the rest of the poll interval.
+    """
+    _record_poll(label, probes=1)
+    try:
+        _timed_fetch(label, url, default_on_dev, budget)
+    except Exception:
+        logging.info(f"{label}: background probe failed; breaker stays open")
+        return
+    if _BREAKERS[label].allow():
+        logging.info(f"{label}: background probe succeeded")
+        _POLL_WAKE.set()
+    else:
+        logging.info(f"{label}: background probe answered over budget; breaker stays open")
+
+
+def _poll_sources():
+    """
+    Poll both staging and production /api/davinci/files endpoints concurrently.
+    Yields (label, tasks) per source, as soon as that source answers, so the
+    caller can start on one source's tasks while the other is still polled.
     If a task does not contain `on_dev`, it will be set based on the source
     (staging → '1', production → '0').
+
+    A source that does not answer within its own latency budget is abandoned
+    for this cycle; its answer is kept when it arrives later and used next
+    cycle unless a fresh one comes in time. Sources whose circuit breaker is
+    open are skipped.
     """
-    all_tasks = []
+    pending = {}
+    skipped = []
 
-    sources = [
-        ("staging", API_STAGING_FILES_URL, "1"),
-        ("production", API_PRODUCTION_FILES_URL, "0"),
-    ]
+    for label, url, default_on_dev, budget in POLL_SOURCES:
+        breaker = _BREAKERS[label]
+        if not breaker.allow():
+            _record_poll(label, skipped=1)
+            logging.info(f"{label}: circuit breaker {breaker.state}, skipping this cycle")
+            skipped.append(label)
+            continue
+        fut = _POLL_EXECUTOR.submit(_timed_fetch, label, url, default_on_dev, budget)
+        started = time.monotonic()
+        pending[fut] = (label, budget, started + budget, started)
 
-    for label, url, default_on_dev in sources:
-        try:
-            logging.info(f"Polling {label} files URL: {url}")
-            resp = requests.get(url, timeout=30)
-            resp.raise_for_status()
+    for label in skipped:
+        late = _take_late_result(label)
+        if late:
+            yield label, late
 
+    while pending:
+        done, _ = futures_wait(list(pending), return_when=FIRST_COMPLETED,
+                               timeout=max(0.0, min(p[2] for p in pending.values()) - time.monotonic()))
+        for fut in done:
+            label, _, _, started = pending.pop(fut)
             try:
-                data = resp.json()
-            except Exception as e:
-                logging.error(
-                    f"Failed to decode JSON from {label} files API: {e} | body={resp.text[:500]}"
-                )
-                data = []
+                tasks = fut.result()
+                with _LATE_RESULTS_LOCK:
+                    _ANSWERED_AT[label] = started
+                    _LATE_RESULTS.pop(label, None)
+            except Exception:
+                tasks = _take_late_result(label)  # error already logged and counted in _timed_fetch
+            if tasks:
+                yield label, tasks
+        now = time.monotonic()
+        for fut in [f for f, (_, _, deadline, _) in pending.items() if deadline <= now]:
+            # The request itself is still bounded by `budget`; it will finish on
+            # the pool thread and report its own outcome to the breaker.
+            label, budget, _, started = pending.pop(fut)
+            _record_poll(label, timeouts=1)
+            logging.error(f"{label} files polling exceeded its {budget}s budget; continuing without it")
+            fut.add_done_callback(lambda f, label=label, started=started: _keep_late_result(label, started, f))
+            late = _take_late_result(label)
+            if late:
+                yield label, late
 
-            if not data:
-                logging.info(f"{label}: no tasks returned.")
-                continue
+    _log_poll_stats()
 
-            logging.info(f"{label}: received {len(data)} task(s)")
-            for task in data:
-                # If backend didn't set on_dev explicitly, infer from source.
-                if "on_dev" not in task or (task["on_dev"] in (None, "", 0, 1) and str(task["on_dev"]).strip() == ""):
-                    task["on_dev"] = default_on_dev
-                all_tasks.append(task)
 
-        except Exception as e:
-            logging.error(f"{label} files polling error: {e}")
+def _take_late_result(label: str):
+    """Pop the tasks of a late answer kept for `label` (None when there is none)."""
+    with _LATE_RESULTS_LOCK:
+        late = _LATE_RESULTS.pop(label, None)
+    if late is not None:
+        logging.info(f"{label}: using {len(late)} task(s) from last cycle's late answer")
+    return late
 
-    return all_tasks
+
+def _keep_late_result(label: str, started: float, fut):
+    if fut.exception() is None:
+        with _LATE_RESULTS_LOCK:
+            if started > _ANSWERED_AT.get(label, 0.0):
+                _LATE_RESULTS[label] = fut.result()
 
 
 def poll_forever(interval_seconds: int = 120):
     """Main loop: poll the backend every `interval_seconds` seconds.
 
     For each returned task, download the file, run DaVinci automation,
-    and push the result back via /api/davinci/save_reply.
+    and queue the result for the outbox sender (/api/davinci/save_reply).
+    Each source's tasks are worked off as soon as that source answers.
     """
     logging.info(
-        f"Starting DaVinci polling worker. Interval={interval_seconds}s, files_dir={INDIR}"
+        f"Starting DaVinci polling worker. Interval={interval_seconds}s, files_dir={INDIR}, "
+        f"prefetch_depth={PREFETCH_DEPTH}"
     )
+    prefetcher = _Prefetcher()
+    scheduler = _Scheduler()
+    first_seen = {}
+    OUTBOX.start()
+    _resume_unfinished_tasks()
 
     while True:
         print("[AGENT] --- Poll cycle start ---", flush=True)
+        total = 0
+        polled = set()
         try:
-            tasks = _fetch_all_tasks()
-            print(f"[AGENT] Polling done, got {len(tasks)} task(s) (staging+production)", flush=True)
-
-            if not tasks:
+            for label, tasks in _poll_sources():
+                total += len(tasks)
+                logging.info(f"Received {len(tasks)} task(s) from {label}")
+                print(f"[AGENT] Processing {len(tasks)} {label} task(s) from queue", flush=True)
+                now = time.time()
+                polled.update(_task_key(t) for t in tasks)
+                for t in tasks:
+                    first_seen.setdefault(_task_key(t), now)
+                scheduler.history.load()
+                tasks = scheduler.order(tasks, now, {id(t): first_seen[_task_key(t)] for t in tasks})
+                if scheduler.policy != "fifo":
+                    logging.info(f"Scheduled ({scheduler.policy}): " + ", ".join(
+                        f"{t.get('task_id')}~{scheduler.history.expected(t):.0f}s" for t in tasks))
+                prefetcher.queue(tasks)
+                try:
+                    for task in tasks:
+                        process_task(task, prefetcher, queued=first_seen[_task_key(task)])
+                finally:
+                    prefetcher.reset()
+                    prefetcher.log_summary()
+            print(f"[AGENT] Poll cycle done, got {total} task(s) (staging+production)", flush=True)
+            if not total:
                 logging.info("No tasks returned.")
                 print("[AGENT] No tasks returned this cycle.", flush=True)
-            else:
-                logging.info(f"Received {len(tasks)} task(s)")
-                print(f"[AGENT] Processing {len(tasks)} task(s) from queue", flush=True)
-                for task in tasks:
-                    process_task(task)
+            first_seen = {k: v for k, v in first_seen.items() if k in polled}
         except Exception as e:
             logging.error(f"Top-level polling error: {e}")
             print(f"[AGENT] Top-level polling error: {e}", flush=True)
 
-        time.sleep(interval_seconds)
+        if _POLL_WAKE.wait(interval_seconds):
+            logging.info("Poll cycle started early: a tripped source recovered")
+        _POLL_WAKE.clear()
         print(f"[AGENT] Sleeping {interval_seconds} seconds before next poll...", flush=True)
 
 
 if __name__ == "__main__":
+    if "--simulate-scheduler" in sys.argv:
+        import argparse
+        ap = argparse.ArgumentParser(description="Replay recorded task mixes under each scheduling policy")
+        ap.add_argument("--simulate-scheduler", nargs="?", const=str(STAGE_TIMINGS_PATH), metavar="TIMINGS",
+                        help=f"stage timings JSONL (default {STAGE_TIMINGS_PATH})")
+        ap.add_argument("--batch-gap", type=float, default=30.0,
+                        help="Seconds between runs that start a new poll batch (default 30)")
+        ap.add_argument("--aging", type=float, default=SCHEDULER_AGING, help="SJF aging rate")
+        a = ap.parse_args()
+        sys.exit(0 if simulate_scheduler(Path(a.simulate_scheduler), a.batch_gap, a.aging) else 1)
+    _setup_runtime()
     print(">>> AGENT: STARTED. Polling for tasks...", flush=True)
     try:
         poll_forever()
     except KeyboardInterrupt:
-        print("Stopped by user.")
\ No newline at end of file
+        print("Stopped by user.")
+    finally:
+        WORKER.stop()
+        OUTBOX.stop()
+        close_sessions()
\ No newline at end of file
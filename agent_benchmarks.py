@@ -0,0 +1,198 @@
+# agent_benchmarks.py — agent.py's HTTP paths timed against local stand-in servers (no backend needed)
+
+from pathlib import Path
+import subprocess
+import json
+import sys
+import os
+import time
+import shutil
+import threading
+import requests
+
+import agent
+
+
+def _stand_in_server(tmp: Path | None, rtt: float, handler_body, tls: bool = True):
+    """Threaded HTTP(S) server on 127.0.0.1 whose connections and requests each cost `rtt` seconds.
+
+    A new connection waits 2 x rtt (TCP plus TLS handshake round trips), every
+    request 1 x rtt. With `tls`, a throw-away certificate is made with the
+    openssl CLI in `tmp`; returns (server, base URL, CA file or None).
+    """
+    import http.server
+    import ssl
+
+    class StandIn(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            time.sleep(2 * rtt)
+            super().setup()
+
+        def _reply(self):
+            n = int(self.headers.get("Content-Length") or 0)
+            while n > 0:
+                n -= len(self.rfile.read(min(n, 1 << 20)) or b"x" * n)
+            time.sleep(rtt)
+            body = handler_body(self)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = _reply
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.daemon_threads = True
+    cafile = None
+    if tls:
+        cafile, keyfile = str(tmp / "cert.pem"), str(tmp / "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                        "-keyout", keyfile, "-out", cafile, "-subj", "/CN=127.0.0.1",
+                        "-addext", "subjectAltName=IP:127.0.0.1"], check=True, capture_output=True)
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(cafile, keyfile)
+        server.socket = ctx.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{'https' if tls else 'http'}://127.0.0.1:{server.server_port}", cafile
+
+
+def _benchmark_http(requests_per_mode: int, rtt_ms: float) -> int:
+    """Per-request latency of a fresh connection per call vs. the pooled keep-alive session."""
+    import tempfile
+    tmp = Path(tempfile.mkdtemp(prefix="agent_bench_"))
+    try:
+        try:
+            server, base, cafile = _stand_in_server(tmp, rtt_ms / 1000, lambda h: b"[]")
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"HTTPS stand-in unavailable ({e}); the openssl CLI is needed for its certificate")
+            return 2
+        url = f"{base}/api/davinci/files"
+        results = {}
+        for mode in ("fresh", "pooled"):
+            times = []
+            for _ in range(requests_per_mode):
+                t0 = time.perf_counter()
+                if mode == "fresh":
+                    requests.get(url, timeout=agent._timeout(), verify=cafile)
+                else:
+                    agent._session_for(url).get(url, timeout=agent._timeout(), verify=cafile)
+                times.append((time.perf_counter() - t0) * 1000)
+            times.sort()
+            results[mode] = times
+            print(f"{mode:6s}: {len(times)} requests, median {times[len(times) // 2]:.1f} ms, "
+                  f"p95 {times[int(len(times) * 0.95) - 1]:.1f} ms, max {times[-1]:.1f} ms")
+        saved = results["fresh"][len(results["fresh"]) // 2] - results["pooled"][len(results["pooled"]) // 2]
+        print(f"stand-in round trip {rtt_ms:.0f} ms: pooled session saves {saved:.1f} ms per request (median)")
+        server.shutdown()
+        agent.close_sessions()
+        return 0
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB (None when it cannot be read)."""
+    try:
+        import resource
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return kb / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    "PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                    "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                 ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize / (1024 * 1024)
+    except Exception:
+        return None
+
+
+def _benchmark_upload_case(mode: str, url: str, path: str):
+    """One upload in this (fresh) process; prints {"seconds", "peak_rss_mb"} as JSON."""
+    t0 = time.perf_counter()
+    if mode == "json":
+        resp = agent._post_save_reply_json(url, 1, path)
+    elif mode != "none":
+        resp = agent._post_save_reply_streaming(url, 1, path, mode)
+    if mode != "none":
+        resp.raise_for_status()
+    print(json.dumps({"seconds": time.perf_counter() - t0, "peak_rss_mb": _peak_rss_mb()}))
+
+
+def _benchmark_upload(sizes_kb) -> int:
+    """Wall time and peak RSS of each save_reply mode for result files of `sizes_kb`.
+
+    Every upload runs in its own interpreter (peak RSS only grows), against a
+    local receiver that reads and discards the body. "none" is an interpreter
+    that imported the agent and uploaded nothing: the baseline.
+    """
+    import tempfile
+    tmp = Path(tempfile.mkdtemp(prefix="agent_bench_"))
+    server, base, _ = _stand_in_server(tmp, 0.0, lambda h: b"{}", tls=False)
+    url = f"{base}/api/davinci/save_reply"
+
+    def case(mode, path):
+        out = subprocess.run([sys.executable, __file__, "--upload-case", mode, url, str(path)],
+                             capture_output=True, text=True, timeout=600)
+        if out.returncode != 0:
+            raise RuntimeError(out.stderr.strip().splitlines()[-1] if out.stderr.strip() else out.returncode)
+        return json.loads(out.stdout.strip().splitlines()[-1])
+
+    try:
+        base_rss = case("none", tmp)["peak_rss_mb"]
+        print(f"baseline (agent imported, no upload): peak RSS {base_rss or 0:.1f} MB")
+        print(f"{'size':>8s}  {'mode':12s} {'wall':>8s} {'peak RSS':>9s} {'over baseline':>14s}")
+        for kb in sizes_kb:
+            path = tmp / f"result_{kb}k.mod"
+            with open(path, "wb") as f:
+                for _ in range(kb // 64):
+                    f.write(os.urandom(64 * 1024))
+                f.write(os.urandom(kb % 64 * 1024))
+            for mode in ("json", "multipart", "octet-stream"):
+                r = case(mode, path)
+                rss = r["peak_rss_mb"]
+                extra = f"{rss - base_rss:+13.1f}M" if rss is not None and base_rss is not None else f"{'-':>14s}"
+                print(f"{kb:>6d}KB  {mode:12s} {r['seconds'] * 1000:6.0f}ms "
+                      f"{(rss or 0):8.1f}M {extra}", flush=True)
+            path.unlink()
+        return 0
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if "--upload-case" in sys.argv:
+        # one upload of `upload`, run in a fresh interpreter
+        _benchmark_upload_case(*sys.argv[sys.argv.index("--upload-case") + 1:][:3])
+        sys.exit(0)
+    import argparse
+    ap = argparse.ArgumentParser(description="Time the agent's backend calls against local stand-ins")
+    sub = ap.add_subparsers(dest="benchmark", required=True)
+    http = sub.add_parser("http", help="Fresh HTTPS connection per call vs. the pooled keep-alive session")
+    http.add_argument("--requests", type=int, default=50, help="Requests per mode (default 50)")
+    http.add_argument("--rtt-ms", type=float, default=20, help="Simulated network round trip (default 20)")
+    upload = sub.add_parser("upload", help="Wall time and peak RSS of each save_reply mode")
+    upload.add_argument("sizes", nargs="*", type=int, metavar="KB",
+                        help="Result file sizes in KB (default 512 1024 4096 16384)")
+    a = ap.parse_args()
+    if a.benchmark == "http":
+        sys.exit(_benchmark_http(a.requests, a.rtt_ms))
+    sys.exit(_benchmark_upload(a.sizes or [512, 1024, 4096, 16384]))
@@ -1,7 +1,8 @@
 # davinci_automation.py — Launch/attach DaVinci → select BRAND & ECU → load BIN → apply services → save mod file
 # deps: pip install pywinauto
 
-import argparse, sys, time, subprocess
+import argparse, sys, time, subprocess, json, re, threading, hashlib
+from contextlib import contextmanager
 from pathlib import Path
 from pywinauto.application import Application
 from pywinauto import Desktop
@@ -10,85 +11,480 @@ from pywinauto.keyboard import send_keys
 from pywinauto.controls.uiawrapper import UIAWrapper
 from pywinauto.uia_defines import IUIA
 from pywinauto import clipboard
+from davinci_common import BRAND_ALIASES, SERVICE_LABELS, effective_brand, exe_version, parse_services_map
 import logging
 logging.basicConfig(filename=str(Path("C:/davinci_automation/davinci_automation.log")),
                     level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
 
+# --- Stage timing events ---
+# Every stage of run() emits one machine-readable line on stdout (and in the log):
+#   STAGE_TIMING:{"stage": ..., "start": <epoch s>, "duration": <s>, "outcome": ..., "retries": n}
+# agent.py collects these into per-task timing records. run() closes every run,
+# failed or not, with a "total" event whose outcome is done, error or timeout.
+_STAGE_STACK = []
+_FAILED_STAGES = []   # events of the stages an exception left in the current run, innermost first
+
+@contextmanager
+def timed_stage(name: str):
+    """Time a stage of run(). The block may set ev["outcome"] (default 'ok'; 'error' on an exception it did not label)."""
+    ev = {"stage": name, "retries": 0}
+    start = time.time()
+    t0 = time.perf_counter()
+    visits0, calls0 = WALK_VISITS["count"], UIA_CALLS["count"]
+    _STAGE_STACK.append(ev)
+    try:
+        yield ev
+    except BaseException:
+        ev.setdefault("outcome", "error")
+        _FAILED_STAGES.append(ev)
+        raise
+    finally:
+        _STAGE_STACK.pop()
+        ev["start"] = round(start, 3)
+        ev["duration"] = round(time.perf_counter() - t0, 3)
+        if WALK_VISITS["count"] != visits0:
+            ev["visits"] = WALK_VISITS["count"] - visits0
+        if UIA_CALLS["count"] != calls0:
+            ev["uia_calls"] = UIA_CALLS["count"] - calls0
+        ev.setdefault("outcome", "ok")
+        STAGE_MODEL.observe(ev)
+        emit_stage_event(ev)
+
+def note_retry():
+    """Count one retry against the innermost running stage (no-op outside run())."""
+    if _STAGE_STACK:
+        _STAGE_STACK[-1]["retries"] += 1
+
+def stage_note(**fields):
+    """Attach extra fields to the innermost running stage event (no-op outside run())."""
+    if _STAGE_STACK:
+        _STAGE_STACK[-1].update(fields)
+
+def emit_stage_event(ev: dict):
+    line = json.dumps(ev, sort_keys=True)
+    logging.info(f"STAGE_TIMING:{line}")
+    print(f"STAGE_TIMING:{line}", flush=True)
+
+
+# --- Stage duration model ---
+# Durations of successful stages (plus the file-load wait) per (brand, ECU,
+# services), kept as a rolling window of the last STAGE_WINDOW samples in
+# STAGE_STATS_PATH. A stage that timed out is kept as a censored sample: its
+# duration, which is at least the timeout it hit, so the next timeout grows
+# instead of only ever shrinking. Waits derive their timeout from the window's p99:
+#   p99 * STAGE_TIMEOUT_MARGIN + STAGE_TIMEOUT_PAD, clamped to STAGE_TIMEOUT_RANGE x default,
+# and use the cold-start default until STAGE_MIN_SAMPLES runs were seen. A stage
+# far above its p99, or a timeout, is logged as STAGE_ANOMALY and tagged in its event.
+STAGE_STATS_PATH = Path("C:/davinci_automation/stage_durations.json")
+STAGE_WINDOW = 200
+STAGE_MIN_SAMPLES = 5
+STAGE_TIMEOUT_MARGIN = 1.5
+STAGE_TIMEOUT_PAD = 2.0
+STAGE_TIMEOUT_RANGE = (0.25, 3.0)
+STAGE_ANOMALY_FACTOR = 1.5
+
+
+def _percentile(sorted_values, p: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class StageDurationModel:
+    """Rolling per-(brand, ECU, services) stage durations with p50/p95/p99 and adaptive timeouts."""
+
+    def __init__(self, path: Path = STAGE_STATS_PATH):
+        self.path = path
+        self.data = None
+        self.key = None  # set by begin() for the running task
+
+    def _loaded(self) -> dict:
+        if self.data is None:
+            try:
+                self.data = json.loads(self.path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                self.data = {}
+        return self.data
+
+    def begin(self, brand: str, ecu: str, services: str):
+        svc = ",".join(f"{k}:{v}" for k, v in sorted(parse_services_map(services).items()))
+        self.key = f"{effective_brand(brand)}|{(ecu or '').strip().upper()}|{svc}"
+
+    def save(self):
+        if self.data is None:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self.data), encoding="utf-8")
+            tmp.replace(self.path)
+        except OSError as e:
+            logging.warning(f"Could not persist stage durations: {e}")
+
+    def stats(self, stage: str):
+        """{"n", "p50", "p95", "p99"} for a stage of the current task, None before STAGE_MIN_SAMPLES."""
+        if self.key is None:
+            return None
+        samples = self._loaded().get(self.key, {}).get(stage)
+        if not samples or len(samples) < STAGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return {"n": len(ordered), "p50": _percentile(ordered, 50), "p95": _percentile(ordered, 95),
+                "p99": _percentile(ordered, 99)}
+
+    def timeout(self, stage: str, default: float) -> float:
+        """Timeout for a wait of `stage`: from its history, or `default` on a cold start."""
+        st = self.stats(stage)
+        if st is None:
+            return default
+        lo, hi = STAGE_TIMEOUT_RANGE
+        t = min(max(st["p99"] * STAGE_TIMEOUT_MARGIN + STAGE_TIMEOUT_PAD, default * lo), default * hi)
+        logging.info(f"adaptive timeout {stage}: {t:.1f}s (default {default:.0f}s; "
+                     f"p50 {st['p50']:.1f}s p95 {st['p95']:.1f}s p99 {st['p99']:.1f}s, n={st['n']})")
+        stage_note(timeout=round(t, 1))
+        return t
+
+    def add(self, stage: str, duration: float):
+        if self.key is None:
+            return
+        samples = self._loaded().setdefault(self.key, {}).setdefault(stage, [])
+        samples.append(round(duration, 3))
+        del samples[:-STAGE_WINDOW]
+
+    def observe(self, ev: dict):
+        """Check a finished stage event against its history, then add it (successful or timed-out stages)."""
+        stage, duration, outcome = ev.get("stage"), ev.get("duration") or 0.0, ev.get("outcome")
+        st = self.stats(stage)
+        if outcome == "timeout" and st is not None:
+            ev["anomaly"] = "timeout"
+        elif st is not None and duration > st["p99"] * STAGE_ANOMALY_FACTOR:
+            ev["anomaly"] = "slow"
+        if "anomaly" in ev:
+            ref = f"p50 {st['p50']:.1f}s, p99 {st['p99']:.1f}s, n={st['n']}" if st else "no history"
+            logging.warning(f"STAGE_ANOMALY {self.key} {stage}: {ev['anomaly']} after {duration:.1f}s ({ref})")
+        if outcome in ("ok", "timeout"):
+            self.add(stage, duration)
+
+
+STAGE_MODEL = StageDurationModel()
+
+
+# --- Wait primitives ---
+# Condition waits that return as soon as DaVinci is ready instead of sleeping a
+# fixed amount. `budget` is the fixed sleep a wait replaces; budget minus the
+# actual wait is added to the running stage's "wait_saved" and to WAIT_TOTALS,
+# which run() reports in its "total" event.
+WAIT_TOTALS = {"waited": 0.0, "saved": 0.0}
+
+def _record_wait(label: str, waited: float, budget: float | None):
+    WAIT_TOTALS["waited"] += waited
+    msg = f"wait {label}: {waited:.2f}s"
+    if budget is not None:
+        saved = budget - waited
+        WAIT_TOTALS["saved"] += saved
+        if _STAGE_STACK:
+            ev = _STAGE_STACK[-1]
+            ev["wait_saved"] = round(ev.get("wait_saved", 0.0) + saved, 3)
+        msg += f" (fixed sleep was {budget:.2f}s)"
+    logging.info(msg)
+
+def wait_until(condition, timeout: float, poll: float = 0.1, budget: float | None = None, label: str = "condition"):
+    """Poll `condition()` until it returns something truthy (returned) or `timeout` passes (None)."""
+    t0 = time.perf_counter()
+    while True:
+        try:
+            result = condition()
+        except Exception:
+            result = None
+        elapsed = time.perf_counter() - t0
+        if result or elapsed >= timeout:
+            break
+        time.sleep(min(poll, timeout - elapsed))
+    _record_wait(label, time.perf_counter() - t0, budget)
+    return result or None
+
+def wait_exists(find, timeout: float, poll: float = 0.1, budget: float | None = None, label: str = "element"):
+    """Wait for an element: `find` is a callable returning it (or None), or a window spec."""
+    if callable(find):
+        return wait_until(find, timeout, poll, budget, label)
+    return wait_until(lambda: find if find.exists(timeout=0) else None, timeout, poll, budget, label)
+
+def wait_enabled(elem, timeout: float, poll: float = 0.1, budget: float | None = None, label: str = "enabled") -> bool:
+    return bool(wait_until(lambda: elem.is_enabled(), timeout, poll, budget, label))
+
+def _element_gone(elem) -> bool:
+    try:
+        return not (elem.exists(timeout=0) if hasattr(elem, "exists") else elem.is_visible())
+    except Exception:
+        return True
+
+def wait_gone(elem, timeout: float, poll: float = 0.1, budget: float | None = None, label: str = "gone") -> bool:
+    return bool(wait_until(lambda: _element_gone(elem), timeout, poll, budget, label))
+
+def wait_idle(app, timeout: float, threshold: float = 5.0, interval: float = 0.2, samples: int = 2,
+              ready=None, budget: float | None = None, label: str = "idle") -> bool:
+    """Wait until `ready()` (if given) holds and the process CPU stays below `threshold`% for `samples` readings."""
+    streak = [0]
+
+    def idle():
+        if ready is not None and not ready():
+            streak[0] = 0
+            return False
+        streak[0] = streak[0] + 1 if app.cpu_usage(interval) < threshold else 0
+        return streak[0] >= samples
+    return bool(wait_until(idle, timeout, poll=0.1, budget=budget, label=label))
+
+def _focused_info():
+    """UIAElementInfo of the element with keyboard focus, None when it cannot be read."""
+    try:
+        from pywinauto.uia_element_info import UIAElementInfo
+        el = IUIA().get_focused_element()
+        return UIAElementInfo(el) if el is not None else None
+    except Exception:
+        return None
+
+def wait_focus_edit(before, timeout: float, budget: float | None = None, label: str = "focus") -> bool:
+    """Wait until keyboard focus is on an Edit other than `before` (the focus read before a shortcut).
+
+    Without a readable focus this sleeps `budget`, the fixed pause it replaces.
+    """
+    if before is None:
+        if budget:
+            time.sleep(budget)
+        return True
+
+    def moved():
+        cur = _focused_info()
+        return cur is not None and cur.control_type == "Edit" and cur != before
+    return bool(wait_until(moved, timeout, poll=0.05, budget=budget, label=label))
+
+
+# --- Vision signals ---
+# screen_state.py (next to this script) matches loading.png against the centre of
+# the DaVinci window and detects when a window has stopped repainting. Optional:
+# without numpy/opencv/Pillow the waits fall back to dialog + CPU signals, and
+# wait_settled to the fixed sleep it replaces.
+SETTLE_DUMP_DIR = Path("C:/davinci_automation/settle_frames")
+_SCREEN_STATE = []   # [screen_state module or None], filled on first use
+_BUSY_DETECTOR = []  # [LoadingDetector or None], filled on first use
+
+def _screen_state():
+    if not _SCREEN_STATE:
+        mod = None
+        try:
+            import screen_state
+            if screen_state.cv2 is not None:
+                mod = screen_state
+        except Exception as e:
+            logging.info(f"screen_state unavailable: {e}")
+        _SCREEN_STATE.append(mod)
+    return _SCREEN_STATE[0]
+
+def _busy_detector():
+    if not _BUSY_DETECTOR:
+        det = None
+        ss = _screen_state()
+        try:
+            if ss is not None and ss.available():
+                det = ss.LoadingDetector()
+        except Exception as e:
+            logging.info(f"Loading-spinner detector unavailable: {e}")
+        _BUSY_DETECTOR.append(det)
+    return _BUSY_DETECTOR[0]
+
+def _window_bbox(win):
+    r = win.rectangle()
+    return (r.left, r.top, r.right, r.bottom)
+
+def _screen_busy(win) -> bool:
+    """True while DaVinci's loading spinner is visible in `win` (False if it cannot be checked)."""
+    det = _busy_detector()
+    if det is None:
+        return False
+    try:
+        return det.is_busy_on_screen(_screen_state().window_region(_window_bbox(win)))
+    except Exception:
+        return False
+
+def settle_detector(quiet_ms: float = 400):
+    """A fresh screen_state.SettleDetector, or None when vision is unavailable."""
+    ss = _screen_state()
+    return ss.SettleDetector(quiet_ms=quiet_ms) if ss is not None else None
+
+def _screen_settled(win, det) -> bool:
+    """Feed one frame of `win` to `det`; True once it has stopped changing (True if it cannot be checked)."""
+    if det is None:
+        return True
+    try:
+        return det.update_on_screen(_window_bbox(win))
+    except Exception:
+        return True
+
+def wait_settled(win, quiet_ms: float = 400, timeout: float = 5.0, budget: float | None = None,
+                 label: str = "settled") -> bool:
+    """Wait until `win` has not repainted for `quiet_ms`.
+
+    Without vision (or when the window cannot be captured) this sleeps `budget`,
+    the fixed pause it replaces. On timeout the recent frames are written to
+    SETTLE_DUMP_DIR/<label> for post-mortem debugging.
+    """
+    det = settle_detector(quiet_ms)
+    if det is not None:
+        try:
+            det.update_on_screen(_window_bbox(win))
+        except Exception:
+            det = None
+    if det is None:
+        if budget:
+            time.sleep(budget)
+        return True
+    if wait_until(lambda: det.update_on_screen(_window_bbox(win)), timeout, poll=0.05, budget=budget, label=label):
+        return True
+    try:
+        n = det.dump(SETTLE_DUMP_DIR / re.sub(r"[^\w-]+", "_", label))
+        logging.info(f"wait {label}: window still changing after {timeout:.1f}s; {n} frames saved")
+    except Exception:
+        pass
+    return False
+
+
 MAIN_TITLES = ["DaVinci DPF EGR DTC", "DaVinci"]
 # Common Save dialog titles (multi-locale)
 OPEN_HINTS  = ["Open", "Öffnen", "Abrir", "Открытие", "Open File", "Select file", "Original Files"]
 SAVE_HINTS  = ["Save Mod File", "Save As", "Save", "Speichern", "Guardar", "Сохранение", "Save file", "Save Modified File"]
 # Helper to detect top-level file dialogs even if not a dialog or with custom titles
 
-# Map various backend brand inputs to the label used in DaVinci's brand tree
-BRAND_ALIASES = {
-    # VAG cluster
-    "volkswagen": "VAG",
-    "vw": "VAG",
-    "audi": "VAG",
-    "seat": "VAG",
-    "skoda": "VAG",
-
-    # Direct one-to-one caps (for completeness, in case backend sends lowercase)
-    "bmw": "BMW",
-    "fiat": "FIAT",
-    "lancia": "LANCIA",
-    "smart": "SMART",
-    "dodge": "DODGE",
-    "chrysler": "CHRYSLER",
-    "iveco": "IVECO",
-    "peugeot": "PEUGEOT",
-    "opel": "OPEL",
-    "renault": "RENAULT",
-    "ford": "FORD",
-    "mazda": "MAZDA",
-    "land rover": "LAND ROVER",
-    "jaguar": "JAGUAR",
-    "kia": "KIA",
-    "hyundai": "HYUNDAI",
-    "volvo": "VOLVO",
-    "suzuki": "SUZUKI",
-
-    # Special cases where backend name and DaVinci label differ
-    "alfa romeo": "ALFA",
-    "alfa": "ALFA",
-    "mercedes-benz": "MERCEDES",
-    "mercedes benz": "MERCEDES",
-    "mercedes": "MERCEDES",
-}
+# Connected (app, main window) kept across jobs in --worker mode
+_CONNECTED = {"app": None, "win": None}
 
-def effective_brand(brand: str) -> str:
-    """
-    Map various backend brand inputs to the brand label used by DaVinci's tree.
+def _cached_window():
+    """Return the cached (app, win) if the DaVinci window is still alive, else None."""
+    app, win = _CONNECTED["app"], _CONNECTED["win"]
+    if win is None:
+        return None
+    try:
+        if win.exists(timeout=0) and win.is_visible():
+            return app, win
+    except Exception:
+        pass
+    _CONNECTED["app"] = _CONNECTED["win"] = None
+    return None
+
+# --- Direct open (--open-direct) ---
+# Some DaVinci builds open a BIN given on the command line: either when starting
+# ("launch") or, with a running instance, by forwarding the path to it and
+# exiting ("handoff"). Support is probed the first time each mode is tried and
+# cached per DaVinci version; unsupported modes fall back to the Open dialog. A
+# load that only timed out counts as unsupported after OPEN_DIRECT_MAX_SLOW in a row.
+OPEN_DIRECT_CACHE_PATH = Path("C:/davinci_automation/open_direct_support.json")
+OPEN_DIRECT_LOAD_TIMEOUT = 20
+OPEN_DIRECT_MAX_SLOW = 3
+# Stages replaced by a successful direct open (reported as "skipped")
+OPEN_DIRECT_SKIPS = ["tree_lookup", "select_brand_ecu", "info_dialog", "open_dialog_wait", "open_file"]
 
-    Examples:
-      - 'Volkswagen', 'VW', 'Audi', 'Seat', 'Skoda' → 'VAG'
-      - 'Mercedes-Benz', 'Mercedes Benz', 'Mercedes' → 'MERCEDES'
-      - 'Alfa Romeo', 'Alfa' → 'ALFA'
-      - Other brands use an uppercase-normalized version of the original string.
-    """
-    raw = (brand or "").strip()
-    b = raw.lower()
 
-    # First try explicit mapping
-    mapped = BRAND_ALIASES.get(b)
-    if mapped:
-        return mapped
+def _open_direct_support(exe: Path, mode: str):
+    """Cached True/False for `mode` on this DaVinci version, None when not probed yet."""
+    try:
+        data = json.loads(OPEN_DIRECT_CACHE_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    return data.get(exe_version(exe), {}).get(mode)
+
+
+def _remember_open_direct(exe: Path, mode: str, supported: bool, slow: bool = False):
+    """Cache the outcome of a direct open; a `slow` one (load timed out) is only counted."""
+    try:
+        data = json.loads(OPEN_DIRECT_CACHE_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        data = {}
+    entry = data.setdefault(exe_version(exe), {})
+    if slow:
+        entry[f"{mode}_slow"] = entry.get(f"{mode}_slow", 0) + 1
+        supported = False if entry[f"{mode}_slow"] >= OPEN_DIRECT_MAX_SLOW else None
+    else:
+        entry.pop(f"{mode}_slow", None)
+    if supported is not None:
+        entry[mode] = supported
+    try:
+        OPEN_DIRECT_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        OPEN_DIRECT_CACHE_PATH.write_text(json.dumps(data, indent=2), encoding="utf-8")
+    except OSError as e:
+        logging.warning(f"Could not persist open-direct support: {e}")
+    logging.info(f"open-direct {mode} support for {exe.name}: {supported}")
+
+
+def _main_windows():
+    try:
+        return [w for t in MAIN_TITLES for w in Desktop(backend="uia").windows(title_re=t)]
+    except Exception:
+        return []
+
+
+def _window_title(win) -> str:
+    try:
+        return win.window_text() or ""
+    except Exception:
+        return ""
+
+
+def _file_shown(win, filename: str) -> bool:
+    """True when the main window shows the BIN's full file name (in its title or any label)."""
+    shows = re.compile(r"(?:^|[\\/\s\[(\"'-])" + re.escape(Path(filename).name.lower()) + r"(?:$|[\s\])\"'*-])").search
+    if shows(_window_title(win).lower()):
+        return True
+    snap = snapshot_elements(win)
+    if snap is not None:
+        return snap.first(name=shows) is not None
+    return first_element(win, name=shows, prune=BULK_CONTAINERS) is not None
+
+
+def _file_newly_shown(win, filename: str, before) -> bool:
+    """_file_shown, and when it was already shown at `before` (title, shown) the title changed since."""
+    if not _file_shown(win, filename):
+        return False
+    title_before, shown_before = before
+    return not shown_before or _window_title(win) != title_before
+
+
+def _handoff_open(exe: Path, path: str):
+    """Pass `path` to the running DaVinci. False when a second instance started instead (it is killed)."""
+    before = len(_main_windows())
+    proc = subprocess.Popen([str(exe), path], shell=False, cwd=str(exe.parent))
+    wait_until(lambda: proc.poll() is not None or len(_main_windows()) > before,
+               timeout=10, poll=0.2, label="open-direct handoff")
+    if proc.poll() is None:
+        # A second instance (or a hung one): this build does not forward files
+        try:
+            proc.kill()
+        except Exception:
+            pass
+        return False
+    return True
 
-    # Fallback: just uppercase whatever we got, so it matches DaVinci's caps style
-    return raw.upper()
 
 def launch_if_needed(exe: Path):
     if not exe.exists():
         raise FileNotFoundError(f"DaVinci not found: {exe}")
+    if _cached_window() is not None:
+        return
     if any(Desktop(backend="uia").windows(title_re=t) for t in MAIN_TITLES):
         return
     subprocess.Popen([str(exe)], shell=False, cwd=str(exe.parent))
-    time.sleep(2)
+    wait_until(lambda: any(Desktop(backend="uia").windows(title_re=t) for t in MAIN_TITLES),
+               timeout=30, poll=0.2, budget=2, label="main window")
     logging.info("launched/attached")
 
 def connect_window(timeout=25):
+    cached = _cached_window()
+    if cached is not None:
+        try:
+            cached[1].set_focus()
+        except Exception:
+            pass
+        logging.info("reusing connected DaVinci window")
+        return cached
     t0 = time.time()
     while time.time() - t0 < timeout:
         for t in MAIN_TITLES:
@@ -96,12 +492,252 @@ def connect_window(timeout=25):
                 app = Application(backend="uia").connect(title_re=t, timeout=2)
                 win = app.window(title_re=t)
                 win.set_focus()
+                _CONNECTED["app"], _CONNECTED["win"] = app, win
                 return app, win
             except Exception:
                 pass
+        note_retry()
         time.sleep(0.4)
     raise RuntimeError("DaVinci window not found. Match elevation (Admin vs non-Admin).")
 
+# --- Bounded element traversal ---
+# descendants() materializes the whole subtree (the brand tree alone has
+# thousands of items) and the finders used to call it again per candidate.
+# walk_elements() is a lazy depth-first walk in the same order as descendants()
+# that stops as soon as the caller stops iterating, never enters pruned
+# subtrees and can be depth-limited. WALK_VISITS counts every element touched.
+WALK_VISITS = {"count": 0}
+# Cross-process UIA calls made by element searches (walks and snapshots)
+UIA_CALLS = {"count": 0}
+# Large item containers that never hold the buttons/edits/labels the finders want
+BULK_CONTAINERS = ("Tree", "List", "DataGrid", "Table")
+
+
+def _control_type(elem) -> str:
+    try:
+        ct = elem.element_info.control_type
+        if ct:
+            return ct
+    except Exception:
+        pass
+    try:
+        return elem.friendly_class_name()
+    except Exception:
+        return ""
+
+
+def _as_wrapper(elem):
+    return elem.wrapper_object() if hasattr(elem, "wrapper_object") else elem
+
+
+def walk_elements(root, control_type=None, name=None, predicate=None,
+                  max_depth=None, prune=None, with_depth=False):
+    """
+    Lazily yield the elements below `root` (root excluded) in descendants() order.
+
+      control_type: a control type or tuple of them to yield (win32: friendly class name)
+      name:         callable on the stripped, lower-cased element text
+      predicate:    callable on the element
+      max_depth:    do not go deeper than this (direct children are depth 1)
+      prune:        control types or callable(elem); matching elements are still
+                    yielded but their subtrees are not visited
+      with_depth:   yield (elem, depth) tuples
+    """
+    if isinstance(control_type, str):
+        control_type = (control_type,)
+    if isinstance(prune, str):
+        prune = (prune,)
+    try:
+        root = _as_wrapper(root)
+        stack = [(iter(root.iter_children()), 1)]
+    except Exception:
+        return
+    while stack:
+        it, depth = stack[-1]
+        try:
+            elem = next(it)
+        except StopIteration:
+            stack.pop()
+            continue
+        except Exception:
+            stack.pop()
+            continue
+        WALK_VISITS["count"] += 1
+        UIA_CALLS["count"] += 1
+        ct = ""
+        if control_type or isinstance(prune, tuple):
+            ct = _control_type(elem)
+            UIA_CALLS["count"] += 1
+        ok = not control_type or ct in control_type
+        if ok and name is not None:
+            UIA_CALLS["count"] += 1
+            try:
+                ok = bool(name((elem.window_text() or "").strip().lower()))
+            except Exception:
+                ok = False
+        if ok and predicate is not None:
+            try:
+                ok = bool(predicate(elem))
+            except Exception:
+                ok = False
+        if ok:
+            yield (elem, depth) if with_depth else elem
+        if max_depth is not None and depth >= max_depth:
+            continue
+        if prune is not None:
+            try:
+                if ct in prune if isinstance(prune, tuple) else prune(elem):
+                    continue
+            except Exception:
+                pass
+        try:
+            stack.append((iter(elem.iter_children()), depth + 1))
+        except Exception:
+            pass
+
+
+def first_element(root, **criteria):
+    """First element matching walk_elements() criteria, or None."""
+    return next(walk_elements(root, **criteria), None)
+
+
+def last_element(root, **criteria):
+    """Last element matching walk_elements() criteria, or None."""
+    found = None
+    for found in walk_elements(root, **criteria):
+        pass
+    return found
+
+
+# --- Cached element snapshots ---
+# Reading name/type/rect per element costs one cross-process call per property.
+# snapshot_elements() fetches those properties for a whole subtree with a single
+# UIA CacheRequest (BuildUpdatedCache) and returns plain in-process nodes;
+# only the element that is finally clicked or typed into goes back to UIA.
+SNAPSHOT_SKIP_TYPES = ("TreeItem", "ListItem", "DataItem")
+
+
+class SnapNode:
+    __slots__ = ("name", "control_type", "automation_id", "rect", "enabled", "parent", "children", "element")
+
+    def __init__(self, element, parent=None):
+        self.element = element
+        self.parent = parent
+        self.children = []
+        try:
+            self.name = (element.CachedName or "").strip()
+        except Exception:
+            self.name = ""
+        try:
+            self.control_type = IUIA().known_control_type_ids.get(element.CachedControlType, "")
+        except Exception:
+            self.control_type = ""
+        try:
+            self.automation_id = element.CachedAutomationId or ""
+        except Exception:
+            self.automation_id = ""
+        try:
+            r = element.CachedBoundingRectangle
+            self.rect = (r.left, r.top, r.right, r.bottom)
+        except Exception:
+            self.rect = None
+        try:
+            self.enabled = bool(element.CachedIsEnabled)
+        except Exception:
+            self.enabled = True
+
+
+class ElementSnapshot:
+    """In-process copy of a UIA subtree (see snapshot_elements)."""
+
+    def __init__(self, cached_root):
+        self.root = SnapNode(cached_root)
+        self.size = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            try:
+                arr = node.element.GetCachedChildren()
+                count = arr.Length if arr else 0
+            except Exception:
+                count = 0
+            for i in range(count):
+                child = SnapNode(arr.GetElement(i), node)
+                node.children.append(child)
+            self.size += count
+            stack.extend(reversed(node.children))
+
+    def iter(self, control_type=None, name=None, automation_id=None, within=None, prune=None):
+        """Pre-order nodes below `within` (default: the root), same criteria as walk_elements()."""
+        if isinstance(control_type, str):
+            control_type = (control_type,)
+        stack = list(reversed((within or self.root).children))
+        while stack:
+            node = stack.pop()
+            if ((not control_type or node.control_type in control_type)
+                    and (automation_id is None or node.automation_id == automation_id)
+                    and (name is None or name(node.name.lower()))):
+                yield node
+            if not (prune and node.control_type in prune):
+                stack.extend(reversed(node.children))
+
+    def first(self, **criteria):
+        return next(self.iter(**criteria), None)
+
+    def last(self, **criteria):
+        found = None
+        for found in self.iter(**criteria):
+            pass
+        return found
+
+    @staticmethod
+    def wrapper(node):
+        from pywinauto.uia_element_info import UIAElementInfo
+        return UIAWrapper(UIAElementInfo(node.element))
+
+
+def snapshot_elements(root):
+    """Snapshot the subtree of a UIA element in one cached request; None if unavailable."""
+    try:
+        iuia = IUIA()
+        uia, dll = iuia.iuia, iuia.UIA_dll
+        element = _as_wrapper(root).element_info.element
+        cr = uia.CreateCacheRequest()
+        for prop in (dll.UIA_NamePropertyId, dll.UIA_ControlTypePropertyId, dll.UIA_AutomationIdPropertyId,
+                     dll.UIA_BoundingRectanglePropertyId, dll.UIA_IsEnabledPropertyId):
+            cr.AddProperty(prop)
+        cr.TreeScope = dll.TreeScope_Subtree
+        skip = [uia.CreatePropertyCondition(dll.UIA_ControlTypePropertyId, iuia.known_control_types[t])
+                for t in SNAPSHOT_SKIP_TYPES]
+        cr.TreeFilter = uia.CreateAndCondition(
+            uia.ControlViewCondition, uia.CreateNotCondition(uia.CreateOrConditionFromArray(skip)))
+        UIA_CALLS["count"] += 1
+        snap = ElementSnapshot(element.BuildUpdatedCache(cr))
+    except Exception as e:
+        logging.info(f"UIA snapshot unavailable, using live search: {e}")
+        return None
+    logging.info(f"UIA snapshot: {snap.size} elements in one request")
+    return snap
+
+
+def _press_snapshot_button(snap, exact, prefixes) -> bool:
+    """Invoke (or focus+space) the first Button named one of `exact`, else starting with `prefixes`."""
+    exact = [x.lower() for x in exact]
+    node = (snap.first(control_type="Button", prune=BULK_CONTAINERS, name=lambda t: t in exact)
+            or snap.first(control_type="Button", prune=BULK_CONTAINERS, name=lambda t: t.startswith(prefixes)))
+    if node is None:
+        return False
+    w = snap.wrapper(node)
+    try:
+        w.invoke(); return True
+    except Exception:
+        pass
+    try:
+        w.set_focus(); send_keys(" "); return True
+    except Exception:
+        return False
+
+
 def get_tree(win):
     try:
         tr = win.child_window(control_type="Tree")
@@ -109,12 +745,9 @@ def get_tree(win):
             return tr.wrapper_object()
     except Exception:
         pass
-    for c in win.descendants():
-        try:
-            if c.element_info.control_type == "Tree":
-                return c.wrapper_object()
-        except Exception:
-            pass
+    tr = first_element(win, control_type="Tree")
+    if tr is not None:
+        return tr
     # Fallback: focus right pane so keystrokes can work later
     try:
         win.set_focus()
@@ -126,14 +759,166 @@ def get_tree(win):
         pass
     raise RuntimeError("Brand/ECU list not found. Ensure main screen visible; Windows scaling 100%.")
 
-def select_brand_ecu_ui(tree, brand: str, ecu: str):
-    logging.info(f"selecting brand={brand} ecu={ecu}")
-    eff_brand = effective_brand(brand)
-    b = eff_brand.strip().lower()
-    e = ecu.strip().lower()
-    if not b or not e:
-        raise ValueError("brand and ecu required")
+# --- Brand/ECU catalog index ---
+# Walking the whole brand tree over UIA costs thousands of cross-process calls,
+# so the tree is indexed once and persisted. Each entry is the exact text path
+# from a root to a node, in tree order; selection becomes tree.get_item(path),
+# which only expands the nodes on that path. The index is rebuilt when the
+# DaVinci executable or the number of tree roots changes (checked on every task,
+# without expanding anything), and when a lookup misses or its path no longer
+# resolves (the lookup is then retried once on the fresh index).
+CATALOG_PATH = Path("C:/davinci_automation/brand_ecu_catalog.json")
+CATALOG_BRAND_DEPTH = 2  # roots + their children: what the linear scan could match as a brand
+
+
+def _tree_shape(tree) -> str:
+    """Cheap fingerprint of the tree: the number of roots (nothing is expanded or read)."""
+    return f"roots={len(tree.roots())}"
+
 
+class BrandEcuCatalog:
+    """Persisted index of the brand/ECU tree: normalized text -> node text path."""
+
+    def __init__(self, path: Path = CATALOG_PATH):
+        self.path = path
+        self.version = None
+        self.shape = None
+        self.items = []  # [[root_text, ..., node_text], ...] in tree order
+
+    def load(self, version: str, shape: str) -> bool:
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return False
+        if data.get("version") != version or data.get("shape") != shape:
+            logging.info("brand/ECU catalog is stale (DaVinci version or tree shape changed)")
+            return False
+        self.version, self.shape, self.items = version, shape, data.get("items") or []
+        return bool(self.items)
+
+    def save(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps({"version": self.version, "shape": self.shape, "items": self.items}),
+                           encoding="utf-8")
+            tmp.replace(self.path)
+        except OSError as e:
+            logging.warning(f"Could not persist brand/ECU catalog: {e}")
+
+    def invalidate(self):
+        self.items = []
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
+
+    def build(self, tree, version: str, shape: str):
+        """Walk the whole tree once, expanding branches so lazily-loaded children appear."""
+        t0 = time.time()
+        items = []
+
+        def walk(node, prefix):
+            try:
+                text = node.window_text()
+            except Exception:
+                return
+            path = prefix + [text]
+            items.append(path)
+            try:
+                node.expand()
+            except Exception:
+                pass
+            try:
+                children = node.children()
+            except Exception:
+                children = []
+            for c in children:
+                walk(c, path)
+            if len(path) > 1 and children:
+                try: node.collapse()
+                except Exception: pass
+
+        for r in tree.roots():
+            walk(r, [])
+        self.version, self.shape, self.items = version, shape, items
+        self.save()
+        logging.info(f"brand/ECU catalog built: {len(items)} nodes in {time.time() - t0:.1f}s")
+
+    def find_brand(self, b: str):
+        """First brand-level path whose text equals or contains `b` (same rule as the tree scan)."""
+        for path in self.items:
+            if len(path) <= CATALOG_BRAND_DEPTH:
+                txt = path[-1].strip().lower()
+                if txt == b or b in txt:
+                    return path
+        return None
+
+    def find_ecu(self, brand_path, e: str):
+        n = len(brand_path)
+        for path in self.items:
+            if len(path) > n and path[:n] == brand_path:
+                txt = path[-1].strip().lower()
+                if txt == e or e in txt:
+                    return path
+        return None
+
+
+BRAND_ECU_CATALOG = BrandEcuCatalog()
+
+
+def _lookup_ecu_node(tree, b: str, e: str, exe: Path | None):
+    """Resolve the ECU node through the catalog; None means use the tree scan instead."""
+    cat = BRAND_ECU_CATALOG
+    try:
+        version, shape = exe_version(exe), _tree_shape(tree)
+    except Exception as ex:
+        logging.info(f"brand/ECU catalog skipped: {ex}")
+        return None
+    status = "hit"
+    if not (cat.items and cat.version == version and cat.shape == shape) and not cat.load(version, shape):
+        status = "built"
+        if not _rebuild_catalog(cat, tree, version, shape):
+            return None
+    while True:
+        brand_path = cat.find_brand(b)
+        ecu_path = cat.find_ecu(brand_path, e) if brand_path else None
+        node, problem = None, None
+        if ecu_path is None:
+            problem = "has no entry"
+        else:
+            try:
+                node = tree.get_item(ecu_path, exact=True)
+                if node is None:
+                    raise IndexError("tree is empty")
+            except Exception as ex:
+                problem = f"path {ecu_path} no longer resolves ({ex})"
+        if node is not None:
+            stage_note(catalog=status)
+            return node
+        if status != "hit":
+            # A fresh index does not know it either: a bad brand/ECU; let the scan decide
+            logging.info(f"brand/ECU catalog {problem} for {b}/{e}; falling back to tree scan")
+            stage_note(catalog="miss")
+            return None
+        logging.info(f"brand/ECU catalog {problem} for {b}/{e}; re-indexing")
+        status = "rebuilt"
+        if not _rebuild_catalog(cat, tree, version, shape):
+            return None
+
+
+def _rebuild_catalog(cat, tree, version: str, shape: str) -> bool:
+    try:
+        cat.build(tree, version, shape)
+        return True
+    except Exception as ex:
+        logging.warning(f"brand/ECU catalog build failed: {ex}")
+        cat.items = []
+        return False
+
+
+def _scan_ecu_node(tree, b: str, e: str, eff_brand: str, ecu: str):
+    """Linear scan of the expanded tree for the brand, then the ECU beneath it."""
     # Expand roots
     try:
         for r in tree.roots():
@@ -143,14 +928,7 @@ def select_brand_ecu_ui(tree, brand: str, ecu: str):
         pass
 
     # Locate brand
-    brand_node = None
-    for n in tree.descendants():
-        try:
-            txt = n.window_text().strip().lower()
-            if txt == b or b in txt:
-                brand_node = n; break
-        except Exception:
-            pass
+    brand_node = first_element(tree, name=lambda txt: txt == b or b in txt)
     if not brand_node:
         msg = f"Brand not found in DaVinci tree: {eff_brand}"
         logging.error(f"AUTOMATION_ERROR: {msg}")
@@ -161,22 +939,32 @@ def select_brand_ecu_ui(tree, brand: str, ecu: str):
         brand_node.select(); brand_node.expand()
     except Exception:
         pass
-    time.sleep(0.2)
 
-    # Locate ECU under brand
-    ecu_node = None
-    for d in brand_node.descendants():
-        try:
-            txt = d.window_text().strip().lower()
-            if txt == e or e in txt:
-                ecu_node = d; break
-        except Exception:
-            pass
+    # Locate ECU under brand (its children appear once the expansion is done)
+    ecu_node = wait_until(lambda: first_element(brand_node, name=lambda txt: txt == e or e in txt),
+                          timeout=2.0, budget=0.2, label="ECU under brand")
     if not ecu_node:
         msg = f"ECU not found under {eff_brand}: {ecu}"
         logging.error(f"AUTOMATION_ERROR: {msg}")
         print(f"AUTOMATION_ERROR: {msg}")
         raise RuntimeError(msg)
+    return ecu_node
+
+
+def select_brand_ecu_ui(tree, brand: str, ecu: str, exe: Path | None = None):
+    logging.info(f"selecting brand={brand} ecu={ecu}")
+    eff_brand = effective_brand(brand)
+    b = eff_brand.strip().lower()
+    e = ecu.strip().lower()
+    if not b or not e:
+        raise ValueError("brand and ecu required")
+
+    ecu_node = _lookup_ecu_node(tree, b, e, exe)
+    if ecu_node is None:
+        ecu_node = _scan_ecu_node(tree, b, e, eff_brand, ecu)
+        if BRAND_ECU_CATALOG.items:
+            # The scan found what the index did not: rebuild it next time
+            BRAND_ECU_CATALOG.invalidate()
 
     # Double-click ECU to trigger the Open dialog
     try:
@@ -187,21 +975,20 @@ def select_brand_ecu_ui(tree, brand: str, ecu: str):
         cx = int((rect.left + rect.right) / 2)
         cy = int((rect.top + rect.bottom) / 2)
         ecu_node.double_click_input(coords=(cx - rect.left, cy - rect.top))
-    time.sleep(0.7)
-
-    # After double-click, a confirmation popup may appear; press Enter to dismiss it
-    time.sleep(0.5)
-    try:
-        send_keys("{ENTER}")
-    except Exception:
-        pass
 
-    # Sometimes a second confirmation appears or focus is elsewhere; press Enter again and try closing info dialog.
-    time.sleep(0.3)
-    try:
-        send_keys("{ENTER}")
-    except Exception:
-        pass
+    # After double-click, a confirmation popup may appear; press Enter to dismiss it.
+    # Sometimes a second confirmation appears or focus is elsewhere; press Enter again.
+    # Each Enter goes out as soon as a popup shows (at the latest when the old fixed
+    # delay ran out); both are skipped once the Open dialog itself is up.
+    for delay in (1.2, 0.3):
+        info = wait_for_dialog(["info", "yes_popup", "open_dialog", "legacy_dialog", "file_dialog", "open_like"],
+                               timeout=delay, poll=0.1, budget=delay)
+        if info is not None and not info.kinds & {"info", "yes_popup"}:
+            break
+        try:
+            send_keys("{ENTER}")
+        except Exception:
+            pass
     # Attempt to close any 'Info' blocker that may have appeared
     try:
         maybe_close_info_dialog(timeout=3)
@@ -213,19 +1000,18 @@ def select_brand_ecu_keys(win, brand: str, ecu: str):
     logging.info(f"selecting brand={brand} ecu={ecu}")
     win.set_focus()
     send_keys("{HOME}")
-    time.sleep(0.1)
+    wait_settled(win, quiet_ms=100, timeout=1.0, budget=0.1, label="tree home")
     eff_brand = effective_brand(brand)
     send_keys(eff_brand, with_spaces=True, pause=0.02)
     send_keys("{ENTER}")
     send_keys("{RIGHT}")
-    time.sleep(0.2)
+    wait_settled(win, quiet_ms=100, timeout=1.5, budget=0.2, label="brand expanded")
     send_keys(ecu, with_spaces=True, pause=0.02)
     # Double-click via keyboard: ENTER twice
     send_keys("{ENTER}")
-    time.sleep(0.15)
+    wait_settled(win, quiet_ms=100, timeout=1.0, budget=0.15, label="ecu activated")
     send_keys("{ENTER}")
-    time.sleep(0.2)
-    # Dismiss the first info dialog that appears after ECU activation
+    # Dismiss the first info dialog that appears after ECU activation (waits for it)
     try:
         maybe_close_info_dialog(timeout=3)
     except Exception:
@@ -234,62 +1020,150 @@ def select_brand_ecu_keys(win, brand: str, ecu: str):
 
 def maybe_close_info_dialog(timeout=6):
     """Close blocking info dialogs (e.g., 'BDM READ IS REQUIRED') so the Open dialog can appear."""
-    t0 = time.time()
-    while time.time() - t0 < timeout:
-        # Common 'Info' dialog titles
-        for title in ["INFO", "Info", "Information"]:
-            try:
-                dlg = Desktop(backend="uia").window(title=title, control_type="Window")
-                if dlg.exists(timeout=0.2):
-                    try:
-                        dlg.set_focus()
-                    except Exception:
-                        pass
-                    # Click OK if present, otherwise press Enter
-                    try:
-                        ok = dlg.child_window(title_re="^(OK|Ok|ok)$", control_type="Button")
-                        if ok.exists(timeout=0.2):
-                            ok.click_input()
-                        else:
-                            send_keys("{ENTER}")
-                    except Exception:
-                        send_keys("{ENTER}")
-                    time.sleep(0.2)
-                    return True
-            except Exception:
-                pass
-        # Fallback: scan any dialog containing specific message text
+    info = wait_for_dialog(["info"], timeout, poll=0.2)
+    if info is None:
+        return False
+    # Click OK if present, otherwise press Enter
+    _press_button_or_keys(info, OK_LABELS, "{ENTER}")
+    wait_gone(info.wrapper, timeout=2, budget=0.2, label="info dialog closed")
+    return True
+
+
+# --- Dialog text I/O ---
+# The File name field is read and written directly: the UIA ValuePattern of the
+# edit, or WM_GETTEXT/WM_SETTEXT on control 1148 of the #32770 dialog. Ctrl+A/C
+# through the clipboard and typed keystrokes are only the last resort.
+# TEXT_IO_PATHS counts which path served each read/write; the running stage
+# gets the same counts under "text_io".
+FILENAME_CTRL_ID = 1148
+TEXT_IO_PATHS = {}
+
+def _note_text_io(op: str, path: str):
+    key = f"{op}:{path}"
+    TEXT_IO_PATHS[key] = TEXT_IO_PATHS.get(key, 0) + 1
+    if _STAGE_STACK:
+        counts = _STAGE_STACK[-1].setdefault("text_io", {})
+        counts[key] = counts.get(key, 0) + 1
+    logging.info(f"dialog filename {op} via {path}")
+
+def _filename_hwnd(dlg):
+    """HWND of the edit behind control 1148 of a #32770 dialog, or None."""
+    try:
+        import win32gui
+        ctrl = win32gui.GetDlgItem(_as_wrapper(dlg).handle, FILENAME_CTRL_ID)
+    except Exception:
+        return None
+    if not ctrl:
+        return None
+    if win32gui.GetClassName(ctrl) == "Edit":
+        return ctrl
+    # Newer dialogs wrap the edit in a ComboBox(Ex)
+    edits = []
+
+    def collect(h, _):
+        if win32gui.GetClassName(h) == "Edit":
+            edits.append(h)
+        return True
+    try:
+        win32gui.EnumChildWindows(ctrl, collect, None)
+    except Exception:
+        pass
+    return edits[0] if edits else ctrl
+
+def read_dialog_filename(dlg, edit=None) -> str:
+    """Current text of the File name field ('' if unreadable)."""
+    edit = edit if edit is not None else find_filename_edit(dlg)
+    if edit is not None:
         try:
-            for w in Desktop(backend="uia").windows():
-                try:
-                    txt = (w.window_text() or "").lower()
-                except Exception:
-                    txt = ""
-                if "bdm read is required" in txt:
-                    try:
-                        w.set_focus()
-                    except Exception:
-                        pass
-                    try:
-                        ok = w.child_window(title_re="^(OK|Ok|ok)$", control_type="Button")
-                        if ok.exists(timeout=0.2):
-                            ok.click_input()
-                        else:
-                            send_keys("{ENTER}")
-                    except Exception:
-                        send_keys("{ENTER}")
-                    time.sleep(0.2)
-                    return True
+            value = (edit.iface_value.CurrentValue or "").strip()
+            if value:
+                _note_text_io("read", "value_pattern")
+                return value
         except Exception:
             pass
-        time.sleep(0.2)
-    return False
+    hwnd = _filename_hwnd(dlg)
+    if hwnd:
+        try:
+            from pywinauto import handleprops
+            value = (handleprops.text(hwnd) or "").strip()
+            if value:
+                _note_text_io("read", "wm_gettext")
+                return value
+        except Exception:
+            pass
+    # Clipboard fallback (Ctrl+A, Ctrl+C)
+    try:
+        if edit is not None:
+            edit.set_focus()
+        send_keys("^a^c")
+        time.sleep(0.06)
+        value = (clipboard.GetData() or "").strip()
+        if value:
+            _note_text_io("read", "clipboard")
+            return value
+    except Exception:
+        pass
+    if edit is not None:
+        try:
+            value = (edit.window_text() or "").strip()
+            if value:
+                _note_text_io("read", "window_text")
+                return value
+        except Exception:
+            pass
+    return ""
+
+def write_dialog_filename(dlg, text: str, edit=None) -> bool:
+    """Replace the File name field with `text`; verified by reading it back."""
+    edit = edit if edit is not None else find_filename_edit(dlg)
+    if edit is not None:
+        try:
+            edit.iface_value.SetValue(text)
+            if (edit.iface_value.CurrentValue or "") == text:
+                _note_text_io("write", "value_pattern")
+                return True
+        except Exception:
+            pass
+    hwnd = _filename_hwnd(dlg)
+    if hwnd:
+        try:
+            import win32con, win32gui
+            from pywinauto import handleprops
+            win32gui.SendMessage(hwnd, win32con.WM_SETTEXT, 0, text)
+            if handleprops.text(hwnd) == text:
+                _note_text_io("write", "wm_settext")
+                return True
+        except Exception:
+            pass
+    # Keystrokes, last resort
+    try:
+        if edit is not None:
+            edit.set_focus()
+        send_keys("^a{BACKSPACE}")
+        time.sleep(0.05)
+        send_keys(text, with_spaces=True)
+        _note_text_io("write", "keystrokes")
+        return True
+    except Exception:
+        return False
 
 
 # Helper: type folder and filename into the Open dialog's File name input, then submit
 def type_folder_and_filename(folder: str, filename: str):
-    """Assumes focus is already in the 'File name' input. Types full path, then TAB and ENTER."""
+    """Put the full path into the Open dialog's 'File name' input and submit.
+
+    Written directly into the field and confirmed with the Open button when the
+    dialog can be found; otherwise typed into the focused input, then TAB and ENTER.
+    """
     full_path = str(Path(folder) / filename)
+    dlg = find_any_open_dialog()
+    if dlg is not None:
+        edit = find_filename_edit(dlg)
+        if edit is not None or _filename_hwnd(dlg):
+            if write_dialog_filename(dlg, full_path, edit):
+                _accept_open_dialog(dlg)
+                return
+    _note_text_io("write", "keystrokes")
     try:
         # Clear any existing text first
         send_keys("^a{BACKSPACE}")
@@ -317,38 +1191,11 @@ def wait_for_save_dialog_then_prepend_modified(modified_dir=r"C:\ecu_files\modif
                 time.sleep(0.2)
                 continue
             # Try to locate the 'File name' edit (usually the last Edit control)
-            edit = None
-            try:
-                edits = dlg.descendants(control_type="Edit")
-                if edits:
-                    edit = edits[-1]
-            except Exception:
-                edit = None
+            edit = last_element(dlg, control_type="Edit", prune=BULK_CONTAINERS)
             if not edit:
                 time.sleep(0.2)
                 continue
-            # Focus and read current value
-            try:
-                edit.set_focus()
-            except Exception:
-                pass
-            time.sleep(0.05)
-            # Copy text from the edit; fall back to .get_value() / window_text()
-            current_text = ""
-            try:
-                send_keys("^a^c")
-                time.sleep(0.05)
-                current_text = (clipboard.GetData() or "").strip()
-            except Exception:
-                pass
-            if not current_text:
-                try:
-                    current_text = (edit.get_value() or "").strip()
-                except Exception:
-                    try:
-                        current_text = (edit.window_text() or "").strip()
-                    except Exception:
-                        current_text = ""
+            current_text = read_dialog_filename(dlg, edit)
             # If there's no filename yet, keep watching
             if not current_text:
                 time.sleep(0.2)
@@ -364,14 +1211,9 @@ def wait_for_save_dialog_then_prepend_modified(modified_dir=r"C:\ecu_files\modif
             # Build the new full path in the modified folder
             full_out = str(Path(modified_dir) / fname)
             # Replace the text and submit
-            try:
-                send_keys("^a{BACKSPACE}")
-                time.sleep(0.05)
-            except Exception:
-                pass
-            send_keys(full_out, with_spaces=True)
-            time.sleep(0.05)
-            send_keys("{TAB}{ENTER}")
+            write_dialog_filename(dlg, full_out, edit)
+            if not _accept_save_dialog(dlg):
+                send_keys("{TAB}{ENTER}")
             logging.info(f"Save dialog handled: wrote {full_out}")
             return True
         except Exception:
@@ -390,31 +1232,29 @@ def invoke_open_dialog(win):
     # 1) Try UIA menu search for 'File' -> 'Open'
     try:
         # Some DaVinci builds expose a MenuBar with MenuItems
-        menubars = win.descendants(control_type="MenuBar")
-        for mb in menubars:
+        for mb in walk_elements(win, control_type="MenuBar", prune=BULK_CONTAINERS):
             try:
-                file_menu = None
-                for mi in mb.descendants(control_type="MenuItem"):
-                    name = (mi.window_text() or "").lower()
-                    if name in ["file", "&file", "archivo", "datei", "fichier", "файл", "文件", "arquivo"]:
-                        file_menu = mi
-                        break
+                file_menu = first_element(
+                    mb, control_type="MenuItem",
+                    name=lambda n: n in ["file", "&file", "archivo", "datei", "fichier", "файл", "文件", "arquivo"],
+                )
                 if file_menu:
                     try:
                         file_menu.select()
                     except Exception:
                         file_menu.click_input()
-                    time.sleep(0.2)
                     # find Open-like item
-                    for mi in file_menu.descendants(control_type="MenuItem"):
-                        n = (mi.window_text() or "").lower()
-                        if any(k in n for k in ["open", "öffnen", "abrir", "ouvrir", "открыть", "打开"]):
-                            try:
-                                mi.select()
-                            except Exception:
-                                mi.click_input()
-                            time.sleep(0.6)
-                            return True
+                    mi = wait_exists(lambda: first_element(
+                        file_menu, control_type="MenuItem",
+                        name=lambda n: any(k in n for k in ["open", "öffnen", "abrir", "ouvrir", "открыть", "打开"]),
+                    ), timeout=1.0, budget=0.2, label="Open menu item")
+                    if mi is not None:
+                        try:
+                            mi.select()
+                        except Exception:
+                            mi.click_input()
+                        wait_for_dialog(OPEN_DIALOG_KINDS, timeout=0.6, budget=0.6)
+                        return True
             except Exception:
                 continue
     except Exception:
@@ -423,21 +1263,24 @@ def invoke_open_dialog(win):
     # 2) Keyboard menu accelerator: Alt+F then O
     try:
         send_keys("%fo")
-        time.sleep(0.6)
+        if wait_for_dialog(OPEN_DIALOG_KINDS, timeout=0.6, budget=0.6) is not None:
+            return True
     except Exception:
         pass
 
     # 3) Ctrl+O as last resort
     try:
         send_keys("^o")
-        time.sleep(0.6)
+        if wait_for_dialog(OPEN_DIALOG_KINDS, timeout=0.6, budget=0.6) is not None:
+            return True
     except Exception:
         pass
     return False
 
 def nudge_open_dialog(win, retries=3):
     """Proactively try to surface the Open dialog if the app swallowed the first double-click.
-    Sends ENTER (confirm), CTRL+O (common Open shortcut), and attempts to dismiss any 'Info' dialog."""
+    Sends ENTER (confirm), CTRL+O (common Open shortcut), and attempts to dismiss any 'Info' dialog.
+    Returns True as soon as an Open dialog is up."""
     logging.info("nudging for Open dialog")
     try:
         win.set_focus()
@@ -447,7 +1290,8 @@ def nudge_open_dialog(win, retries=3):
         try:
             # Confirm/advance any blocking prompt
             send_keys("{ENTER}")
-            time.sleep(0.25)
+            if wait_exists(find_any_open_dialog, timeout=0.25, budget=0.25, label="open dialog after ENTER"):
+                return True
             # Try common File→Open shortcut
             send_keys("^o")
             try:
@@ -458,145 +1302,429 @@ def nudge_open_dialog(win, retries=3):
             pass
         # Close possible info dialog
         try:
-            maybe_close_info_dialog(timeout=0.6)
+            maybe_close_info_dialog(timeout=0.6)
+        except Exception:
+            pass
+        if wait_exists(find_any_open_dialog, timeout=0.6, budget=0.6, label="open dialog after nudge"):
+            return True
+    return False
+
+
+# Helper to find an embedded Open dialog within the DaVinci window
+def find_open_dialog_within(win):
+    """Some builds host the file picker as a child Pane/Window inside the main window.
+    Search within the DaVinci window for a container having an Edit ('File name') and an 'Open' button.
+
+    One walk: each Edit/Button marks its Window/Pane/Group ancestors, and the walk
+    stops at the first container that has an Edit plus an Open button or a
+    'File name' edit (outermost such container, Window before Pane before Group).
+    """
+    open_keys = ["open", "öffnen", "abrir", "ouvrir", "открыть", "打开"]
+    filename_keys = ["file name", "dateiname", "nombre", "nome", "nome do arquivo", "nome del file", "имя файла"]
+    containers = ("Window", "Pane", "Group")
+    stack = []  # [depth, elem, control_type, has_edit, has_open_btn, has_filename]
+    try:
+        for elem, depth in walk_elements(win, control_type=containers + ("Edit", "Button"),
+                                         prune=BULK_CONTAINERS, with_depth=True):
+            while stack and stack[-1][0] >= depth:
+                stack.pop()
+            ct = _control_type(elem)
+            if ct in containers:
+                stack.append([depth, elem, ct, False, False, False])
+                continue
+            try:
+                text = (elem.window_text() or "").lower()
+            except Exception:
+                text = ""
+            for entry in stack:
+                if ct == "Edit":
+                    entry[3] = True
+                    if any(k in text for k in filename_keys):
+                        entry[5] = True
+                elif any(k in text for k in open_keys):
+                    entry[4] = True
+            ready = [entry for entry in stack if entry[3] and (entry[4] or entry[5])]
+            if ready:
+                for ct_pref in containers:
+                    for entry in ready:
+                        if entry[2] == ct_pref:
+                            return entry[1]
+    except Exception:
+        pass
+    return None
+
+# --- Desktop scanner ---
+# One enumeration of the top-level windows per polling tick. Each window is
+# described once (title, class, buttons/edits/texts from a single bounded walk,
+# fetched lazily) and classified by the shared DIALOG_RULES table; the
+# wait/find helpers below all consume the resulting DesktopSnapshot.
+# Controls are only walked for dialog-like windows, and a window's control
+# lists are reused for CONTROL_CACHE_TTL seconds while its handle and title
+# stay the same, so a wait polling every 0.1 s does not re-walk every tick.
+CONTROL_CACHE_TTL = 1.0
+_CONTROL_CACHE = {}    # (backend, handle) -> (title, expires, controls)
+OPEN_BUTTON_KEYS   = ["open", "öffnen", "abrir", "ouvrir", "открыть", "打开"]
+SAVE_BUTTON_KEYS   = ["save", "speichern", "guardar", "salvar"]
+FILENAME_KEYS      = ["file name", "dateiname", "nombre", "nome", "имя файла"]
+INFO_TITLES        = ["INFO", "Info", "Information"]
+OVERWRITE_KEYS     = ["confirm save as", "overwrite", "replace", "bestätigen"]
+YES_LABELS         = ["Yes", "&Yes", "Ja", "Sí", "Да"]
+OK_LABELS          = ["OK", "Ok", "ok"]
+
+
+class WindowInfo:
+    """One top-level window (or a dialog hosted directly under DaVinci's main window)."""
+
+    def __init__(self, wrapper, backend: str):
+        self.wrapper = wrapper
+        self.backend = backend
+        try:
+            self.title = (wrapper.window_text() or "").strip()
+        except Exception:
+            self.title = ""
+        self.title_l = self.title.lower()
+        try:
+            self.class_name = wrapper.element_info.class_name or ""
+        except Exception:
+            self.class_name = ""
+        self._controls = None
+        self.kinds = set()
+        self.hosted = False   # a dialog hosted under DaVinci's main window
+
+    def _dialog_like(self) -> bool:
+        return self.hosted or self.class_name == "#32770" or self.is_dialog()
+
+    def _load_controls(self):
+        if self._controls is None:
+            if not self._dialog_like():
+                self._controls = {"buttons": [], "edits": [], "texts": []}
+                return self._controls
+            try:
+                key = (self.backend, self.wrapper.handle)
+            except Exception:
+                key = None
+            now = time.monotonic()
+            hit = _CONTROL_CACHE.get(key) if key else None
+            if hit and hit[0] == self.title and hit[1] > now:
+                self._controls = hit[2]
+                return self._controls
+            buttons, edits, texts = [], [], []
+            try:
+                for c in walk_elements(self.wrapper, control_type=("Button", "Edit", "Text", "Static"),
+                                       prune=BULK_CONTAINERS):
+                    ct = _control_type(c)
+                    if ct == "Button":
+                        buttons.append(c)
+                    elif ct == "Edit":
+                        edits.append(c)
+                    elif ct in ("Text", "Static"):
+                        texts.append(c)
+            except Exception:
+                pass
+            self._controls = {"buttons": buttons, "edits": edits, "texts": texts}
+            if key:
+                for k in [k for k, v in _CONTROL_CACHE.items() if v[1] <= now]:
+                    del _CONTROL_CACHE[k]
+                _CONTROL_CACHE[key] = (self.title, now + CONTROL_CACHE_TTL, self._controls)
+        return self._controls
+
+    @property
+    def buttons(self):
+        return self._load_controls()["buttons"]
+
+    @property
+    def edits(self):
+        return self._load_controls()["edits"]
+
+    def button_names(self):
+        controls = self._load_controls()
+        if "button_names" not in controls:
+            names = []
+            for b in controls["buttons"]:
+                try:
+                    names.append((b.window_text() or "").strip())
+                except Exception:
+                    names.append("")
+            controls["button_names"] = names
+        return controls["button_names"]
+
+    def text_values(self):
+        controls = self._load_controls()
+        if "text_values" not in controls:
+            vals = []
+            for t in controls["texts"]:
+                try:
+                    vals.append((t.window_text() or "").strip().lower())
+                except Exception:
+                    pass
+            controls["text_values"] = vals
+        return controls["text_values"]
+
+    def button(self, labels):
+        """First button whose caption is exactly one of `labels`."""
+        for b, name in zip(self.buttons, self.button_names()):
+            if name in labels:
+                return b
+        return None
+
+    def is_dialog(self) -> bool:
+        try:
+            return bool(self.wrapper.is_dialog())
+        except Exception:
+            return False
+
+    def is_visible(self) -> bool:
+        try:
+            return bool(self.wrapper.is_visible())
+        except Exception:
+            return True
+
+    def spec(self):
+        """A WindowSpecification for this window (child_window()/exists() available)."""
+        try:
+            return Desktop(backend=self.backend).window(handle=self.wrapper.handle)
+        except Exception:
+            return self.wrapper
+
+
+def _title_matches(info: WindowInfo, hints) -> bool:
+    return any(re.match(h, info.title) for h in hints)
+
+def _has_button(info: WindowInfo, keys, startswith=False) -> bool:
+    for n in info.button_names():
+        n = n.lower()
+        if (n.startswith(tuple(keys)) if startswith else any(k in n for k in keys)):
+            return True
+    return False
+
+# (kind, predicate) — every matching kind is attached to the window
+DIALOG_RULES = [
+    ("davinci_main",      lambda i: i.backend == "uia" and _title_matches(i, MAIN_TITLES)),
+    ("overwrite_confirm", lambda i: any(k in i.title_l for k in OVERWRITE_KEYS)),
+    ("info",              lambda i: i.backend == "uia" and (i.title in INFO_TITLES or "bdm read is required" in i.title_l)),
+    ("save_dialog",       lambda i: i.backend == "uia" and (_title_matches(i, SAVE_HINTS) or (
+                              i.is_dialog() and "open" not in i.title_l and _has_button(i, ["save"], startswith=True)))),
+    ("open_dialog",       lambda i: i.backend == "uia" and _title_matches(i, OPEN_HINTS)),
+    ("legacy_dialog",     lambda i: i.backend == "win32" and i.class_name == "#32770"),
+    ("file_dialog",       lambda i: i.class_name == "#32770" or (
+                              bool(i.edits) and _has_button(i, OPEN_BUTTON_KEYS + SAVE_BUTTON_KEYS))),
+    ("open_like",         lambda i: i.is_visible() and ((bool(i.edits) and _has_button(i, OPEN_BUTTON_KEYS))
+                              or any(k in t for t in i.text_values() for k in FILENAME_KEYS))),
+    ("yes_popup",         lambda i: i.button(YES_LABELS) is not None),
+]
+# Rules that need controls are skipped for the DaVinci main window itself; its
+# hosted dialogs are described as separate entries instead.
+_TITLE_ONLY_KINDS = {"davinci_main", "overwrite_confirm", "info", "open_dialog", "legacy_dialog"}
+
+
+class DesktopSnapshot:
+    """Classified view of the desktop at one polling tick."""
+
+    def __init__(self, windows):
+        self.windows = windows
+
+    def all(self, kind: str):
+        return [w for w in self.windows if kind in w.kinds]
+
+    def first(self, kind: str):
+        for w in self.windows:
+            if kind in w.kinds:
+                return w
+        return None
+
+
+def _classify(info: WindowInfo, kinds=None, title_only=False):
+    for kind, rule in DIALOG_RULES:
+        if kinds is not None and kind not in kinds:
+            continue
+        if title_only and kind not in _TITLE_ONLY_KINDS:
+            continue
+        try:
+            if rule(info):
+                info.kinds.add(kind)
         except Exception:
             pass
-        time.sleep(0.6)
-
-
-# Helper to find an embedded Open dialog within the DaVinci window
-def find_open_dialog_within(win):
-    """Some builds host the file picker as a child Pane/Window inside the main window.
-    Search within the DaVinci window for a container having an Edit ('File name') and an 'Open' button."""
-    try:
-        # First, any child window/pane that looks like a file picker
-        candidates = []
-        for ct in ("Window", "Pane", "Group"):
-            try:
-                candidates.extend(win.descendants(control_type=ct))
-            except Exception:
-                continue
+    return info
 
-        # Heuristic scoring
-        for c in candidates:
-            try:
-                # must contain at least one Edit
-                edits = c.descendants(control_type="Edit")
-                if not edits:
-                    continue
+def scan_desktop(kinds=None) -> DesktopSnapshot:
+    """Enumerate the desktop once and classify every window.
 
-                # look for an 'Open' button sibling OR a combobox/toolbar that looks like the address bar
-                has_open_btn = False
-                for btn in c.descendants(control_type="Button"):
-                    name = (btn.window_text() or "").lower()
-                    if any(k in name for k in ["open", "öffnen", "abrir", "ouvrir", "открыть", "打开"]):
-                        has_open_btn = True
-                        break
-
-                # also accept if we find a 'File name' edit or filename label nearby
-                has_filename = False
-                for e in edits:
-                    nm = (e.window_text() or "").lower()
-                    if any(k in nm for k in ["file name", "dateiname", "nombre", "nome", "nome do arquivo", "nome del file", "имя файла"]):
-                        has_filename = True
-                        break
-
-                if has_open_btn or has_filename:
-                    return c.wrapper_object()
-            except Exception:
+    `kinds` restricts classification to the rules a caller needs, so windows are
+    only descended into when one of those rules looks at their controls.
+    """
+    return _classify_desktop(lambda: Desktop(backend="uia").windows(),
+                             lambda: Desktop(backend="win32").windows(class_name="#32770"), kinds)
+
+def _classify_desktop(uia_windows, win32_dialogs, kinds=None) -> DesktopSnapshot:
+    """scan_desktop() over the given enumerators (callables returning top-level wrappers)."""
+    wanted = set(kinds) if kinds else None
+    windows = []
+    try:
+        for w in uia_windows():
+            info = WindowInfo(w, "uia")
+            _classify(info, {"davinci_main"})
+            if "davinci_main" in info.kinds:
+                _classify(info, wanted, title_only=True)
+                windows.append(info)
+                # Modal dialogs owned by DaVinci are hosted as child windows in UIA
+                try:
+                    for child in w.children(control_type="Window"):
+                        hosted = WindowInfo(child, "uia")
+                        hosted.hosted = True
+                        windows.append(_classify(hosted, wanted))
+                except Exception:
+                    pass
                 continue
+            windows.append(_classify(info, wanted))
     except Exception:
         pass
-    return None
-
-def find_any_open_dialog():
-    """Return a wrapper for any likely Open-file dialog."""
-    # Known titles first
-    for hint in OPEN_HINTS:
+    if wanted is None or wanted & {"legacy_dialog", "file_dialog", "overwrite_confirm", "yes_popup"}:
         try:
-            d = Desktop(backend="uia").window(title_re=hint, control_type="Window")
-            if d.exists(timeout=0.2):
-                return d.wrapper_object()
+            for w in win32_dialogs():
+                windows.append(_classify(WindowInfo(w, "win32"), wanted))
         except Exception:
             pass
-
-    # Generic top-level detector
-    dlg = find_top_level_file_dialog()
-    if dlg is not None:
-        return dlg
-
-    # Heuristic over visible windows: must have Edit and an Open-like button
-    try:
-        for w in Desktop(backend="uia").windows():
-            try:
-                if not w.is_visible():
-                    continue
-            except Exception:
-                pass
-            try:
-                edits = w.descendants(control_type="Edit")
-                if not edits:
-                    continue
-                for btn in w.descendants(control_type="Button"):
-                    name = (btn.window_text() or "").lower()
-                    if any(k in name for k in ["open", "öffnen", "abrir", "ouvrir", "открыть", "打开"]):
-                        return w.wrapper_object()
-            except Exception:
-                continue
+    return DesktopSnapshot(windows)
+
+# --- Event-driven dialog detection ---
+# A background MTA thread subscribes to UIA window-opened and focus-changed
+# events; each event wakes whoever is waiting in wait_for_dialog(), which then
+# re-scans the desktop immediately. Plain polling at `poll` remains the fallback
+# when the subscription is unavailable or an event is missed.
+class DialogWatcher:
+    """Wakes dialog waits as soon as UIA reports a new window or a focus change."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._ready = threading.Event()
+        self._thread = None
+        self.active = False
+        self.events = 0
+
+    def _notify(self):
+        self.events += 1
+        self._event.set()
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return self.active
+        self._thread = threading.Thread(target=self._run, name="uia-events", daemon=True)
+        self._thread.start()
+        self._ready.wait(5)
+        return self.active
+
+    def _run(self):
+        try:
+            import comtypes
+            comtypes.CoInitializeEx(comtypes.COINIT_MULTITHREADED)
+            iuia = IUIA()
+            uia, dll = iuia.iuia, iuia.UIA_dll
+            watcher = self
+
+            class _OpenedHandler(comtypes.COMObject):
+                _com_interfaces_ = [dll.IUIAutomationEventHandler]
+
+                def HandleAutomationEvent(self, sender, event_id):
+                    watcher._notify()
+
+            class _FocusHandler(comtypes.COMObject):
+                _com_interfaces_ = [dll.IUIAutomationFocusChangedEventHandler]
+
+                def HandleFocusChangedEvent(self, sender):
+                    watcher._notify()
+
+            self._handlers = (_OpenedHandler(), _FocusHandler())
+            uia.AddAutomationEventHandler(
+                dll.UIA_Window_WindowOpenedEventId, uia.GetRootElement(),
+                dll.TreeScope_Subtree, None, self._handlers[0],
+            )
+            uia.AddFocusChangedEventHandler(None, self._handlers[1])
+            self.active = True
+            logging.info("UIA event watcher subscribed (window-opened, focus-changed)")
+        except Exception as e:
+            logging.info(f"UIA event watcher unavailable, polling only: {e}")
+            self._ready.set()
+            return
+        self._ready.set()
+        # Keep the MTA thread (and the handler objects) alive for the process lifetime
+        threading.Event().wait()
+
+    def wait(self, timeout: float) -> bool:
+        """Sleep up to `timeout`; returns early (True) when a UIA event arrived."""
+        fired = self._event.wait(timeout)
+        self._event.clear()
+        if fired:
+            # Let a burst of events settle into one re-scan
+            time.sleep(0.02)
+        return fired
+
+
+DIALOG_WATCHER = DialogWatcher()
+
+def wait_for_dialog(kinds, timeout: float, poll: float = 0.25, budget: float | None = None):
+    """Wait until a window classified as any of `kinds` exists; returns its WindowInfo or None.
+
+    Kinds are tried in the given order. Detection latency is one desktop scan
+    after the UIA event when the watcher is active, `poll` seconds otherwise.
+    """
+    DIALOG_WATCHER.ensure_started()
+    kinds = list(kinds)
+    t0 = time.time()
+    while True:
+        snap = scan_desktop(set(kinds))
+        for kind in kinds:
+            info = snap.first(kind)
+            if info is not None:
+                _record_wait(f"dialog '{info.title}' ({kind})", time.time() - t0, budget)
+                return info
+        remaining = timeout - (time.time() - t0)
+        if remaining <= 0:
+            _record_wait(f"dialog {'/'.join(kinds)} (none)", time.time() - t0, budget)
+            return None
+        DIALOG_WATCHER.wait(min(poll, remaining))
+
+def _press_button_or_keys(info: WindowInfo, labels, keys: str):
+    """Click the first button captioned with one of `labels`, else type `keys` (then ENTER)."""
+    try:
+        info.wrapper.set_focus()
     except Exception:
         pass
-
-    # Last resort: any visible window containing a 'File name' text label
+    btn = info.button(labels)
+    if btn is not None:
+        try:
+            btn.click_input()
+            return True
+        except Exception:
+            pass
     try:
-        for w in Desktop(backend="uia").windows():
-            try:
-                if not w.is_visible():
-                    continue
-            except Exception:
-                pass
-            try:
-                for t in w.descendants(control_type="Text"):
-                    txt = (t.window_text() or "").lower()
-                    if any(k in txt for k in ["file name", "dateiname", "nombre", "nome", "имя файла"]):
-                        return w.wrapper_object()
-            except Exception:
-                continue
+        info.wrapper.type_keys(keys)
     except Exception:
-        pass
+        try:
+            send_keys("{ENTER}")
+        except Exception:
+            pass
+    return True
 
+
+# Known titles first, then generic file pickers, then heuristics
+OPEN_DIALOG_KINDS = ["open_dialog", "legacy_dialog", "file_dialog", "open_like"]
+
+def find_any_open_dialog():
+    """Return a wrapper for any likely Open-file dialog."""
+    snap = scan_desktop(set(OPEN_DIALOG_KINDS))
+    for kind in OPEN_DIALOG_KINDS:
+        info = snap.first(kind)
+        if info is not None:
+            return info.wrapper
     return None
 
 
 # --- Save/Open dialog helpers ---
 def find_top_level_file_dialog():
     """Detect a common file dialog hosted as a top-level window (UIA or legacy)."""
-    # Legacy common dialog (#32770)
-    try:
-        dlg = Desktop(backend="win32").window(class_name="#32770")
-        if dlg.exists(timeout=0.2):
-            return dlg.wrapper_object()
-    except Exception:
-        pass
-    # UIA windows that look like file pickers (have Edit and an Open/Save button)
-    try:
-        for w in Desktop(backend="uia").windows():
-            try:
-                edits = w.descendants(control_type="Edit")
-            except Exception:
-                edits = []
-            if not edits:
-                continue
-            try:
-                for b in w.descendants(control_type="Button"):
-                    n = (b.window_text() or "").lower()
-                    if any(k in n for k in ["open", "öffnen", "abrir", "ouvrir", "открыть", "打开",
-                                            "save", "speichern", "guardar", "salvar"]):
-                        return w.wrapper_object()
-            except Exception:
-                continue
-    except Exception:
-        pass
-    return None
+    snap = scan_desktop({"legacy_dialog", "file_dialog"})
+    info = snap.first("legacy_dialog") or snap.first("file_dialog")
+    return info.wrapper if info is not None else None
 
 def _set_folder_via_address_bar(folder: Path):
     # Works in both Open/Save dialogs: Alt+D focuses address bar
@@ -606,63 +1734,88 @@ def _set_folder_via_address_bar(folder: Path):
     send_keys("{ENTER}")
     time.sleep(0.35)
 
-def _accept_open_dialog(dlg) -> bool:
-    """Activate Open without relying on Enter focus."""
+# --- Dialog accept strategies ---
+# Open/Save are pressed by one of several methods. Which one works depends on
+# the dialog, so each (role, title, class, button set) signature keeps per-method
+# success counts and latency in DIALOG_STRATEGY_PATH, and the historically
+# fastest method is tried first. A method counts as working once the dialog
+# closes, becomes disabled under a modal prompt, or an overwrite prompt shows.
+DIALOG_STRATEGY_PATH = Path("C:/davinci_automation/dialog_strategies.json")
+ACCEPT_VERIFY_TIMEOUT = 2.0
+ACCEPT_GRACE_TIMEOUT = 3.0  # extra wait for the dialog to close before escalating to the next method
+ACCEPT_SPECS = {
+    "open": {"variants": ["Open", "&Open", "Öffnen", "Abrir", "Открыть"],
+             "prefixes": ("open", "öffnen", "abrir", "откры"), "mnemonic": "%o", "enter": True},
+    "save": {"variants": ["Save", "&Save", "Speichern", "Guardar", "Сохранить", "Salvar"],
+             "prefixes": ("save",), "mnemonic": "%s", "enter": False},
+}
+
+
+def _invoke_or_space(w) -> bool:
     try:
-        dlg.set_focus()
+        if hasattr(w, "invoke"):
+            w.invoke(); return True
     except Exception:
         pass
-    variants = ["Open", "&Open", "Öffnen", "Abrir", "Открыть"]
     try:
-        for lab in variants:
-            try:
-                btn = dlg.child_window(title=lab, control_type="Button")
-                if btn.exists():
-                    w = btn.wrapper_object()
-                    try:
-                        if hasattr(w, "invoke"):
-                            w.invoke(); return True
-                    except Exception:
-                        pass
-                    try:
-                        w.set_focus(); send_keys(" "); return True
-                    except Exception:
-                        pass
-            except Exception:
-                continue
-        for b in dlg.descendants(control_type="Button"):
-            try:
-                t = (b.window_text() or "").strip().lower()
-                if t.startswith("open") or t.startswith("öffnen") or t.startswith("abrir") or t.startswith("откры"):
-                    w = b.wrapper_object()
-                    try:
-                        if hasattr(w, "invoke"):
-                            w.invoke(); return True
-                    except Exception:
-                        pass
-                    try:
-                        w.set_focus(); send_keys(" "); return True
-                    except Exception:
-                        pass
-            except Exception:
-                continue
+        w.set_focus(); send_keys(" "); return True
     except Exception:
-        pass
+        return False
+
+def _accept_by_snapshot(dlg, snap, spec) -> bool:
+    return snap is not None and _press_snapshot_button(snap, spec["variants"], spec["prefixes"])
+
+def _accept_by_named_button(dlg, snap, spec) -> bool:
+    if snap is not None:
+        return False  # the snapshot already covered these buttons
+    for lab in spec["variants"]:
+        try:
+            btn = dlg.child_window(title=lab, control_type="Button")
+            if btn.exists() and _invoke_or_space(btn.wrapper_object()):
+                return True
+        except Exception:
+            continue
+    return False
+
+def _accept_by_button_scan(dlg, snap, spec) -> bool:
+    if snap is not None:
+        return False
+    for b in walk_elements(dlg, control_type="Button", prune=BULK_CONTAINERS):
+        try:
+            if (b.window_text() or "").strip().lower().startswith(spec["prefixes"]) and _invoke_or_space(_as_wrapper(b)):
+                return True
+        except Exception:
+            continue
+    return False
+
+def _accept_by_mnemonic(dlg, snap, spec) -> bool:
     try:
-        dlg.type_keys("%o"); return True
+        dlg.type_keys(spec["mnemonic"]); return True
     except Exception:
-        pass
+        return False
+
+def _dialog_is_foreground(dlg) -> bool:
+    """True only when `dlg` is verifiably the foreground window (global keystrokes land in it)."""
+    try:
+        import win32gui
+        return win32gui.GetForegroundWindow() == _as_wrapper(dlg).handle
+    except Exception:
+        return False
+
+def _accept_by_tab_loop(dlg, snap, spec) -> bool:
+    # TAB/SPACE are global keystrokes: only while the dialog itself has the foreground
     try:
         iui = IUIA()
         for _ in range(120):
+            if not _dialog_is_foreground(dlg):
+                return False
             try:
                 foc_el = iui.get_focused_element()
                 if foc_el is not None:
                     foc = UIAWrapper(foc_el)
                     ctl = (foc.element_info.control_type or "")
                     name = (foc.window_text() or "").strip().lower()
-                    if ctl == "Button" and (name.startswith("open") or name.startswith("öffnen")
-                                            or name.startswith("abrir") or name.startswith("откры")):
+                    if ctl == "Button" and name.startswith(spec["prefixes"]):
                         send_keys(" "); return True
             except Exception:
                 pass
@@ -670,68 +1823,168 @@ def _accept_open_dialog(dlg) -> bool:
             time.sleep(0.05)
     except Exception:
         pass
+    return False
+
+def _accept_by_enter(dlg, snap, spec) -> bool:
+    if not spec["enter"]:
+        return False
     try:
         dlg.type_keys("{ENTER}"); return True
     except Exception:
         return False
 
-def _locate_possible_open_dialog():
-    for hint in OPEN_HINTS:
+# name -> method, in the original cascade order (used for signatures not seen yet)
+ACCEPT_STRATEGIES = {
+    "snapshot_button": _accept_by_snapshot,
+    "named_button": _accept_by_named_button,
+    "button_scan": _accept_by_button_scan,
+    "mnemonic": _accept_by_mnemonic,
+    "tab_loop": _accept_by_tab_loop,
+    "enter": _accept_by_enter,
+}
+
+
+class DialogStrategyRegistry:
+    """Persisted per-signature stats of the accept methods: {signature: {name: {ok, fail, seconds}}}."""
+
+    def __init__(self, path: Path = DIALOG_STRATEGY_PATH):
+        self.path = path
+        self.data = None
+
+    def _loaded(self) -> dict:
+        if self.data is None:
+            try:
+                self.data = json.loads(self.path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                self.data = {}
+        return self.data
+
+    def save(self):
         try:
-            dlg = Desktop(backend="uia").window(title_re=hint, control_type="Window")
-            if dlg.exists(timeout=0.2):
-                return dlg
-        except Exception:
-            pass
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self._loaded(), indent=1, sort_keys=True), encoding="utf-8")
+            tmp.replace(self.path)
+        except OSError as e:
+            logging.warning(f"Could not persist dialog strategies: {e}")
+
+    def order(self, signature: str, names) -> list:
+        """Proven methods by expected cost (latency + failure share x verify timeout), then untried, then failing."""
+        stats = self._loaded().get(signature, {})
+        default = list(names)
+
+        def key(name):
+            st = stats.get(name)
+            if st is None:
+                return (1, 0.0, default.index(name))
+            if st.get("ok", 0) == 0:
+                return (2, 0.0, default.index(name))
+            fail_share = st.get("fail", 0) / (st["ok"] + st.get("fail", 0))
+            return (0, st.get("seconds", 0.0) + fail_share * ACCEPT_VERIFY_TIMEOUT, default.index(name))
+        return sorted(default, key=key)
+
+    def record(self, signature: str, name: str, ok: bool, seconds: float):
+        st = self._loaded().setdefault(signature, {}).setdefault(name, {"ok": 0, "fail": 0, "seconds": 0.0})
+        if ok:
+            # moving average of the time to a verified accept
+            st["seconds"] = round(seconds if st["ok"] == 0 else 0.7 * st["seconds"] + 0.3 * seconds, 3)
+            st["ok"] += 1
+        else:
+            st["fail"] += 1
+
+
+DIALOG_STRATEGIES = DialogStrategyRegistry()
+
+
+def _dialog_signature(role: str, dlg, snap) -> str:
     try:
-        for w in Desktop(backend="uia").windows():
-            try:
-                if w.is_dialog():
-                    for b in w.descendants(control_type="Button"):
-                        t = (b.window_text() or "").strip().lower()
-                        if t.startswith("open") or t.startswith("öffnen") or t.startswith("abrir") or t.startswith("откры"):
-                            return w
-            except Exception:
-                continue
+        title = (dlg.window_text() or "").strip()
+    except Exception:
+        title = ""
+    try:
+        cls = _as_wrapper(dlg).element_info.class_name or ""
+    except Exception:
+        cls = ""
+    buttons = sorted({n.name for n in snap.iter(control_type="Button", prune=BULK_CONTAINERS) if n.name}) if snap else []
+    return f"{role}|{title}|{cls}|{','.join(buttons)}"
+
+def _dialog_open_and_enabled(dlg) -> bool:
+    """Positively verified: `dlg` still exists and accepts input."""
+    try:
+        return not _element_gone(dlg) and bool(dlg.is_enabled())
+    except Exception:
+        return False
+
+def _accept_took_effect(dlg) -> bool:
+    """The dialog closed, is disabled under a modal prompt, or an overwrite prompt is up."""
+    if _element_gone(dlg):
+        return True
+    try:
+        if not dlg.is_enabled():
+            return True
     except Exception:
         pass
+    return scan_desktop({"overwrite_confirm"}).first("overwrite_confirm") is not None
+
+def _accept_dialog(dlg, role: str) -> bool:
+    """Press Open/Save with the historically fastest method that works for this dialog.
+
+    A dispatched method counts as failed only when, after the verify timeout
+    and a grace wait for the dialog to close, the dialog is still open and
+    enabled; only then is the next method tried, so a dialog is never accepted
+    twice. Methods that found nothing to press are skipped without being
+    recorded. Returns True if any method could be dispatched (the caller still
+    waits for the dialog to close).
+    """
     try:
-        dlg = Desktop(backend="win32").window(class_name="#32770")
-        if dlg.exists(timeout=0.2):
-            return dlg
+        dlg.set_focus()
     except Exception:
         pass
+    spec = ACCEPT_SPECS[role]
+    snap = snapshot_elements(dlg)
+    signature = _dialog_signature(role, dlg, snap)
+    dispatched = ok = False
+    for name in DIALOG_STRATEGIES.order(signature, ACCEPT_STRATEGIES):
+        t0 = time.perf_counter()
+        if not ACCEPT_STRATEGIES[name](dlg, snap, spec):
+            continue  # nothing to press with this method: not evidence either way
+        dispatched = True
+        ok = bool(wait_until(lambda: _accept_took_effect(dlg), ACCEPT_VERIFY_TIMEOUT, poll=0.05,
+                             label=f"{role} accepted ({name})"))
+        if not ok:
+            ok = wait_gone(dlg, ACCEPT_GRACE_TIMEOUT, label=f"{role} dialog closed ({name})") or _accept_took_effect(dlg)
+        DIALOG_STRATEGIES.record(signature, name, ok, time.perf_counter() - t0)
+        if ok:
+            stage_note(accept=name)
+            logging.info(f"Accepted {role} dialog via {name} in {time.perf_counter() - t0:.2f}s")
+            break
+        if not _dialog_open_and_enabled(dlg):
+            logging.info(f"{role} dialog: state unclear after {name}; not pressing again")
+            break
+        logging.info(f"{role} dialog: {name} had no visible effect; trying the next method")
+    DIALOG_STRATEGIES.save()
+    return ok or dispatched
+
+def _accept_open_dialog(dlg) -> bool:
+    """Activate Open without relying on Enter focus."""
+    return _accept_dialog(dlg, "open")
+
+def _locate_possible_open_dialog():
+    snap = scan_desktop({"open_dialog", "open_like", "legacy_dialog"})
+    for kind in ("open_dialog", "open_like", "legacy_dialog"):
+        info = snap.first(kind)
+        if info is not None and (kind != "open_like" or info.is_dialog()):
+            return info.spec()
     return None
 
 def wait_save_dialog(timeout=120):
     """Wait for DaVinci's Save/Save As dialog after user clicks Save."""
-    t0 = time.time()
-    while time.time() - t0 < timeout:
-        for hint in SAVE_HINTS:
-            try:
-                dlg = Desktop(backend="uia").window(title_re=hint, control_type="Window")
-                if dlg.exists(timeout=0.4):
-                    return ("uia", dlg)
-            except Exception:
-                pass
-        try:
-            for w in Desktop(backend="uia").windows():
-                try:
-                    if w.is_dialog() and "open" not in (w.window_text() or "").lower():
-                        if any(btn.window_text().strip().lower().startswith("save")
-                               for btn in w.descendants(control_type="Button")):
-                            return ("uia", w)
-                except Exception:
-                    pass
-        except Exception:
-            pass
-        time.sleep(0.25)
-    try:
-        dlg = Desktop(backend="win32").window(class_name="#32770")
-        if dlg.exists(timeout=1.5):
-            return ("win32", dlg)
-    except Exception:
-        pass
+    info = wait_for_dialog(["save_dialog"], timeout)
+    if info is not None:
+        return ("uia", info.spec())
+    info = scan_desktop({"legacy_dialog"}).first("legacy_dialog")
+    if info is not None:
+        return ("win32", info.spec())
     raise UIATimeout("Save dialog did not appear.")
 
 def _read_filename_from_dialog_uia(dlg):
@@ -742,23 +1995,15 @@ def _read_filename_from_dialog_uia(dlg):
     except Exception:
         pass
     try:
-        edits = [c for c in dlg.descendants(control_type="Edit")]
-        if edits:
-            return edits[-1].get_value()
+        edit = last_element(dlg, control_type="Edit", prune=BULK_CONTAINERS)
+        if edit is not None:
+            return edit.get_value()
     except Exception:
         pass
     return None
 
 def _wait_dialog_gone(dlg, timeout=15) -> bool:
-    t0 = time.time()
-    while time.time() - t0 < timeout:
-        try:
-            if not dlg.exists(timeout=0.2):
-                return True
-        except Exception:
-            return True
-        time.sleep(0.1)
-    return False
+    return wait_gone(dlg, timeout, label="dialog closed")
 
 def _best_filename_from_dialog(dlg, fallback_name: str) -> str:
     try:
@@ -768,82 +2013,18 @@ def _best_filename_from_dialog(dlg, fallback_name: str) -> str:
             return val.strip() or fallback_name
     except Exception:
         pass
-    try:
-        edits = [c for c in dlg.descendants(control_type="Edit")]
-        if edits:
-            try:
-                val = edits[-1].get_value() or ""
-                return val.strip() or fallback_name
-            except Exception:
-                pass
-    except Exception:
-        pass
+    edit = last_element(dlg, control_type="Edit", prune=BULK_CONTAINERS)
+    if edit is not None:
+        try:
+            val = edit.get_value() or ""
+            return val.strip() or fallback_name
+        except Exception:
+            pass
     return fallback_name
 
 def _accept_save_dialog(dlg) -> bool:
     """Ensure Save is activated without relying on Enter focus."""
-    try:
-        dlg.set_focus()
-    except Exception:
-        pass
-    variants = ["Save", "&Save", "Speichern", "Guardar", "Сохранить", "Salvar"]
-    try:
-        for lab in variants:
-            try:
-                btn = dlg.child_window(title=lab, control_type="Button")
-                if btn.exists():
-                    w = btn.wrapper_object()
-                    try:
-                        if hasattr(w, "invoke"):
-                            w.invoke(); return True
-                    except Exception:
-                        pass
-                    try:
-                        w.set_focus(); send_keys(" "); return True
-                    except Exception:
-                        pass
-            except Exception:
-                continue
-        for b in dlg.descendants(control_type="Button"):
-            try:
-                t = (b.window_text() or "").strip().lower()
-                if t.startswith("save"):
-                    w = b.wrapper_object()
-                    try:
-                        if hasattr(w, "invoke"):
-                            w.invoke(); return True
-                    except Exception:
-                        pass
-                    try:
-                        w.set_focus(); send_keys(" "); return True
-                    except Exception:
-                        pass
-            except Exception:
-                continue
-    except Exception:
-        pass
-    try:
-        dlg.type_keys("%s"); return True
-    except Exception:
-        pass
-    try:
-        iui = IUIA()
-        for _ in range(120):
-            try:
-                foc_el = iui.get_focused_element()
-                if foc_el is not None:
-                    foc = UIAWrapper(foc_el)
-                    ctl = (foc.element_info.control_type or "")
-                    name = (foc.window_text() or "").strip().lower()
-                    if ctl == "Button" and name.startswith("save"):
-                        send_keys(" "); return True
-            except Exception:
-                pass
-            send_keys("{TAB}")
-            time.sleep(0.05)
-    except Exception:
-        pass
-    return False
+    return _accept_dialog(dlg, "save")
 
 def save_to_folder_uia(dlg, target_folder: Path, filename_fallback: str):
     target_folder.mkdir(parents=True, exist_ok=True)
@@ -859,9 +2040,8 @@ def save_to_folder_uia(dlg, target_folder: Path, filename_fallback: str):
             e.set_focus(); e.select()
             e.type_keys(fname, with_spaces=True)
         else:
-            edits = [c for c in dlg.descendants(control_type="Edit")]
-            if edits:
-                e = edits[-1].wrapper_object()
+            e = last_element(dlg, control_type="Edit", prune=BULK_CONTAINERS)
+            if e is not None:
                 e.set_focus(); e.select()
                 e.type_keys(fname, with_spaces=True)
     except Exception:
@@ -893,81 +2073,47 @@ def save_to_folder_win32(dlg, target_folder: Path, filename_fallback: str):
     return False
 
 def maybe_confirm_overwrite(timeout=8):
-    t0 = time.time()
-    while time.time() - t0 < timeout:
-        for backend in ("uia", "win32"):
-            try:
-                desk = Desktop(backend=backend)
-                for w in desk.windows():
-                    title = (w.window_text() or "").lower()
-                    if any(k in title for k in ["confirm save as", "overwrite", "replace", "bestätigen"]):
-                        for yes in ["Yes", "&Yes", "Ja", "Sí", "Да"]:
-                            try:
-                                b = w.child_window(title=yes, control_type="Button") if backend=="uia" else w.child_window(title=yes)
-                                if b.exists():
-                                    b.wrapper_object().click_input()
-                                    return True
-                            except Exception:
-                                pass
-                        try:
-                            w.type_keys("%y")
-                        except Exception:
-                            try: w.type_keys("{ENTER}")
-                            except Exception: pass
-                        return True
-            except Exception:
-                pass
-        time.sleep(0.25)
-    return False
+    info = wait_for_dialog(["overwrite_confirm"], timeout)
+    if info is None:
+        return False
+    return _press_button_or_keys(info, YES_LABELS, "%y")
+
+def _popup_menu_open() -> bool:
+    """True while a drop-down/popup menu is shown (UIA Menu window or Win32 #32768)."""
+    try:
+        if Desktop(backend="uia").windows(control_type="Menu"):
+            return True
+    except Exception:
+        pass
+    try:
+        return bool(Desktop(backend="win32").windows(class_name="#32768"))
+    except Exception:
+        return False
 
 def maybe_click_yes_popup(timeout=8):
     """
     Look for any popup/dialog with a 'Yes' button and click it.
     Use after double-clicking in DaVinci when it shows a confirmation.
     """
+    DIALOG_WATCHER.ensure_started()
     t0 = time.time()
     while time.time() - t0 < timeout:
-        for backend in ("uia", "win32"):
+        for info in scan_desktop({"yes_popup"}).all("yes_popup"):
             try:
-                desk = Desktop(backend=backend)
-                for w in desk.windows():
-                    title = (w.window_text() or "").strip()
-                    # You can narrow this down later if needed
-                    # For now: any small dialog with a Yes button
-                    try:
-                        for yes_label in ["Yes", "&Yes", "Ja", "Sí", "Да"]:
-                            try:
-                                btn = (
-                                    w.child_window(title=yes_label, control_type="Button")
-                                    if backend == "uia"
-                                    else w.child_window(title=yes_label)
-                                )
-                                if btn.exists(timeout=0.2):
-                                    btn.wrapper_object().click_input()
-                                    logging.info(f"Clicked YES on popup: '{title}'")
-                                    return True
-                            except Exception:
-                                continue
-                    except Exception:
-                        continue
+                info.button(YES_LABELS).click_input()
+                logging.info(f"Clicked YES on popup: '{info.title}'")
+                return True
             except Exception:
-                pass
-        time.sleep(0.25)
+                continue
+        DIALOG_WATCHER.wait(0.25)
     logging.info("maybe_click_yes_popup: no YES popup detected within timeout.")
     return False
 
 
 def focus_save_filename_edit(save_win):
     """Focus the 'File name' input of a Save dialog and report status."""
-    try:
-        edits = save_win.descendants(control_type="Edit")
-    except Exception:
-        edits = []
-    if not edits:
-        return None
-    try:
-        edit = edits[-1]
-    except Exception:
+    edit = last_element(save_win, control_type="Edit", prune=BULK_CONTAINERS)
+    if edit is None:
         return None
     try:
         edit.set_focus()
@@ -986,7 +2132,13 @@ def find_filename_edit(dlg):
       2) auto_id=1148 ComboBox → child Edit
       3) the last Edit under any ComboBox that is near a 'File name' label
       4) fallback: the last visible Edit in the dialog
+    The search runs on a cached snapshot when UIA caching is available.
     """
+    snap = snapshot_elements(dlg)
+    if snap is not None:
+        node = _filename_edit_node(snap)
+        return snap.wrapper(node) if node is not None else None
+
     # 1) Canonical Edit with auto_id=1148
     try:
         e = dlg.child_window(auto_id="1148", control_type="Edit")
@@ -999,98 +2151,75 @@ def find_filename_edit(dlg):
     try:
         cb = dlg.child_window(auto_id="1148", control_type="ComboBox")
         if cb.exists(timeout=0.2):
-            try:
-                inner_edits = cb.descendants(control_type="Edit")
-                if inner_edits:
-                    return inner_edits[-1]
-            except Exception:
-                pass
+            inner = last_element(cb, control_type="Edit")
+            if inner is not None:
+                return inner
     except Exception:
         pass
 
     # 3) Heuristic: find a 'File name' label and grab a nearby Edit/ComboBox→Edit
     try:
-        labels = []
-        for t in dlg.descendants(control_type="Text"):
-            txt = (t.window_text() or "").strip().lower()
-            if any(k in txt for k in ["file name", "dateiname", "nombre", "nome", "имя файла"]):
-                labels.append(t)
-        if labels:
+        lab = first_element(dlg, control_type="Text", prune=BULK_CONTAINERS,
+                            name=lambda txt: any(k in txt for k in ["file name", "dateiname", "nombre", "nome", "имя файла"]))
+        if lab is not None:
             # pick the first visible label, search siblings/descendants for an Edit
-            lab = labels[0]
             parent = lab.parent()
             if parent:
                 try:
                     # prefer an Edit inside a ComboBox sibling
-                    for cb in parent.descendants(control_type="ComboBox"):
-                        try:
-                            inner_edits = cb.descendants(control_type="Edit")
-                            if inner_edits:
-                                return inner_edits[-1]
-                        except Exception:
-                            continue
+                    for cb in walk_elements(parent, control_type="ComboBox", prune=BULK_CONTAINERS):
+                        inner = last_element(cb, control_type="Edit")
+                        if inner is not None:
+                            return inner
                     # otherwise, any Edit sibling
-                    edits = parent.descendants(control_type="Edit")
-                    if edits:
-                        return edits[-1]
+                    edit = last_element(parent, control_type="Edit", prune=BULK_CONTAINERS)
+                    if edit is not None:
+                        return edit
                 except Exception:
                     pass
     except Exception:
         pass
 
     # 4) Last resort: the last Edit visible in the dialog
-    try:
-        edits = [e for e in dlg.descendants(control_type="Edit")]
-        if edits:
-            return edits[-1]
-    except Exception:
-        pass
-    return None
+    return last_element(dlg, control_type="Edit", prune=BULK_CONTAINERS)
+
+def _filename_edit_node(snap):
+    """find_filename_edit() steps 1-4, in memory."""
+    node = snap.first(control_type="Edit", automation_id="1148")
+    if node is not None:
+        return node
+    cb = snap.first(control_type="ComboBox", automation_id="1148")
+    if cb is not None:
+        node = snap.last(within=cb, control_type="Edit")
+        if node is not None:
+            return node
+    lab = snap.first(control_type="Text", prune=BULK_CONTAINERS,
+                     name=lambda txt: any(k in txt for k in ["file name", "dateiname", "nombre", "nome", "имя файла"]))
+    if lab is not None and lab.parent is not None:
+        for cb in snap.iter(within=lab.parent, control_type="ComboBox", prune=BULK_CONTAINERS):
+            node = snap.last(within=cb, control_type="Edit")
+            if node is not None:
+                return node
+        node = snap.last(within=lab.parent, control_type="Edit", prune=BULK_CONTAINERS)
+        if node is not None:
+            return node
+    return snap.last(control_type="Edit", prune=BULK_CONTAINERS)
 
 # Helper: get current filename from the Save dialog's File name edit, robustly
 def get_current_filename_from_edit(dlg) -> str:
     """
     Robustly read the current text in the 'File name' field.
-    Priority: UIA value from the correct Edit → clipboard → window_text.
-    Includes small waits and multiple attempts to handle slow dialogs.
+    Priority: ValuePattern → WM_GETTEXT on control 1148 → clipboard → window_text
+    (see read_dialog_filename). Retries briefly to handle slow dialogs.
     """
     edit = find_filename_edit(dlg)
-    # Try to focus the exact edit
-    if edit is not None:
-        try:
-            edit.set_focus()
-        except Exception:
-            pass
-
     raw = ""
-    # Try UIA value first (most reliable, no keyboard required)
     for _ in range(3):
-        if edit is not None:
-            try:
-                v = (edit.get_value() or "").strip()
-                if v:
-                    raw = v
-                    break
-            except Exception:
-                pass
+        raw = read_dialog_filename(dlg, edit)
+        if raw:
+            break
         time.sleep(0.05)
 
-    # Clipboard fallback (Ctrl+A, Ctrl+C)
-    if not raw:
-        try:
-            send_keys("^a^c")
-            time.sleep(0.06)
-            raw = (clipboard.GetData() or "").strip()
-        except Exception:
-            raw = ""
-
-    # window_text final fallback
-    if not raw and edit is not None:
-        try:
-            raw = (edit.window_text() or "").strip()
-        except Exception:
-            raw = ""
-
     # Normalize: keep only the last path segment (the filename)
     if raw:
         try:
@@ -1128,26 +2257,31 @@ def save_into_modified_dir_with_existing_name(dlg, modified_dir=r"C:\\ecu_files\
         pass
     final_path = str(out_dir / fname_only)
 
-    # Replace text in the edit and submit
-    # Prefer dialog-scoped typing, with fallback to global send_keys
+    # Replace text in the edit and submit: write the field directly and press Save,
+    # else dialog-scoped typing, with fallback to global send_keys
     typed = False
-    try:
-        dlg.type_keys("^a{BACKSPACE}")
-        time.sleep(0.05)
-        dlg.type_keys(final_path, with_spaces=True)
-        time.sleep(0.05)
-        dlg.type_keys("{TAB}{ENTER}")
-        typed = True
-    except Exception:
+    edit = find_filename_edit(dlg)
+    if (edit is not None or _filename_hwnd(dlg)) and write_dialog_filename(dlg, final_path, edit):
+        typed = _accept_save_dialog(dlg)
+    if not typed:
+        _note_text_io("write", "keystrokes")
         try:
-            send_keys("^a{BACKSPACE}")
+            dlg.type_keys("^a{BACKSPACE}")
             time.sleep(0.05)
-            send_keys(final_path, with_spaces=True)
+            dlg.type_keys(final_path, with_spaces=True)
             time.sleep(0.05)
-            send_keys("{TAB}{ENTER}")
+            dlg.type_keys("{TAB}{ENTER}")
             typed = True
         except Exception:
-            typed = False
+            try:
+                send_keys("^a{BACKSPACE}")
+                time.sleep(0.05)
+                send_keys(final_path, with_spaces=True)
+                time.sleep(0.05)
+                send_keys("{TAB}{ENTER}")
+                typed = True
+            except Exception:
+                typed = False
 
     if typed:
         logging.info(f"Save Mod File: typed full path → {final_path}")
@@ -1171,34 +2305,51 @@ def save_via_address_bar_using_existing_name(dlg, target_folder=r"C:\\ecu_files\
     except Exception:
         pass
 
+    # 0) Direct: read the proposed name, write the full target path into the
+    #    File name field and press Save — no address bar, focus or clipboard needed
+    edit = find_filename_edit(dlg)
+    if edit is not None or _filename_hwnd(dlg):
+        fname_only = get_current_filename_from_edit(dlg).strip()
+        if fname_only:
+            final_path = str(out_dir / fname_only)
+            if write_dialog_filename(dlg, final_path, edit) and _accept_save_dialog(dlg):
+                print(f"RAW_FILENAME:{fname_only}")
+                logging.info(f"Save via direct File name write → {final_path}")
+                print(f"SAVED_PATH:{final_path}")
+                return final_path
+    _note_text_io("write", "keystrokes")
+
     # 1) Address bar jump
     jumped = False
     try:
+        before = _focused_info()
         dlg.type_keys('%d')
-        time.sleep(0.2)
+        wait_focus_edit(before, timeout=1.0, budget=0.2, label="address bar focus")
         dlg.type_keys(str(out_dir), with_spaces=True)
         dlg.type_keys('{ENTER}')
-        time.sleep(0.45)
+        wait_settled(dlg, quiet_ms=150, timeout=1.5, budget=0.45, label="address bar jump")
         jumped = True
     except Exception:
         try:
+            before = _focused_info()
             send_keys('%d')
-            time.sleep(0.2)
+            wait_focus_edit(before, timeout=1.0, budget=0.2, label="address bar focus")
             send_keys(str(out_dir), with_spaces=True)
             send_keys('{ENTER}')
-            time.sleep(0.45)
+            wait_settled(dlg, quiet_ms=150, timeout=1.5, budget=0.45, label="address bar jump")
             jumped = True
         except Exception:
             jumped = False
 
     # 2) Focus File name via Alt+N and read it robustly
+    before = _focused_info()
     try:
         dlg.type_keys('%n')
-        time.sleep(0.15)
+        wait_focus_edit(before, timeout=0.5, budget=0.15, label="file name focus")
     except Exception:
         try:
             send_keys('%n')
-            time.sleep(0.15)
+            wait_focus_edit(before, timeout=0.5, budget=0.15, label="file name focus")
         except Exception:
             pass
 
@@ -1250,9 +2401,15 @@ def trigger_save_mod_file(win):
 
     # 1) Try to find and click a Save button on the main window
     try:
-        for btn in win.descendants(control_type="Button"):
+        # The brand tree is pruned: it holds thousands of items and no buttons
+        snap = snapshot_elements(win)
+        if snap is not None:
+            buttons = snap.iter(control_type="Button", prune=BULK_CONTAINERS)
+        else:
+            buttons = walk_elements(win, control_type="Button", prune=BULK_CONTAINERS)
+        for btn in buttons:
             try:
-                label = (btn.window_text() or "").strip().lower()
+                label = (btn.name if snap is not None else btn.window_text() or "").strip().lower()
             except Exception:
                 continue
 
@@ -1262,9 +2419,9 @@ def trigger_save_mod_file(win):
             # Prefer explicit 'Save Mod File', but accept generic 'Save' buttons too
             if "save mod" in label or ("save" in label and "file" in label) or label.startswith("save"):
                 try:
-                    btn.click_input()
+                    (snap.wrapper(btn) if snap is not None else btn).click_input()
                     logging.info(f"Clicked Save button on main window: '{label}'")
-                    time.sleep(0.6)
+                    wait_for_dialog(["save_dialog"], timeout=0.6, budget=0.6)
                     return True
                 except Exception as e:
                     logging.info(f"Failed clicking Save button '{label}': {e}")
@@ -1277,7 +2434,7 @@ def trigger_save_mod_file(win):
     try:
         send_keys("%s")
         logging.info("trigger_save_mod_file: sent Alt+S to main window.")
-        time.sleep(0.6)
+        wait_for_dialog(["save_dialog"], timeout=0.6, budget=0.6)
         return True
     except Exception:
         pass
@@ -1286,7 +2443,7 @@ def trigger_save_mod_file(win):
     try:
         send_keys("^s")
         logging.info("trigger_save_mod_file: sent Ctrl+S to main window.")
-        time.sleep(0.6)
+        wait_for_dialog(["save_dialog"], timeout=0.6, budget=0.6)
         return True
     except Exception:
         pass
@@ -1296,85 +2453,216 @@ def trigger_save_mod_file(win):
 
 ######## this is the part where I will implement the solution automation########
 
-SERVICE_LABELS = {
-    "DPF": "DPF",
-    "EGR": "EGR",
-    "TVA": "TVA",
-    "MAF": "MAF",
-    "FLAPS": "FLAPS",
-    "ADBLUE": "ADBLUE",
-    "LAMBDA": "LAMBDA",
-    "STARTSTOP": "STARTSTOP",
-}
+# Which service toggles exist for a (brand, ECU), learned from the labels that
+# apply_services finds: {"BRAND|ECU": {"version", "signature", "walks", "absent": [KEY],
+# "services": {LABEL: [dx, dy]}}} with positions relative to the main window. An
+# entry is replaced (walks back to 1) when a walk finds a different layout or
+# DaVinci's version changes. agent.py reads the file as plain JSON to flag or
+# reject unsupported requests before downloading the BIN; the top-level "version"
+# (DaVinci version of the last run), "brand_aliases" and "service_keys" (request
+# part -> service key, as parsed here) let it do that without importing this module.
+CAPABILITY_PATH = Path("C:/davinci_automation/service_capabilities.json")
+CAPABILITY_GRID = 8  # px; positions are compared on this grid for the layout signature
+
+
+def _layout_signature(layout: dict) -> str:
+    h = hashlib.sha1()
+    for label in sorted(layout):
+        dx, dy = layout[label]
+        h.update(f"{label}:{dx // CAPABILITY_GRID},{dy // CAPABILITY_GRID}|".encode("utf-8"))
+    return h.hexdigest()
+
+
+class ServiceCapabilities:
+    """Persisted (brand, ECU) -> service labels present in DaVinci's layout."""
+
+    def __init__(self, path: Path = CAPABILITY_PATH):
+        self.path = path
+        self.version = None  # DaVinci version of this process; entries of other versions are ignored
+        self.ecus = {}
+        self.service_keys = {}
+        self._mtime = None
+
+    @staticmethod
+    def key(brand: str, ecu: str) -> str:
+        return f"{effective_brand(brand)}|{(ecu or '').strip().upper()}"
+
+    def _refresh(self):
+        """Re-read the file when another process (worker or agent) has rewritten it."""
+        try:
+            mtime = self.path.stat().st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            self.ecus = data.get("ecus") or {}
+            self.service_keys = data.get("service_keys") or {}
+            self._mtime = mtime
+        except (OSError, ValueError) as e:
+            logging.info(f"service capability map unreadable: {e}")
+
+    def save(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            data = {"version": self.version, "brand_aliases": BRAND_ALIASES,
+                    "service_keys": self.service_keys, "ecus": self.ecus}
+            tmp.write_text(json.dumps(data, sort_keys=True), encoding="utf-8")
+            tmp.replace(self.path)
+            self._mtime = self.path.stat().st_mtime
+        except OSError as e:
+            logging.warning(f"Could not persist service capability map: {e}")
+
+    def get(self, brand: str, ecu: str):
+        """The entry for this brand/ECU, or None when unknown or from another DaVinci version."""
+        self._refresh()
+        entry = self.ecus.get(self.key(brand, ecu))
+        if entry is None or entry.get("version") != self.version:
+            return None
+        return entry
+
+    def learn(self, brand: str, ecu: str, layout: dict, services: str = "") -> bool:
+        """Store the labels found in one walk; True when the entry was new or the layout changed.
+
+        A walk that finds the stored layout again counts as a confirmation
+        ("walks"); `services` is the request text, whose parts are remembered
+        with their service keys for agent.py.
+        """
+        if not layout:
+            return False  # nothing found: window not ready, do not record "no services"
+        for part in (p.strip().lower() for p in services.replace(";", ",").split(",")):
+            keys = list(parse_services_map(part))
+            if len(keys) == 1:
+                self.service_keys[part] = keys[0]
+        signature = _layout_signature(layout)
+        old = self.get(brand, ecu)
+        if old is not None and old.get("signature") == signature:
+            old["walks"] = old.get("walks", 1) + 1
+            self.save()
+            return False
+        self.ecus[self.key(brand, ecu)] = {
+            "version": self.version, "signature": signature, "walks": 1,
+            "absent": sorted(k for k, lab in SERVICE_LABELS.items() if lab.upper() not in layout),
+            "services": {k: list(v) for k, v in sorted(layout.items())},
+        }
+        self.save()
+        logging.info(f"service capabilities {'updated (layout changed)' if old else 'learned'} for "
+                     f"{self.key(brand, ecu)}: {', '.join(sorted(layout))}")
+        return True
+
+
+SERVICE_CAPABILITIES = ServiceCapabilities()
 
-def parse_services_map(services: str) -> dict[str, str]:
-    """
-    Parse backend service strings into a dict { SERVICE_KEY: "ON"/"OFF" }.
-
-    Mapping rules provided by backend:
-      - "DPF OFF" → DPF:OFF
-      - "EGR OFF" → EGR:OFF
-      - "TVA" → TVA:OFF
-      - "MAF Removal" → MAF:OFF
-      - "Swirl Flap OFF" → FLAPS:OFF
-      - "SCR (ADblue OFF)" → ADBLUE:OFF
-      - "Decat / O2 / Lamda OFF" → LAMBDA:OFF
-      - "Decat" → LAMBDA:ON
-      - "Start and Stop OFF" → STARTSTOP:OFF
-
-    READINESS is ignored.
-    Matching is case‑insensitive.
-    "ON" means: ensure toggle ends ON (double-click if currently OFF).
-    "OFF" means: ensure toggle ends OFF (double-click if currently ON).
-    """
-    result = {}
-    if not services:
-        return result
-
-    parts = [p.strip().lower() for p in services.replace(";", ",").split(",") if p.strip()]
-
-    for p in parts:
-        txt = p.lower()
-
-        if "dpf" in txt and "off" in txt:
-            result["DPF"] = "OFF"
-        elif "egr" in txt and "off" in txt:
-            result["EGR"] = "OFF"
-        elif txt == "tva" or txt.startswith("tva"):
-            result["TVA"] = "OFF"
-        elif "maf" in txt and "removal" in txt:
-            result["MAF"] = "OFF"
-        elif "swirl" in txt or "flap" in txt:
-            result["FLAPS"] = "OFF"
-        elif "scr" in txt or "adblue" in txt:
-            result["ADBLUE"] = "OFF"
-        elif ("decat" in txt or "lambda" in txt or "lamda" in txt or "o2" in txt) and "off" in txt:
-            result["LAMBDA"] = "OFF"
-        elif txt == "decat":
-            result["LAMBDA"] = "ON"
-        elif "start" in txt and "stop" in txt and "off" in txt:
-            result["STARTSTOP"] = "OFF"
-
-    return result
-
-
-def click_toggle_by_label(win, label_text: str):
-    """
-    Find the Text control 'DPF' / 'EGR' etc, then DOUBLE-CLICK slightly to its LEFT
-    (where the ON/OFF slider is in your layout).
-    """
-    label_upper = label_text.upper()
-    lbl = None
 
-    # Find the label
-    for t in win.descendants(control_type="Text"):
+TOGGLE_CLICK_OFFSET = 40           # the ON/OFF slider sits this many px LEFT of its label
+TOGGLE_TYPES = ("CheckBox", "Button")
+POPUP_KINDS_AFTER_TOGGLE = ["info", "yes_popup", "legacy_dialog"]
+
+
+def find_service_labels(win, labels, toggles=None):
+    """Resolve several service labels ('DPF', 'EGR', ...) in one walk; returns {LABEL: Text control}.
+
+    When a `toggles` list is passed, toggle-like controls met during the same
+    walk are appended to it (and the walk covers the whole window).
+    """
+    wanted = {lab.upper() for lab in labels}
+    found = {}
+    types = ("Text",) + (TOGGLE_TYPES if toggles is not None else ())
+    for t in walk_elements(win, control_type=types, prune=BULK_CONTAINERS):
+        if toggles is not None and _control_type(t) != "Text":
+            toggles.append(t)
+            continue
         try:
             txt = (t.window_text() or "").strip().upper()
         except Exception:
             continue
-        if txt == label_upper:
-            lbl = t
-            break
+        if txt in wanted and txt not in found:
+            found[txt] = t
+            if len(found) == len(wanted) and toggles is None:
+                break
+    return found
+
+def _toggle_point(win, lbl):
+    """Screen point of the slider LEFT of a label, clamped inside the window."""
+    win_rect = win.rectangle()
+    r = lbl.rectangle()
+    x = max(r.left - TOGGLE_CLICK_OFFSET, win_rect.left + 5)
+    return x, (r.top + r.bottom) // 2
+
+def _uia_toggle_state(elem):
+    """'ON' / 'OFF' from the UIA Toggle pattern, None if the control has none."""
+    try:
+        UIA_CALLS["count"] += 1
+        return {0: "OFF", 1: "ON"}.get(elem.iface_toggle.CurrentToggleState)
+    except Exception:
+        return None
+
+def read_toggle_state(toggle=None):
+    """Current state of a slider: (state, 'pattern'), or (None, 'unknown') without a Toggle pattern."""
+    if toggle is not None:
+        state = _uia_toggle_state(toggle)
+        if state:
+            return state, "pattern"
+    return None, "unknown"
+
+def _toggle_at(toggles, point):
+    """The toggle control whose rectangle contains `point` (rectangles cached on first use)."""
+    x, y = point
+    for entry in toggles:
+        if len(entry) == 1:
+            try:
+                entry.append(entry[0].rectangle())
+            except Exception:
+                entry.append(None)
+        r = entry[1]
+        if r is not None and r.left <= x <= r.right and r.top <= y <= r.bottom:
+            return entry[0]
+    return None
+
+def plan_service_toggles(win, svc_map: dict[str, str], layout: dict | None = None) -> list[dict]:
+    """One walk over the window: each requested service with its label, slider point and current state.
+
+    The walk resolves every SERVICE_LABELS entry; pass `layout` to receive
+    {LABEL: (dx, dy)} of all labels found, relative to the window.
+    """
+    controls = []
+    labels = find_service_labels(win, list(SERVICE_LABELS.values()), toggles=controls)
+    toggles = [[c] for c in controls]
+    if layout is not None:
+        try:
+            wr = win.rectangle()
+            for label, ctl in labels.items():
+                r = ctl.rectangle()
+                layout[label] = (r.left - wr.left, r.top - wr.top)
+        except Exception as e:
+            logging.info(f"Could not measure service label positions: {e}")
+            layout.clear()
+    plan = []
+    for key, want in svc_map.items():
+        item = {"key": key, "label": SERVICE_LABELS[key], "want": want, "lbl": labels.get(SERVICE_LABELS[key].upper()),
+                "point": None, "toggle": None, "state": None, "source": "unknown"}
+        if item["lbl"] is not None:
+            try:
+                item["point"] = _toggle_point(win, item["lbl"])
+            except Exception as e:
+                logging.info(f"Service label {item['label']} has no usable rectangle: {e}")
+        if item["point"] is not None:
+            item["toggle"] = _toggle_at(toggles, item["point"])
+            item["state"], item["source"] = read_toggle_state(item["toggle"])
+        plan.append(item)
+    logging.info("Service plan: " + ", ".join(
+        f"{p['label']} {p['state'] or '?'}->{p['want']} ({p['source']})" for p in plan))
+    return plan
+
+def click_toggle_by_label(win, label_text: str, lbl=None):
+    """
+    Find the Text control 'DPF' / 'EGR' etc, then DOUBLE-CLICK slightly to its LEFT
+    (where the ON/OFF slider is in your layout). Pass `lbl` when already resolved.
+    """
+    if lbl is None:
+        lbl = find_service_labels(win, [label_text]).get(label_text.upper())
 
     if not lbl:
         logging.info(f"Service label not found: {label_text}")
@@ -1382,16 +2670,7 @@ def click_toggle_by_label(win, label_text: str):
 
     try:
         win_rect = win.rectangle()
-        r = lbl.rectangle()
-        # Click a bit to the LEFT of the text, middle vertically
-        offset = 40  # adjust if needed
-        x = r.left - offset
-        y = (r.top + r.bottom) // 2
-
-        # Clamp inside window bounds so we don't click outside
-        if x < win_rect.left + 5:
-            x = win_rect.left + 5
-
+        x, y = _toggle_point(win, lbl)
         # DOUBLE-CLICK instead of single click
         win.double_click_input(coords=(x - win_rect.left, y - win_rect.top))
         logging.info(f"Double-clicked toggle LEFT of {label_text} at ({x},{y})")
@@ -1400,55 +2679,123 @@ def click_toggle_by_label(win, label_text: str):
         logging.info(f"Failed double-clicking toggle for {label_text}: {e}")
         return False
 
-def apply_services(win, services: str):
+def _dismiss_toggle_popup(win) -> bool:
+    """Confirm a popup raised by a toggle click, if one shows up.
+
+    Known popups are confirmed with their OK/Yes button. When none is
+    recognised but the DaVinci window lost the foreground (some other popup
+    took it), ENTER is sent as before so an unknown popup cannot block the run.
+    """
+    info = wait_for_dialog(POPUP_KINDS_AFTER_TOGGLE, timeout=0.35, poll=0.05, budget=0.35)
+    if info is not None:
+        logging.info(f"Toggle popup '{info.title}': confirming")
+        _press_button_or_keys(info, OK_LABELS + YES_LABELS, "{ENTER}")
+        wait_gone(info.wrapper, timeout=2, label="toggle popup closed")
+        return True
+    if _dialog_is_foreground(win):
+        return False
+    logging.info("Toggle click: DaVinci lost the foreground to an unrecognised window; sending ENTER")
+    try:
+        send_keys("{ENTER}")
+    except Exception:
+        pass
+    return True
+
+class ServiceVerificationError(RuntimeError):
+    """A service toggle did not reach the requested state, or its state could not be read."""
+
+
+def apply_services(win, services: str, brand: str = "", ecu: str = ""):
     """
     Apply requested services (e.g. 'DPF OFF, EGR OFF') by clicking toggles.
-    Uses DOUBLE-CLICK per label and hits ENTER after each toggle to dismiss any blocking popup.
-    Respects ON/OFF state as parsed from the backend.
+
+    All requested services are planned in one walk, which also refreshes the
+    capability map (a stale "absent" entry is corrected by the next run). The
+    state of a slider is read from its UIA Toggle pattern: one already in the
+    requested state is left alone, the others are DOUBLE-CLICKed, any popup a
+    click raises is confirmed and the slider is re-read. A slider without a
+    Toggle pattern has no trustworthy state and is not clicked blindly.
+    Raises ServiceVerificationError when a slider did not switch or its state
+    is unknown. Returns the plan entries.
     """
     svc_map = parse_services_map(services)
     if not svc_map:
         logging.info("No services requested; skipping toggle automation.")
-        return
+        return []
 
     logging.info(f"Applying services: {svc_map}")
     try:
         win.set_focus()
     except Exception:
         pass
-
-    time.sleep(0.3)
-
-    for key, state in svc_map.items():
-        if state == "OFF":
-            clicked = click_toggle_by_label(win, SERVICE_LABELS[key])
-            time.sleep(0.15)
-            if clicked:
-                try:
-                    send_keys("{ENTER}")
-                except Exception:
-                    pass
-                time.sleep(0.2)
-
-        elif state == "ON":
-            clicked = click_toggle_by_label(win, SERVICE_LABELS[key])
-            time.sleep(0.15)
-            if clicked:
-                try:
-                    send_keys("{ENTER}")
-                except Exception:
-                    pass
-                time.sleep(0.2)
-
-def after_file_loaded_double_click_and_confirm(win, wait_before=5.0):
+    wait_settled(win, quiet_ms=150, timeout=1.0, budget=0.3, label="services focus")
+
+    layout = {}
+    plan = plan_service_toggles(win, svc_map, layout)
+    if brand and ecu:
+        SERVICE_CAPABILITIES.learn(brand, ecu, layout, services)
+    clicked, unknown, skipped = [], [], 0
+    for item in plan:
+        if item["lbl"] is None:
+            logging.info(f"Service label not found: {item['label']}")
+            continue
+        if item["source"] != "pattern":
+            logging.info(f"{item['label']}: slider state unknown (no Toggle pattern); not clicked")
+            unknown.append(item["label"])
+            continue
+        if item["state"] == item["want"]:
+            logging.info(f"{item['label']} already {item['want']}; not clicked")
+            skipped += 1
+            continue
+        if click_toggle_by_label(win, item["label"], item["lbl"]):
+            clicked.append(item)
+            _dismiss_toggle_popup(win)
+
+    failed = []
+    for item in clicked:
+        if wait_until(lambda: read_toggle_state(item["toggle"])[0] == item["want"],
+                      timeout=1.5, poll=0.1, label=f"{item['label']} {item['want']}"):
+            item["state"] = item["want"]
+        else:
+            failed.append(item["label"])
+            logging.info(f"{item['label']} did not switch {item['want']} after clicking")
+    stage_note(toggles_clicked=len(clicked), toggles_skipped=skipped, toggles_failed=len(failed),
+               toggles_unknown=len(unknown), services_absent=sum(1 for item in plan if item["lbl"] is None))
+    problems = []
+    if failed:
+        problems.append(f"did not switch as requested: {', '.join(failed)}")
+    if unknown:
+        problems.append(f"state could not be read: {', '.join(unknown)}")
+    if problems:
+        raise ServiceVerificationError("Service toggles " + "; ".join(problems))
+    return plan
+
+def after_file_loaded_double_click_and_confirm(win, wait_before=5.0, app=None, load_timeout=None) -> bool:
     """
     After BIN is loaded:
-      1) wait a bit
+      1) wait until the Open dialog is gone, the loading spinner has disappeared,
+         the window has stopped repainting and DaVinci's CPU is idle, for at most
+         `load_timeout` (default `wait_before`, the former fixed pause; only the
+         repaint check when no app is connected)
       2) double-click in the central work area
       3) wait for a popup and click YES if present
+    Returns False when the load did not settle within `load_timeout` (steps 2-3 still run).
     """
     # 1) wait for DaVinci to finish loading the file
-    time.sleep(wait_before)
+    load_timeout = load_timeout or wait_before
+    t0 = time.perf_counter()
+    if app is None:
+        loaded = wait_settled(win, timeout=load_timeout, budget=wait_before, label="file loaded")
+    else:
+        settle = settle_detector()
+        stage_note(vision=_busy_detector() is not None, settle=settle is not None)
+        loaded = wait_idle(app, timeout=load_timeout,
+                           ready=lambda: (find_any_open_dialog() is None and not _screen_busy(win)
+                                          and _screen_settled(win, settle)),
+                           budget=wait_before, label="file loaded")
+    STAGE_MODEL.add("load_wait", time.perf_counter() - t0)  # at least load_timeout when not loaded
+    if not loaded:
+        logging.info(f"after_file_loaded: DaVinci did not settle within {load_timeout:.1f}s; continuing")
 
     # 2) double-click roughly in the center (you can tweak this later)
     try:
@@ -1465,13 +2812,41 @@ def after_file_loaded_double_click_and_confirm(win, wait_before=5.0):
         maybe_click_yes_popup(timeout=8)
     except Exception:
         pass
+    return bool(loaded)
 
 
 ######## end of solution automation########
-def run(exe: Path, brand: str, ecu: str, input_path: str | None = None, services: str = ""):
-    """Launch/attach DaVinci, select brand+ECU, and stop once the Open dialog appears.
-    input_path and services are accepted for compatibility but not used here.
+def run(exe: Path, brand: str, ecu: str, input_path: str | None = None, services: str = "",
+        open_direct: bool = False):
+    """Launch/attach DaVinci, select brand+ECU, load the BIN, apply services and save.
+
+    With open_direct, the BIN is passed on DaVinci's command line when the build
+    supports it, skipping the tree selection and Open-dialog stages.
     """
+    run_start, run_t0 = time.time(), time.perf_counter()
+    WAIT_TOTALS["waited"] = WAIT_TOTALS["saved"] = 0.0
+    _FAILED_STAGES.clear()
+    total = {"stage": "total", "start": round(run_start, 3), "retries": 0, "outcome": "done"}
+    try:
+        _run_stages(exe, brand, ecu, input_path, services, open_direct)
+    except BaseException as e:
+        total["outcome"] = "timeout" if isinstance(e, UIATimeout) else "error"
+        raise
+    finally:
+        if _FAILED_STAGES:
+            # The innermost stage an exception left (also when the run caught it and carried on)
+            failed = _FAILED_STAGES[0]
+            total["failed_stage"] = failed["stage"]
+            total["outcome"] = "timeout" if failed.get("outcome") == "timeout" else "error"
+        STAGE_MODEL.save()  # also when a stage failed, so its duration is not lost
+        logging.info(f"condition waits: {WAIT_TOTALS['waited']:.2f}s waited, "
+                     f"{WAIT_TOTALS['saved']:.2f}s saved against the former fixed sleeps")
+        total["duration"] = round(time.perf_counter() - run_t0, 3)
+        total["wait_saved"] = round(WAIT_TOTALS["saved"], 3)
+        emit_stage_event(total)
+
+
+def _run_stages(exe: Path, brand: str, ecu: str, input_path: str | None, services: str, open_direct: bool):
     # Guard for missing brand or ecu
     if not (brand or "").strip() or not (ecu or "").strip():
         message = f"Missing brand or ECU from agent (brand='{brand}', ecu='{ecu}')"
@@ -1479,92 +2854,548 @@ def run(exe: Path, brand: str, ecu: str, input_path: str | None = None, services
         print(f"AUTOMATION_ERROR: {message}")
         raise RuntimeError(message)
 
-    launch_if_needed(exe)
-    logging.info("launched/attached")
-    app, win = connect_window()
-    tree = get_tree(win)
-    logging.info(f"selecting brand={brand} ecu={ecu}")
-    if tree is None:
-        select_brand_ecu_keys(win, brand, ecu)
-    else:
-        select_brand_ecu_ui(tree, brand, ecu)
-    logging.info("brand/ecu selection done")
-    # Close the info dialog synchronously once; focus should now be in 'File name'
-    try:
-        maybe_close_info_dialog(timeout=5)
-    except Exception:
-        pass
-
+    STAGE_MODEL.begin(brand, ecu, services)
     if not input_path:
         raise RuntimeError("Missing --input path: required to derive the filename.")
-
     filename = Path(input_path).name
-    # As soon as the info dialog closes, immediately start typing the path and filename.
-    type_folder_and_filename(r"C:\ecu_files\original", filename)
-    print("OK: typed full path and submitted.")
-
-    # 1) Wait for file to load (5s), double-click, and accept YES popup
-    try:
-        after_file_loaded_double_click_and_confirm(win)
-    except Exception as e:
-        logging.info(f"after_file_loaded_double_click_and_confirm failed: {e}")
+    bin_path = str(Path(r"C:\ecu_files\original") / filename)
+
+    # Direct open: which mode applies, and is it known not to work on this build?
+    direct_mode = None
+    if open_direct:
+        direct_mode = "handoff" if (_cached_window() is not None or _main_windows()) else "launch"
+        if _open_direct_support(exe, direct_mode) is False:
+            logging.info(f"open-direct {direct_mode} not supported by this DaVinci build; using the Open dialog")
+            direct_mode = None
+
+    with timed_stage("launch"):
+        if direct_mode == "launch":
+            if not exe.exists():
+                raise FileNotFoundError(f"DaVinci not found: {exe}")
+            subprocess.Popen([str(exe), bin_path], shell=False, cwd=str(exe.parent))
+            wait_until(lambda: _main_windows(), timeout=30, poll=0.2, label="main window")
+        else:
+            launch_if_needed(exe)
+    logging.info("launched/attached")
+    SERVICE_CAPABILITIES.version = exe_version(exe)
+    with timed_stage("connect"):
+        app, win = connect_window()
+
+    opened_direct = False
+    if direct_mode:
+        with timed_stage("open_direct") as ev:
+            ev["mode"] = direct_mode
+            # The previous job's BIN may have the same name: require a change from here
+            before = ((_window_title(win), _file_shown(win, filename)) if direct_mode == "handoff"
+                      else (None, False))
+            forwarded = _handoff_open(exe, bin_path) if direct_mode == "handoff" else True
+            if forwarded:
+                opened_direct = bool(wait_until(lambda: _file_newly_shown(win, filename, before),
+                                                timeout=STAGE_MODEL.timeout("open_direct", OPEN_DIRECT_LOAD_TIMEOUT),
+                                                poll=0.5, label="open-direct load"))
+            _remember_open_direct(exe, direct_mode, opened_direct, slow=forwarded and not opened_direct)
+            if not opened_direct:
+                ev["outcome"] = "timeout" if forwarded else "unsupported"
+
+    if opened_direct:
+        print("OK: BIN opened directly.")
+        for name in OPEN_DIRECT_SKIPS:
+            emit_stage_event({"stage": name, "start": round(time.time(), 3), "duration": 0.0,
+                              "retries": 0, "outcome": "skipped"})
+    else:
+        with timed_stage("tree_lookup") as ev:
+            tree = get_tree(win)
+            if tree is None:
+                ev["outcome"] = "fallback_keys"
+        logging.info(f"selecting brand={brand} ecu={ecu}")
+        with timed_stage("select_brand_ecu"):
+            if tree is None:
+                select_brand_ecu_keys(win, brand, ecu)
+            else:
+                select_brand_ecu_ui(tree, brand, ecu, exe=exe)
+        logging.info("brand/ecu selection done")
+        # Close the info dialog synchronously once; focus should now be in 'File name'
+        with timed_stage("info_dialog") as ev:
+            try:
+                if not maybe_close_info_dialog(timeout=5):
+                    ev["outcome"] = "none"
+            except Exception:
+                ev["outcome"] = "error"
+
+        # Make sure the Open dialog is up before typing into it (event-driven, short cap)
+        with timed_stage("open_dialog_wait") as ev:
+            if wait_for_dialog(OPEN_DIALOG_KINDS, timeout=STAGE_MODEL.timeout("open_dialog_wait", 3)) is None:
+                ev["outcome"] = "timeout"
+        # As soon as the info dialog closes, immediately start typing the path and filename.
+        with timed_stage("open_file"):
+            type_folder_and_filename(r"C:\ecu_files\original", filename)
+        print("OK: typed full path and submitted.")
+
+    # 1) Wait for file to load (idle, at most 5s on a cold start), double-click, and accept YES popup
+    with timed_stage("post_load_confirm") as ev:
+        try:
+            if not after_file_loaded_double_click_and_confirm(win, app=app,
+                                                              load_timeout=STAGE_MODEL.timeout("load_wait", 5)):
+                ev["outcome"] = "timeout"
+        except Exception as e:
+            ev["outcome"] = "error"
+            logging.info(f"after_file_loaded_double_click_and_confirm failed: {e}")
     
     # 2) Apply services (DPF OFF, EGR OFF, etc.)
-    try:
-        apply_services(win, services)
-    except Exception as e:
-        logging.info(f"apply_services failed: {e}")
+    with timed_stage("apply_services") as ev:
+        try:
+            apply_services(win, services, brand, ecu)
+        except ServiceVerificationError as e:
+            # Never save (and report) a .mod that lacks a requested service
+            logging.error(f"AUTOMATION_ERROR: {e}")
+            print(f"AUTOMATION_ERROR: {e}")
+            raise
+        except Exception as e:
+            ev["outcome"] = "error"
+            logging.info(f"apply_services failed: {e}")
 
     # 3) Open Save Mod menu via Alt+M and confirm with ENTER twice
-    try:
-        win.set_focus()
-    except Exception:
-        pass
-    try:
-        send_keys('%m')
-        time.sleep(0.3)
-        send_keys('{ENTER}')
-        time.sleep(0.2)
-        send_keys('{ENTER}')
-        time.sleep(0.5)
-        logging.info('Triggered Save via Alt+M + ENTER + ENTER')
-    except Exception as e:
-        logging.info(f"Alt+M Save sequence failed: {e}")
+    with timed_stage("save_mod") as ev:
+        try:
+            win.set_focus()
+        except Exception:
+            pass
+        try:
+            send_keys('%m')
+            wait_until(_popup_menu_open, timeout=0.3, poll=0.05, budget=0.3, label="Alt+M menu")
+            send_keys('{ENTER}')
+            wait_for_dialog(["info", "yes_popup", "legacy_dialog", "save_dialog"], timeout=0.2, poll=0.05, budget=0.2)
+            send_keys('{ENTER}')
+            # The former 0.5 s pause is covered by the Save dialog wait below
+            logging.info('Triggered Save via Alt+M + ENTER + ENTER')
+        except Exception as e:
+            ev["outcome"] = "error"
+            logging.info(f"Alt+M Save sequence failed: {e}")
 
     
     # PASSIVE WAIT for the Save dialog — handle save as required
     logging.info("Passive wait: watching for Save dialog to appear …")
     try:
-        backend, sdlg = wait_save_dialog(timeout=180)  # explicitly detects 'Save Mod File' now
-        try:
-            sdlg.set_focus()
-        except Exception:
-            pass
+        with timed_stage("save_dialog_wait") as ev:
+            try:
+                # explicitly detects 'Save Mod File' now; 180 s until this ECU has a history
+                backend, sdlg = wait_save_dialog(timeout=STAGE_MODEL.timeout("save_dialog_wait", 180))
+            except UIATimeout:
+                ev["outcome"] = "timeout"
+                raise
+        with timed_stage("save_dialog") as ev:
+            try:
+                sdlg.set_focus()
+            except Exception:
+                pass
 
-        # Navigate using the address bar to C:\\ecu_files\\modified and keep existing filename
-        saved_path = save_via_address_bar_using_existing_name(sdlg, target_folder=r"C:\\ecu_files\\modified")
-        if saved_path:
-            print(f"SAVED_PATH:{saved_path}")
-        else:
-            # Ensure the agent still receives a line it can parse
-            # Try to read the filename again and synthesize the path
-            fallback_name = get_current_filename_from_edit(sdlg) or "modified.bin"
-            print(f"SAVED_PATH:{str(Path(r'C:\\\\ecu_files\\\\modified') / Path(fallback_name).name)}")
+            # Navigate using the address bar to C:\\ecu_files\\modified and keep existing filename
+            saved_path = save_via_address_bar_using_existing_name(sdlg, target_folder=r"C:\\ecu_files\\modified")
+            if saved_path:
+                print(f"SAVED_PATH:{saved_path}")
+            else:
+                ev["outcome"] = "fallback_name"
+                # Ensure the agent still receives a line it can parse
+                # Try to read the filename again and synthesize the path
+                fallback_name = get_current_filename_from_edit(sdlg) or "modified.bin"
+                print(f"SAVED_PATH:{str(Path(r'C:\\\\ecu_files\\\\modified') / Path(fallback_name).name)}")
 
         # Handle optional overwrite prompts and wait for the dialog to close
-        try:
-            maybe_confirm_overwrite(timeout=8)
-        except Exception:
-            pass
-        try:
-            _wait_dialog_gone(sdlg, timeout=20)
-        except Exception:
-            pass
+        with timed_stage("overwrite_confirm") as ev:
+            try:
+                if not maybe_confirm_overwrite(timeout=8):
+                    ev["outcome"] = "none"
+            except Exception:
+                ev["outcome"] = "error"
+        with timed_stage("dialog_close") as ev:
+            try:
+                if not _wait_dialog_gone(sdlg, timeout=STAGE_MODEL.timeout("dialog_close", 20)):
+                    ev["outcome"] = "timeout"
+            except Exception:
+                ev["outcome"] = "error"
+        # Let DaVinci finish writing/repainting before the next job reuses the window
+        with timed_stage("save_settle") as ev:
+            if not wait_settled(win, timeout=STAGE_MODEL.timeout("save_settle", 10), label="after save"):
+                ev["outcome"] = "timeout"
 
         
     except UIATimeout:
         logging.info("No Save dialog detected within timeout; continuing.")
 
+# --- Offline benchmarks (no DaVinci needed; pywinauto must still import) ---
+#   python davinci_automation.py --benchmark-classify [--ticks 200]
+#   python davinci_automation.py --benchmark-walk
+
+class _SyntheticElement:
+    """UIA wrapper stand-in; `reads` counts the calls that would cross into the target process,
+    `visits` the elements touched by child iteration or descendants()."""
+    reads = 0
+    visits = 0
+
+    def __init__(self, control_type: str, text: str = "", children=(), class_name: str = "", dialog: bool = False):
+        self.control_type, self.class_name = control_type, class_name
+        self.text, self.dialog = text, dialog
+        self._children = list(children)
+        self.handle = id(self)
+
+    @property
+    def element_info(self):
+        _SyntheticElement.reads += 1
+        return self
+
+    def window_text(self):
+        _SyntheticElement.reads += 1
+        return self.text
+
+    def iter_children(self):
+        for c in self._children:
+            _SyntheticElement.reads += 1
+            _SyntheticElement.visits += 1
+            yield c
+
+    def children(self, control_type=None):
+        return [c for c in self.iter_children() if control_type is None or c.control_type == control_type]
+
+    def descendants(self, control_type=None):
+        """Like pywinauto: the whole subtree is searched even when filtered by type."""
+        found, stack = [], list(reversed(self._children))
+        while stack:
+            c = stack.pop()
+            _SyntheticElement.reads += 1
+            _SyntheticElement.visits += 1
+            if control_type is None or c.control_type == control_type:
+                found.append(c)
+            stack.extend(reversed(c._children))
+        return found
+
+    def is_dialog(self):
+        _SyntheticElement.reads += 1
+        return self.dialog
+
+    def is_visible(self):
+        _SyntheticElement.reads += 1
+        return True
+
+    def child_window(self, **criteria):
+        return _SyntheticSpec(self.descendants, criteria)
+
+    def wrapper_object(self):
+        return self
+
+    def set_focus(self):
+        pass
+
+    def click_input(self, **kwargs):
+        pass
+
+    def type_keys(self, keys, **kwargs):
+        pass
+
+
+class _SyntheticSpec:
+    """WindowSpecification stand-in over synthetic elements. exists() looks once
+    instead of retrying for `timeout`, so baseline figures are a lower bound."""
+
+    def __init__(self, candidates, criteria):
+        self.candidates, self.criteria = candidates, criteria
+
+    def _matches(self, e) -> bool:
+        c = self.criteria
+        return (("title" not in c or e.window_text() == c["title"])
+                and ("title_re" not in c or re.match(c["title_re"], e.window_text()) is not None)
+                and ("control_type" not in c or e.element_info.control_type == c["control_type"])
+                and ("class_name" not in c or e.element_info.class_name == c["class_name"]))
+
+    def wrapper_object(self):
+        for e in self.candidates():
+            if self._matches(e):
+                return e
+        raise LookupError(self.criteria)
+
+    def exists(self, timeout=None):
+        try:
+            self.wrapper_object()
+            return True
+        except LookupError:
+            return False
+
+    def child_window(self, **criteria):
+        return _SyntheticSpec(lambda: self.wrapper_object().descendants(), criteria)
+
+    def __getattr__(self, name):
+        return getattr(self.wrapper_object(), name)
+
+
+class _SyntheticDesktop:
+    """Desktop(backend=...) stand-in: win32 enumerates every top-level window, as the real backend does."""
+
+    def __init__(self, uia, win32_dialogs):
+        self.uia, self.win32 = uia, uia + win32_dialogs
+
+    def __call__(self, backend="uia"):
+        self.backend = backend
+        return self
+
+    def windows(self, **criteria):
+        ws = self.uia if self.backend == "uia" else self.win32
+        return [w for w in ws if _SyntheticSpec(None, criteria)._matches(w)]
+
+    def window(self, **criteria):
+        return _SyntheticSpec(lambda: self.windows(), criteria)
+
+
+def _synthetic_app_window(i: int):
+    E = _SyntheticElement
+    toolbar = E("ToolBar", children=[E("Button", f"Tool {k}") for k in range(12)])
+    form = E("Pane", children=[E("Text", f"Field {k}") for k in range(10)] + [E("Edit", "") for _ in range(4)])
+    return E("Window", f"Document {i} - Editor", [E("MenuBar", children=[E("MenuItem", m) for m in
+                                                                     ("File", "Edit", "View", "Help")]),
+                                                  toolbar, form, E("StatusBar", "Ready")])
+
+
+def _synthetic_desktop(n_windows: int):
+    """(uia windows, win32 #32770 dialogs) of a desktop with DaVinci, its Save dialog and an overwrite prompt."""
+    E = _SyntheticElement
+    main = E("Window", MAIN_TITLES[0], [
+        E("Tree", children=[E("TreeItem", f"Brand {k}") for k in range(60)]),
+        E("Pane", children=[E("Button", "Save Mod File"), E("Text", "DPF"), E("Text", "EGR")]),
+    ])
+    save = E("Window", "Save Mod File", [E("Edit", "File name:"), E("Button", "Save"), E("Button", "Cancel")],
+             dialog=True)
+    confirm = E("Dialog", "Confirm Save As", [E("Text", "already exists. Do you want to replace it?"),
+                                              E("Button", "&Yes"), E("Button", "&No")], class_name="#32770")
+    others = [_synthetic_app_window(i) for i in range(max(0, n_windows - 3))]
+    return [main] + others + [save], [confirm]
+
+
+# One polling tick of each dialog finder the desktop scanner replaced, as they
+# were written (Desktop passed in, sleeps and click fallbacks trimmed).
+def _baseline_close_info(desktop):
+    for title in ["INFO", "Info", "Information"]:
+        dlg = desktop(backend="uia").window(title=title, control_type="Window")
+        if dlg.exists(timeout=0.2):
+            return dlg
+    for w in desktop(backend="uia").windows():
+        if "bdm read is required" in (w.window_text() or "").lower():
+            return w
+    return None
+
+
+def _baseline_top_level_file_dialog(desktop):
+    dlg = desktop(backend="win32").window(class_name="#32770")
+    if dlg.exists(timeout=0.2):
+        return dlg.wrapper_object()
+    for w in desktop(backend="uia").windows():
+        if not w.descendants(control_type="Edit"):
+            continue
+        for b in w.descendants(control_type="Button"):
+            n = (b.window_text() or "").lower()
+            if any(k in n for k in OPEN_BUTTON_KEYS + SAVE_BUTTON_KEYS):
+                return w.wrapper_object()
+    return None
+
+
+def _baseline_any_open_dialog(desktop):
+    for hint in OPEN_HINTS:
+        d = desktop(backend="uia").window(title_re=hint, control_type="Window")
+        if d.exists(timeout=0.2):
+            return d.wrapper_object()
+    dlg = _baseline_top_level_file_dialog(desktop)
+    if dlg is not None:
+        return dlg
+    for w in desktop(backend="uia").windows():
+        if not w.is_visible() or not w.descendants(control_type="Edit"):
+            continue
+        for btn in w.descendants(control_type="Button"):
+            if any(k in (btn.window_text() or "").lower() for k in OPEN_BUTTON_KEYS):
+                return w.wrapper_object()
+    for w in desktop(backend="uia").windows():
+        if not w.is_visible():
+            continue
+        for t in w.descendants(control_type="Text"):
+            if any(k in (t.window_text() or "").lower() for k in FILENAME_KEYS):
+                return w.wrapper_object()
+    return None
+
+
+def _baseline_locate_open_dialog(desktop):
+    for hint in OPEN_HINTS:
+        dlg = desktop(backend="uia").window(title_re=hint, control_type="Window")
+        if dlg.exists(timeout=0.2):
+            return dlg
+    for w in desktop(backend="uia").windows():
+        if w.is_dialog():
+            for b in w.descendants(control_type="Button"):
+                if (b.window_text() or "").strip().lower().startswith(("open", "öffnen", "abrir", "откры")):
+                    return w
+    dlg = desktop(backend="win32").window(class_name="#32770")
+    return dlg if dlg.exists(timeout=0.2) else None
+
+
+def _baseline_save_dialog(desktop):
+    for hint in SAVE_HINTS:
+        dlg = desktop(backend="uia").window(title_re=hint, control_type="Window")
+        if dlg.exists(timeout=0.4):
+            return dlg
+    for w in desktop(backend="uia").windows():
+        if w.is_dialog() and "open" not in (w.window_text() or "").lower():
+            if any(btn.window_text().strip().lower().startswith("save")
+                   for btn in w.descendants(control_type="Button")):
+                return w
+    return None
+
+
+def _baseline_confirm_overwrite(desktop):
+    for backend in ("uia", "win32"):
+        for w in desktop(backend=backend).windows():
+            if any(k in (w.window_text() or "").lower() for k in OVERWRITE_KEYS):
+                for yes in YES_LABELS:
+                    b = (w.child_window(title=yes, control_type="Button") if backend == "uia"
+                         else w.child_window(title=yes))
+                    if b.exists():
+                        return b.wrapper_object()
+                return w
+    return None
+
+
+def _baseline_yes_popup(desktop):
+    for backend in ("uia", "win32"):
+        for w in desktop(backend=backend).windows():
+            for yes_label in YES_LABELS:
+                btn = (w.child_window(title=yes_label, control_type="Button") if backend == "uia"
+                       else w.child_window(title=yes_label))
+                if btn.exists(timeout=0.2):
+                    return btn.wrapper_object()
+    return None
+
+
+_BASELINE_FINDERS = (_baseline_close_info, _baseline_any_open_dialog, _baseline_locate_open_dialog,
+                     _baseline_save_dialog, _baseline_confirm_overwrite, _baseline_yes_popup)
+
+
+def _benchmark_classify(ticks: int) -> int:
+    """Per-tick cost of classifying synthetic desktops of 5/20/50 windows.
+
+    The "old" rows run one tick of the dialog finders the scanner replaced
+    (_baseline_*): all six, the Save dialog wait, and find_any_open_dialog as
+    polled by the open/load waits. The "new" rows are one _classify_desktop()
+    per tick with the matching kinds. Reads are calls that would cross into
+    another process.
+    """
+    wrong = 0
+    for n in (5, 20, 50):
+        uia, win32 = _synthetic_desktop(n)
+        desktop = _SyntheticDesktop(uia, win32)
+        cases = {"old all":   lambda: [f(desktop) for f in _BASELINE_FINDERS],
+                 "new all":   lambda: _classify_desktop(lambda: uia, lambda: win32),
+                 "old save":  lambda: _baseline_save_dialog(desktop),
+                 "new save":  lambda: _classify_desktop(lambda: uia, lambda: win32, {"save_dialog"}),
+                 "old open":  lambda: _baseline_any_open_dialog(desktop),
+                 "new open":  lambda: _classify_desktop(lambda: uia, lambda: win32, OPEN_DIALOG_KINDS)}
+        print(f"{n} windows:")
+        for label, tick in cases.items():
+            _CONTROL_CACHE.clear()
+            _SyntheticElement.reads = 0
+            t0 = time.perf_counter()
+            for _ in range(ticks):
+                snap = tick()
+            print(f"  {label:10s} {(time.perf_counter() - t0) * 1000 / ticks:6.2f} ms "
+                  f"{_SyntheticElement.reads / ticks:7.0f} reads per tick")
+            if label == "new all":
+                found = {k: (snap.first(k).title if snap.first(k) else None)
+                         for k in ("davinci_main", "save_dialog", "overwrite_confirm")}
+                if found != {"davinci_main": MAIN_TITLES[0], "save_dialog": "Save Mod File",
+                             "overwrite_confirm": "Confirm Save As"}:
+                    print(f"  <-- WRONG classification: {found}")
+                    wrong += 1
+    return 1 if wrong else 0
+
+
+def _synthetic_main_window(tree_items: int):
+    """DaVinci-like main window: a brand tree of `tree_items` items (20 ECUs per brand),
+    the toolbar, the service labels with their sliders and a hosted Open dialog."""
+    E = _SyntheticElement
+    brands = [E("TreeItem", f"Brand {b}", [E("TreeItem", f"ECU {b}.{k}") for k in range(19)])
+              for b in range(max(1, tree_items // 20))]
+    services = []
+    for label in SERVICE_LABELS.values():
+        services += [E("Text", label), E("CheckBox", "")]
+    picker = E("Window", "Open", [E("Pane", children=[
+        E("List", children=[E("ListItem", f"file{k}.bin") for k in range(200)]),
+        E("Edit", "File name:"), E("Button", "Open"), E("Button", "Cancel")])])
+    return E("Window", MAIN_TITLES[0], [
+        E("Pane", children=[E("Tree", children=brands)]),
+        E("Pane", children=[E("ToolBar", children=[E("Button", "Open File"), E("Button", "Save Mod File")])]),
+        E("Pane", children=services),
+        picker,
+    ])
+
+
+def _legacy_open_dialog_within(win):
+    """find_open_dialog_within before the bounded walk (descendants() per candidate)."""
+    candidates = [c for ct in ("Window", "Pane", "Group") for c in win.descendants(control_type=ct)]
+    for c in candidates:
+        if c.descendants(control_type="Edit") and any(
+                "open" in (b.window_text() or "").lower() for b in c.descendants(control_type="Button")):
+            return c
+    return None
+
+
+def _legacy_service_labels(win, labels):
+    """One Text scan per service, as click_toggle_by_label did."""
+    found = {}
+    for label in labels:
+        for t in win.descendants(control_type="Text"):
+            if (t.window_text() or "").strip().upper() == label:
+                found[label] = t
+                break
+    return found
+
+
+def _legacy_save_button(win):
+    for b in win.descendants(control_type="Button"):
+        if (b.window_text() or "").strip().lower().startswith("save"):
+            return b
+    return None
+
+
+def _live_save_button(win):
+    """trigger_save_mod_file's live search (no UIA snapshot)."""
+    for b in walk_elements(win, control_type="Button", prune=BULK_CONTAINERS):
+        if (b.window_text() or "").strip().lower().startswith("save"):
+            return b
+    return None
+
+
+def _benchmark_walk() -> int:
+    """Element visits and reads of the main-window finders on synthetic trees of 1k/10k/50k items,
+    descendants() scans (before) vs. walk_elements() (now)."""
+    labels = ["DPF", "EGR", "TVA"]
+    finders = [
+        ("open dialog within", _legacy_open_dialog_within, find_open_dialog_within),
+        ("3 service labels", lambda w: _legacy_service_labels(w, labels),
+         lambda w: find_service_labels(w, labels, toggles=[])),
+        ("Save Mod button", _legacy_save_button, _live_save_button),
+    ]
+    wrong = 0
+    for n in (1000, 10000, 50000):
+        win = _synthetic_main_window(n)
+        print(f"{n} tree items:")
+        for label, before, now in finders:
+            row = []
+            results = []
+            for fn in (before, now):
+                _SyntheticElement.reads = _SyntheticElement.visits = 0
+                t0 = time.perf_counter()
+                results.append(fn(win))
+                row.append(f"{_SyntheticElement.visits:7d} visits {_SyntheticElement.reads:7d} reads "
+                           f"{(time.perf_counter() - t0) * 1000:7.1f} ms")
+            same = (set(results[0]) == set(results[1])) if isinstance(results[0], dict) else results[0] is results[1]
+            wrong += not same or not results[1]
+            print(f"  {label:18s} before {row[0]} | now {row[1]}" + ("" if same and results[1] else "  <-- DIFFERENT"))
+    return 1 if wrong else 0
+
+
 def parse_args():
     p = argparse.ArgumentParser(
         description=(
@@ -1573,23 +3404,80 @@ def parse_args():
             "  2) Select BRAND and ECU.\n"
             "  3) Auto-load the --input BIN from C:\\\\ecu_files\\\\original.\n"
             "  4) Apply --services (e.g. 'DPF OFF, EGR OFF').\n"
-            "  5) Save the modified file into C:\\\\ecu_files\\\\modified."
+            "  5) Save the modified file into C:\\\\ecu_files\\\\modified.\n"
+            "With --worker, stay resident and read jobs as JSON lines from stdin."
         )
     )
-    p.add_argument("--exe", required=True, help="Path to davinci.exe")
-    p.add_argument("--brand", required=True, help="Brand as shown in DaVinci (e.g., BMW)")
-    p.add_argument("--ecu", required=True, help="ECU as shown under the brand (e.g., Bosch MEVD17.2)")
+    p.add_argument("--exe", help="Path to davinci.exe")
+    p.add_argument("--brand", help="Brand as shown in DaVinci (e.g., BMW)")
+    p.add_argument("--ecu", help="ECU as shown under the brand (e.g., Bosch MEVD17.2)")
     # Back-compat only — these values are parsed but unused in this script
     p.add_argument("--input", help="Full path to the BIN file (copied into C:\\ecu_files\\original)")
     p.add_argument("--services", default="", help="Services string e.g. 'DPF OFF, EGR OFF'")
-    return p.parse_args()
+    p.add_argument("--open-direct", action="store_true",
+                   help="Pass the BIN on DaVinci's command line when the build supports it (auto-detected)")
+    p.add_argument("--worker", action="store_true",
+                   help="Persistent worker: read {exe, brand, ecu, input, services, open_direct} JSON jobs from stdin")
+    p.add_argument("--benchmark-classify", action="store_true",
+                   help="Time the desktop classifier on synthetic desktops of 5/20/50 windows and exit")
+    p.add_argument("--ticks", type=int, default=200, help="Polling ticks per benchmark case")
+    p.add_argument("--benchmark-walk", action="store_true",
+                   help="Count element visits of the main-window finders on synthetic trees and exit")
+    a = p.parse_args()
+    if not (a.worker or a.benchmark_classify or a.benchmark_walk):
+        missing = [f"--{n}" for n in ("exe", "brand", "ecu") if not getattr(a, n)]
+        if missing:
+            p.error(f"the following arguments are required: {', '.join(missing)}")
+    return a
+
+def worker_loop():
+    """Persistent worker: one JSON job per stdin line, results as marker lines on stdout.
+
+    Imports, COM type libraries and the connected DaVinci window are reused across
+    jobs. Each job ends with a `JOB_DONE:{...}` line carrying its exit code, using
+    the same codes as a one-shot run (0 ok, 2 UI timeout, 1 other error).
+    """
+    try:
+        sys.stdout.reconfigure(line_buffering=True)
+    except Exception:
+        pass
+    logging.info("worker started")
+    print("WORKER_READY", flush=True)
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        t0 = time.time()
+        job_id = None
+        try:
+            job = json.loads(line)
+            job_id = job.get("id")
+            logging.info(f"worker job {job_id} started")
+            run(Path(job["exe"]), job.get("brand", ""), job.get("ecu", ""),
+                input_path=job.get("input"), services=job.get("services", ""),
+                open_direct=bool(job.get("open_direct")))
+            code = 0
+        except UIATimeout as e:
+            print("ERROR:", str(e)); code = 2
+        except Exception as e:
+            print("ERROR:", str(e)); code = 1
+        done = {"id": job_id, "code": code, "seconds": round(time.time() - t0, 3)}
+        logging.info(f"worker job {job_id} finished: {done}")
+        print(f"JOB_DONE:{json.dumps(done)}", flush=True)
 
 if __name__ == "__main__":
     try:
         a = parse_args()
-        run(Path(a.exe), a.brand, a.ecu, input_path=a.input, services=a.services)
+        if a.benchmark_classify:
+            sys.exit(_benchmark_classify(a.ticks))
+        if a.benchmark_walk:
+            sys.exit(_benchmark_walk())
+        if a.worker:
+            worker_loop()
+            sys.exit(0)
+        run(Path(a.exe), a.brand, a.ecu, input_path=a.input, services=a.services, open_direct=a.open_direct)
         sys.exit(0)
     except UIATimeout as e:
         print("ERROR:", str(e)); sys.exit(2)
     except Exception as e:
-        print("ERROR:", str(e)); sys.exit(1)
\ No newline at end of file
+        print("ERROR:", str(e)); sys.exit(1)
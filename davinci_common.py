@@ -0,0 +1,143 @@
+# davinci_common.py — request mapping shared by davinci_automation.py and agent.py
+# Standard library only: agent.py imports it without pulling in pywinauto.
+
+from pathlib import Path
+
+
+# Map various backend brand inputs to the label used in DaVinci's brand tree
+BRAND_ALIASES = {
+    # VAG cluster
+    "volkswagen": "VAG",
+    "vw": "VAG",
+    "audi": "VAG",
+    "seat": "VAG",
+    "skoda": "VAG",
+
+    # Direct one-to-one caps (for completeness, in case backend sends lowercase)
+    "bmw": "BMW",
+    "fiat": "FIAT",
+    "lancia": "LANCIA",
+    "smart": "SMART",
+    "dodge": "DODGE",
+    "chrysler": "CHRYSLER",
+    "iveco": "IVECO",
+    "peugeot": "PEUGEOT",
+    "opel": "OPEL",
+    "renault": "RENAULT",
+    "ford": "FORD",
+    "mazda": "MAZDA",
+    "land rover": "LAND ROVER",
+    "jaguar": "JAGUAR",
+    "kia": "KIA",
+    "hyundai": "HYUNDAI",
+    "volvo": "VOLVO",
+    "suzuki": "SUZUKI",
+
+    # Special cases where backend name and DaVinci label differ
+    "alfa romeo": "ALFA",
+    "alfa": "ALFA",
+    "mercedes-benz": "MERCEDES",
+    "mercedes benz": "MERCEDES",
+    "mercedes": "MERCEDES",
+}
+
+def effective_brand(brand: str) -> str:
+    """
+    Map various backend brand inputs to the brand label used by DaVinci's tree.
+
+    Examples:
+      - 'Volkswagen', 'VW', 'Audi', 'Seat', 'Skoda' → 'VAG'
+      - 'Mercedes-Benz', 'Mercedes Benz', 'Mercedes' → 'MERCEDES'
+      - 'Alfa Romeo', 'Alfa' → 'ALFA'
+      - Other brands use an uppercase-normalized version of the original string.
+    """
+    raw = (brand or "").strip()
+    b = raw.lower()
+
+    # First try explicit mapping
+    mapped = BRAND_ALIASES.get(b)
+    if mapped:
+        return mapped
+
+    # Fallback: just uppercase whatever we got, so it matches DaVinci's caps style
+    return raw.upper()
+
+
+def exe_version(exe) -> str:
+    """File version of the DaVinci executable (size/mtime when it has no version resource)."""
+    if exe is None:
+        return "unknown"
+    try:
+        import win32api
+        info = win32api.GetFileVersionInfo(str(exe), "\\")
+        ms, ls = info["FileVersionMS"], info["FileVersionLS"]
+        return f"{ms >> 16}.{ms & 0xFFFF}.{ls >> 16}.{ls & 0xFFFF}"
+    except Exception:
+        pass
+    try:
+        st = Path(exe).stat()
+        return f"size={st.st_size};mtime={int(st.st_mtime)}"
+    except OSError:
+        return "unknown"
+
+
+SERVICE_LABELS = {
+    "DPF": "DPF",
+    "EGR": "EGR",
+    "TVA": "TVA",
+    "MAF": "MAF",
+    "FLAPS": "FLAPS",
+    "ADBLUE": "ADBLUE",
+    "LAMBDA": "LAMBDA",
+    "STARTSTOP": "STARTSTOP",
+}
+
+def parse_services_map(services: str) -> dict[str, str]:
+    """
+    Parse backend service strings into a dict { SERVICE_KEY: "ON"/"OFF" }.
+
+    Mapping rules provided by backend:
+      - "DPF OFF" → DPF:OFF
+      - "EGR OFF" → EGR:OFF
+      - "TVA" → TVA:OFF
+      - "MAF Removal" → MAF:OFF
+      - "Swirl Flap OFF" → FLAPS:OFF
+      - "SCR (ADblue OFF)" → ADBLUE:OFF
+      - "Decat / O2 / Lamda OFF" → LAMBDA:OFF
+      - "Decat" → LAMBDA:ON
+      - "Start and Stop OFF" → STARTSTOP:OFF
+
+    READINESS is ignored.
+    Matching is case‑insensitive.
+    "ON" means: ensure toggle ends ON (double-click if currently OFF).
+    "OFF" means: ensure toggle ends OFF (double-click if currently ON).
+    """
+    result = {}
+    if not services:
+        return result
+
+    parts = [p.strip().lower() for p in services.replace(";", ",").split(",") if p.strip()]
+
+    for p in parts:
+        txt = p.lower()
+
+        if "dpf" in txt and "off" in txt:
+            result["DPF"] = "OFF"
+        elif "egr" in txt and "off" in txt:
+            result["EGR"] = "OFF"
+        elif txt == "tva" or txt.startswith("tva"):
+            result["TVA"] = "OFF"
+        elif "maf" in txt and "removal" in txt:
+            result["MAF"] = "OFF"
+        elif "swirl" in txt or "flap" in txt:
+            result["FLAPS"] = "OFF"
+        elif "scr" in txt or "adblue" in txt:
+            result["ADBLUE"] = "OFF"
+        elif ("decat" in txt or "lambda" in txt or "lamda" in txt or "o2" in txt) and "off" in txt:
+            result["LAMBDA"] = "OFF"
+        elif txt == "decat":
+            result["LAMBDA"] = "ON"
+        elif "start" in txt and "stop" in txt and "off" in txt:
+            result["STARTSTOP"] = "OFF"
+
+    return result
@@ -0,0 +1,300 @@
+# screen_state.py — vision-based busy/idle detection for the DaVinci window
+# deps (optional): pip install numpy opencv-python pillow
+#
+# DaVinci shows the spinner from loading.png while it processes a file. The
+# detector grabs only the central region of the DaVinci window, downsamples it
+# and template-matches a precomputed pyramid of spinner templates (one per
+# on-screen size). Each template is the average of the 12 animation phases, so
+# the spokes have uniform shading and any phase matches it. Once a size has
+# matched, it is the only size tried, so a frame costs one small matchTemplate call.
+#
+# SettleDetector is the generic counterpart: it samples low-resolution frames
+# of a window, diffs each one against the previous frame and reports when
+# nothing has changed for a given number of ms. The last frames are kept in a
+# small ring buffer that can be dumped as PNGs after a failed run.
+#
+# Offline benchmarks (run anywhere numpy/opencv are installed, no Windows needed):
+#   python screen_state.py --benchmark C:\davinci_automation\screens
+#   python screen_state.py --benchmark            (synthetic frames)
+#   python screen_state.py --benchmark-settle     (synthetic frame sequence)
+
+import argparse, sys, time
+from collections import deque
+from pathlib import Path
+
+try:
+    import numpy as np
+    import cv2
+except ImportError:  # optional: davinci_automation falls back to UIA/CPU signals
+    np = cv2 = None
+
+LOADING_TEMPLATE = Path(__file__).with_name("loading.png")
+WORK_SCALE = 0.5                        # frames are matched at half resolution
+SPINNER_SIZES = (24, 32, 48, 64, 96)    # on-screen spinner sizes to try, px
+PHASES = 12                             # 12 spokes: a 30° rotation is one animation step
+BUSY_THRESHOLD = 0.55                   # TM_CCOEFF_NORMED score counted as "spinner visible"
+REGION = (0.15, 0.15, 0.85, 0.85)       # part of the window searched (fractions of w/h)
+SETTLE_SCALE = 0.25                     # frames are diffed at quarter resolution
+PIXEL_TOLERANCE = 12                    # grey-level change ignored as noise
+CHANGE_FRACTION = 0.0005                # changed-pixel share that counts as "moved" (caret blink stays below)
+RING_SIZE = 32                          # frames kept for post-mortem dumps
+
+
+def available() -> bool:
+    return cv2 is not None and LOADING_TEMPLATE.exists()
+
+
+def window_region(rect, region=REGION):
+    """Screen bbox (left, top, right, bottom) of `region` inside a window rect."""
+    left, top, right, bottom = rect
+    w, h = right - left, bottom - top
+    return (int(left + w * region[0]), int(top + h * region[1]),
+            int(left + w * region[2]), int(top + h * region[3]))
+
+
+def grab_gray(bbox):
+    """Grayscale screenshot of a screen bbox (Windows/macOS via Pillow)."""
+    from PIL import ImageGrab
+    img = ImageGrab.grab(bbox=bbox, all_screens=True)
+    return cv2.cvtColor(np.asarray(img.convert("RGB")), cv2.COLOR_RGB2GRAY)
+
+
+def _template_gray(path: Path):
+    """loading.png composited over white, as 8-bit grayscale."""
+    img = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise FileNotFoundError(path)
+    if img.ndim == 3 and img.shape[2] == 4:
+        alpha = img[:, :, 3:4].astype(np.float32) / 255.0
+        rgb = img[:, :, :3].astype(np.float32) * alpha + 255.0 * (1.0 - alpha)
+        img = rgb.astype(np.uint8)
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return img
+
+
+class LoadingDetector:
+    """Reports whether the DaVinci loading spinner is visible in a frame."""
+
+    def __init__(self, template_path: Path = LOADING_TEMPLATE, sizes=SPINNER_SIZES,
+                 scale: float = WORK_SCALE, threshold: float = BUSY_THRESHOLD):
+        self.scale = scale
+        self.threshold = threshold
+        base = _template_gray(template_path)
+        h, w = base.shape
+        phases = []
+        for k in range(PHASES):
+            m = cv2.getRotationMatrix2D((w / 2, h / 2), k * 360.0 / PHASES, 1.0)
+            phases.append(cv2.warpAffine(base, m, (w, h), flags=cv2.INTER_AREA, borderValue=255).astype(np.float32))
+        average = (sum(phases) / PHASES).astype(np.uint8)
+        # on-screen size -> template at working resolution
+        self.pyramid = {}
+        for size in sizes:
+            px = max(8, int(round(size * scale)))
+            self.pyramid[size] = cv2.resize(average, (px, px), interpolation=cv2.INTER_AREA)
+        self.locked = None
+        self.last_score = 0.0
+
+    def score(self, frame_gray) -> float:
+        """Best match score in the frame (0..1); only the locked size once one has matched."""
+        small = cv2.resize(frame_gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        sizes = [self.locked] if self.locked is not None else list(self.pyramid)
+        best = 0.0
+        for size in sizes:
+            tpl = self.pyramid[size]
+            if tpl.shape[0] > small.shape[0] or tpl.shape[1] > small.shape[1]:
+                continue
+            _, mx, _, _ = cv2.minMaxLoc(cv2.matchTemplate(small, tpl, cv2.TM_CCOEFF_NORMED))
+            best = max(best, mx)
+            if best >= self.threshold:
+                self.locked = size
+                break
+        self.last_score = best
+        return best
+
+    def is_busy(self, frame_gray) -> bool:
+        return self.score(frame_gray) >= self.threshold
+
+    def is_busy_on_screen(self, bbox) -> bool:
+        return self.is_busy(grab_gray(bbox))
+
+
+class SettleDetector:
+    """Reports when a screen region has stopped changing for `quiet_ms`."""
+
+    def __init__(self, quiet_ms: float = 400, scale: float = SETTLE_SCALE,
+                 tolerance: int = PIXEL_TOLERANCE, fraction: float = CHANGE_FRACTION, ring: int = RING_SIZE):
+        self.quiet = quiet_ms / 1000.0
+        self.scale = scale
+        self.tolerance = tolerance
+        self.fraction = fraction
+        self.ring = deque(maxlen=ring)  # (timestamp, frame, changed share)
+        self.prev = None
+        self.still_since = None
+
+    def reset(self):
+        self.prev = None
+        self.still_since = None
+
+    def changed(self, frame_gray) -> float:
+        """Share of pixels that moved since the previous frame (1.0 for the first frame)."""
+        small = cv2.resize(frame_gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        if self.prev is None or self.prev.shape != small.shape:
+            share = 1.0
+        else:
+            diff = np.abs(small.astype(np.int16) - self.prev)
+            share = np.count_nonzero(diff > self.tolerance) / diff.size
+        self.prev = small
+        return share
+
+    def update(self, frame_gray, now: float | None = None) -> bool:
+        """Feed one frame; True once the region has been unchanged for `quiet_ms`."""
+        now = time.monotonic() if now is None else now
+        share = self.changed(frame_gray)
+        self.ring.append((now, self.prev, share))
+        if share > self.fraction:
+            self.still_since = now
+            return False
+        if self.still_since is None:
+            self.still_since = now
+        return now - self.still_since >= self.quiet
+
+    def update_on_screen(self, bbox) -> bool:
+        return self.update(grab_gray(bbox))
+
+    def still_for(self, now: float | None = None) -> float:
+        """Seconds since the last change (0 before the first still frame)."""
+        if self.still_since is None or not self.ring or self.ring[-1][2] > self.fraction:
+            return 0.0
+        return (time.monotonic() if now is None else now) - self.still_since
+
+    def dump(self, folder) -> int:
+        """Write the ring buffer as PNGs (t-relative ms and changed share in the name)."""
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        t_end = self.ring[-1][0] if self.ring else 0.0
+        for i, (t, frame, share) in enumerate(self.ring):
+            cv2.imwrite(str(folder / f"settle-{i:02d}-{(t - t_end) * 1000:+.0f}ms-{share:.4f}.png"), frame)
+        return len(self.ring)
+
+
+def _synthetic_frames(n: int, size=(640, 480), spinner=48):
+    """Idle/busy frame pairs: a light UI-like background with and without the spinner."""
+    rng = np.random.default_rng(0)
+    tpl = _template_gray(LOADING_TEMPLATE)
+    frames = []
+    for i in range(n):
+        bg = np.full((size[1], size[0]), 240, np.uint8)
+        for _ in range(12):  # some text-like clutter
+            x, y = rng.integers(0, size[0] - 120), rng.integers(0, size[1] - 20)
+            cv2.putText(bg, "ECU EDC17C64 DPF EGR", (int(x), int(y) + 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, 40, 1)
+        busy = i % 2 == 1
+        if busy:
+            m = cv2.getRotationMatrix2D((tpl.shape[1] / 2, tpl.shape[0] / 2), 30.0 * (i % PHASES), 1.0)
+            sp = cv2.resize(cv2.warpAffine(tpl, m, tpl.shape[::-1], borderValue=255), (spinner, spinner),
+                            interpolation=cv2.INTER_AREA)
+            x, y = (size[0] - spinner) // 2, (size[1] - spinner) // 2
+            region = bg[y:y + spinner, x:x + spinner]
+            np.minimum(region, sp, out=region)
+        frames.append((f"synthetic-{i:03d}-{'busy' if busy else 'idle'}", bg, busy))
+    return frames
+
+
+def _synthetic_sequence(n: int, size=(1280, 800), busy_frames: int = 20, fps: float = 10.0):
+    """A window that animates a spinner and a progress bar for `busy_frames`, then sits still (caret blinking)."""
+    base = _synthetic_frames(2, size)[0][1]
+    tpl = _template_gray(LOADING_TEMPLATE)
+    seq = []
+    for i in range(n):
+        frame = base.copy()
+        if i < busy_frames:
+            m = cv2.getRotationMatrix2D((tpl.shape[1] / 2, tpl.shape[0] / 2), 30.0 * i, 1.0)
+            sp = cv2.resize(cv2.warpAffine(tpl, m, tpl.shape[::-1], borderValue=255), (48, 48),
+                            interpolation=cv2.INTER_AREA)
+            x, y = (size[0] - 48) // 2, (size[1] - 48) // 2
+            np.minimum(frame[y:y + 48, x:x + 48], sp, out=frame[y:y + 48, x:x + 48])
+            frame[size[1] - 40:size[1] - 30, 100:100 + 50 * i] = 90
+        if i % 2:
+            frame[200:216, 300] = 0  # caret
+        seq.append((i / fps, frame, i < busy_frames))
+    return seq
+
+
+def _benchmark_settle(n: int, quiet_ms: float):
+    fps = 10.0
+    seq = _synthetic_sequence(n, fps=fps)
+    det = SettleDetector(quiet_ms=quiet_ms)
+    times, settled_at = [], None
+    for t, frame, _busy in seq:
+        t0 = time.perf_counter()
+        settled = det.update(frame, now=t)
+        times.append((time.perf_counter() - t0) * 1000)
+        if settled and settled_at is None:
+            settled_at = t
+    last_busy = max(t for t, _f, busy in seq if busy)
+    expected = last_busy + 1 / fps + quiet_ms / 1000
+    times.sort()
+    h, w = seq[0][1].shape
+    print(f"{len(seq)} frames {w}x{h} @ {fps:.0f} fps: diff median {times[len(times) // 2]:.2f} ms, "
+          f"max {times[-1]:.2f} ms")
+    try:  # capture cost needs a desktop (Windows/macOS); skipped elsewhere
+        t0 = time.perf_counter()
+        for _ in range(10):
+            grab_gray((0, 0, w, h))
+        print(f"capture {w}x{h}: {(time.perf_counter() - t0) * 100:.2f} ms/frame")
+    except Exception as e:
+        print(f"capture not measured ({type(e).__name__}: {e})")
+    print(f"settled at {settled_at if settled_at is None else f'{settled_at:.1f}s'}, "
+          f"expected {expected:.1f}s")
+    return 0 if settled_at is not None and abs(settled_at - expected) < 1.5 / fps else 1
+
+
+def _benchmark(folder: str | None, n: int):
+    det = LoadingDetector()
+    if folder:
+        frames = []
+        for p in sorted(Path(folder).glob("*.png")):
+            img = cv2.imread(str(p), cv2.IMREAD_GRAYSCALE)
+            if img is not None:
+                # file names containing "busy"/"idle" are checked against the result
+                label = "busy" in p.stem.lower() if ("busy" in p.stem.lower() or "idle" in p.stem.lower()) else None
+                frames.append((p.name, img, label))
+    else:
+        frames = _synthetic_frames(n)
+    if not frames:
+        print("no frames found")
+        return 1
+    times, wrong = [], 0
+    for name, img, expected in frames:
+        t0 = time.perf_counter()
+        busy = det.is_busy(img)
+        times.append((time.perf_counter() - t0) * 1000)
+        mark = "" if expected is None or expected == busy else "  <-- WRONG"
+        wrong += bool(mark)
+        print(f"{name}: {'busy' if busy else 'idle'} score={det.last_score:.2f} {times[-1]:.2f} ms{mark}")
+    times.sort()
+    print(f"{len(frames)} frames: median {times[len(times) // 2]:.2f} ms, "
+          f"p95 {times[int(len(times) * 0.95) - 1 if len(times) > 1 else 0]:.2f} ms, "
+          f"max {times[-1]:.2f} ms, misclassified {wrong}")
+    return 1 if wrong else 0
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="DaVinci loading-spinner detector")
+    p.add_argument("--benchmark", nargs="?", const="", metavar="DIR",
+                   help="Classify recorded screenshots in DIR (*.png; 'busy'/'idle' in the name is checked), "
+                        "or synthetic frames when DIR is omitted")
+    p.add_argument("--benchmark-settle", action="store_true",
+                   help="Time the frame-difference settle detector on a synthetic frame sequence")
+    p.add_argument("--frames", type=int, default=40, help="Number of synthetic frames")
+    p.add_argument("--quiet-ms", type=float, default=400, help="Settle time for --benchmark-settle")
+    a = p.parse_args()
+    if cv2 is None:
+        print("numpy and opencv-python are required: pip install numpy opencv-python")
+        sys.exit(2)
+    if a.benchmark_settle:
+        sys.exit(_benchmark_settle(a.frames, a.quiet_ms))
+    if a.benchmark is None:
+        p.print_help()
+        sys.exit(0)
+    sys.exit(_benchmark(a.benchmark or None, a.frames))
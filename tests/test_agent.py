@@ -0,0 +1,258 @@
+# Delivery machinery of agent.py against local stand-ins (temporary journal,
+# an HTTP server on 127.0.0.1, dummy automation scripts); no DaVinci and no
+# backend needed: python -m pytest tests
+
+import collections
+import http.server
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import agent
+
+
+@pytest.fixture
+def flaky_backend():
+    """HTTP server on 127.0.0.1 answering 503 to the first `refuse[path]` POSTs (always when None), then 200.
+
+    Yields (base URL, refuse, hits); hits maps each path to its
+    [(monotonic time, Idempotency-Key, status)].
+    """
+    refuse = {}
+    hits = collections.defaultdict(list)
+
+    class FlakyBackend(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            path = self.path.split("?")[0]
+            n = refuse.get(path, 0)
+            status = 503 if n is None or len(hits[path]) < n else 200
+            hits[path].append((time.monotonic(), self.headers.get("Idempotency-Key"), status))
+            self.send_response(status)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyBackend)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}", refuse, hits
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def journal(tmp_path):
+    j = agent._TaskJournal(tmp_path / "journal.db")
+    yield j
+    if j._conn is not None:
+        j._conn.close()
+
+
+def test_outbox_retries_with_backoff_and_parks(tmp_path, flaky_backend, journal):
+    """One result is refused twice and one failure once before they are accepted;
+    a third reply goes to an endpoint that is always down and is parked after
+    max_attempts. Every attempt of a reply carries its Idempotency-Key.
+    """
+    base, refuse, hits = flaky_backend
+    refuse.update({"/staging/save_reply": 2, "/staging/failure": 1, "/production/failure": None})
+    base_delay, max_delay, max_attempts = 0.2, 1.0, 4
+    outbox = agent._Outbox(journal, base_delay=base_delay, max_delay=max_delay, max_attempts=max_attempts,
+                           urls={("save_reply", "1"): f"{base}/staging/save_reply",
+                                 ("failure", "1"): f"{base}/staging/failure",
+                                 ("failure", "0"): f"{base}/production/failure"})
+
+    result = tmp_path / "result.mod"
+    result.write_bytes(os.urandom(64 * 1024))
+    uploaded = {"task_id": 101, "on_dev": "1"}
+    refused = {"task_id": 102, "on_dev": "1"}
+    down = {"task_id": 103, "on_dev": "0"}
+    journal.record(uploaded, "automated", saved_path=str(result))
+    outbox.enqueue(uploaded, "save_reply", saved_path=str(result))
+    outbox.enqueue(uploaded, "save_reply", saved_path=str(result))  # duplicate: ignored
+    for task in (refused, down):
+        journal.record(task, "failed", error="test", reply_sent=0)
+        outbox.enqueue(task, "failure", message="test")
+    outbox.start()
+    try:
+        deadline = time.monotonic() + 20
+        while outbox.pending() and time.monotonic() < deadline:
+            time.sleep(0.1)
+    finally:
+        outbox.stop()
+
+    for path, kind, task, attempts in (("/staging/save_reply", "save_reply", uploaded, 3),
+                                       ("/staging/failure", "failure", refused, 2),
+                                       ("/production/failure", "failure", down, max_attempts)):
+        got = hits[path]
+        assert len(got) == attempts, path
+        assert {k for _, k, _ in got} == {agent._Outbox.idempotency_key(kind, task)}, path
+        for i in range(1, len(got)):
+            low = base_delay * (2 ** (i - 1)) * 0.5
+            high = min(max_delay, base_delay * (2 ** (i - 1))) * 1.5 + 0.5
+            assert low - 0.05 <= got[i][0] - got[i - 1][0] <= high, f"{path} retry {i}"
+
+    for task, stage, reply_sent in ((uploaded, "uploaded", None), (refused, "failed", 1), (down, "failed", 0)):
+        row = journal.get(task["task_id"], task["on_dev"]) or {}
+        assert row.get("stage") == stage, task
+        if reply_sent is not None:
+            assert row.get("reply_sent") == reply_sent, task
+    with journal._lock:
+        rows = [dict(r) for r in outbox._db().execute("SELECT * FROM outbox")]
+    assert [(r["idem_key"], r["parked"], r["attempts"]) for r in rows] == \
+        [(agent._Outbox.idempotency_key("failure", down), 1, max_attempts)]
+
+
+# Dummy automation: `ok` streams 300 lines with the markers of a real run and
+# exits; `hang` reports its result, starts a grandchild (writing its pid to
+# argv[2]) and then never exits.
+DUMMY_AUTOMATION = r"""
+import subprocess, sys, time
+mode = sys.argv[1]
+print("SAVING_TO:C:\\ecu_files\\modified\\early.bin", flush=True)
+print('STAGE_TIMING:{"stage": "launch", "duration": 0.1, "outcome": "ok"}', flush=True)
+print("SAVED_PATH:C:\\ecu_files\\modified\\result.bin", flush=True)
+if mode == "hang":
+    grandchild = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(600)"])
+    open(sys.argv[2], "w").write(str(grandchild.pid))
+    time.sleep(600)
+for i in range(300):
+    print(f"filler line {i}", flush=True)
+print("stderr tail", file=sys.stderr, flush=True)
+print("last line", flush=True)
+"""
+
+
+def _pid_alive(pid: int) -> bool:
+    if os.name == "nt":
+        out = subprocess.run(["tasklist", "/FI", f"PID eq {pid}", "/NH"], capture_output=True, text=True)
+        return str(pid) in out.stdout
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    # a killed child of ours may linger as a zombie until its parent reaps it
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().split(")")[-1].split()[0] != "Z"
+    except OSError:
+        return True
+
+
+def test_supervised_run_parses_stream_into_bounded_buffer(tmp_path):
+    """SAVED_PATH (over SAVING_TO) and stage events are parsed even after their lines left the ring buffer."""
+    child = tmp_path / "dummy_automation.py"
+    child.write_text(DUMMY_AUTOMATION, encoding="utf-8")
+
+    r = agent._run_supervised([sys.executable, str(child), "ok"], timeout=60, cwd=str(tmp_path), max_lines=50)
+    assert r.returncode == 0 and not r.timed_out
+    assert len(r.stdout) == 50
+    assert (r.stdout[0], r.stdout[-1]) == ("filler line 251", "last line")
+    assert list(r.stderr) == ["stderr tail"]
+    assert r.saved_path == "C:\\ecu_files\\modified\\result.bin"
+    assert [ev.get("stage") for ev in r.stages] == ["launch"]
+
+
+def test_supervised_run_kills_hung_process_tree(tmp_path):
+    """A child hanging past its deadline is killed together with the process it started."""
+    child = tmp_path / "dummy_automation.py"
+    child.write_text(DUMMY_AUTOMATION, encoding="utf-8")
+    pid_file = tmp_path / "grandchild.pid"
+
+    r = agent._run_supervised([sys.executable, str(child), "hang", str(pid_file)], timeout=3, cwd=str(tmp_path))
+    assert r.timed_out and r.returncode != 0
+    assert 3 <= r.duration < 10
+    assert r.saved_path == "C:\\ecu_files\\modified\\result.bin"
+    grandchild = int(pid_file.read_text())
+    deadline = time.monotonic() + 5
+    while _pid_alive(grandchild) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert not _pid_alive(grandchild)
+
+
+# Dummy worker: answers each job with a stale JOB_DONE marker (id 0), one line
+# of output and then the JOB_DONE for the job it was given.
+DUMMY_WORKER = r"""
+import json, sys
+print("WORKER_READY", flush=True)
+for line in sys.stdin:
+    job = json.loads(line)
+    print('JOB_DONE:{"id": 0, "code": 0}', flush=True)
+    print("working", flush=True)
+    print("JOB_DONE:" + json.dumps({"id": job["id"], "code": 3}), flush=True)
+"""
+
+
+def test_worker_waits_for_its_own_job_done(tmp_path):
+    script = tmp_path / "dummy_worker.py"
+    script.write_text(DUMMY_WORKER, encoding="utf-8")
+    worker = agent._AutomationWorker(cmd=[sys.executable, str(script)], cwd=tmp_path)
+    try:
+        first = worker.run_job({"task": 1}, timeout=10)
+        second = worker.run_job({"task": 2}, timeout=10)
+    finally:
+        worker.stop()
+    for r in (first, second):
+        assert r.returncode == 3 and not r.timed_out
+        assert list(r.stdout) == ["working"]
+    assert worker.jobs_done == 2
+
+
+def test_breaker_probes_after_cooldown_without_a_poll_cycle():
+    probed = threading.Event()
+    breaker = agent._CircuitBreaker("test", threshold=2, cooldown=0.3, probe=probed.set)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    assert probed.wait(2)
+    assert breaker.state == "half-open"
+    breaker.record_success()
+    assert breaker.allow()
+
+
+@pytest.fixture
+def fake_sources(monkeypatch):
+    """Staging (budget 0.5 s) and production (budget 3 s) answering after `delay[label]` seconds."""
+    delay = {"staging": 0.0, "production": 0.0}
+
+    def fetch(label, url, default_on_dev, budget):
+        time.sleep(delay[label])
+        return [{"task_id": label, "on_dev": default_on_dev}]
+
+    monkeypatch.setattr(agent, "POLL_SOURCES", [("staging", "s", "1", 0.5), ("production", "p", "0", 3.0)])
+    monkeypatch.setattr(agent, "_fetch_source", fetch)
+    monkeypatch.setattr(agent, "_BREAKERS", {"staging": agent._CircuitBreaker("staging", threshold=2),
+                                             "production": agent._CircuitBreaker("production")})
+    monkeypatch.setattr(agent, "_LATE_RESULTS", {})
+    monkeypatch.setattr(agent, "_ANSWERED_AT", {})
+    return delay
+
+
+def test_poll_hands_over_each_source_as_it_answers(fake_sources):
+    fake_sources.update(staging=0.4, production=0.05)
+    t0 = time.monotonic()
+    got = []
+    for label, tasks in agent._poll_sources():
+        got.append((label, time.monotonic() - t0))
+    assert [label for label, _ in got] == ["production", "staging"]
+    assert got[0][1] < 0.3
+
+
+def test_slow_answers_trip_the_breaker(fake_sources):
+    fake_sources.update(staging=0.7)
+    for _ in range(2):
+        list(agent._poll_sources())
+        time.sleep(0.4)  # let the abandoned staging poll finish
+    assert agent._BREAKERS["staging"].state == "open"
+    assert agent._BREAKERS["production"].state == "closed"